@@ -5,7 +5,9 @@ import logging
 import logging.handlers as handlers
 import time
 import requests
-from datetime import datetime, date
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+from datetime import datetime, date, timedelta
 from dataclasses import dataclass
 import sys
 from http import HTTPStatus
@@ -16,18 +18,53 @@ import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.header import Header
+from email.utils import parsedate_to_datetime
 import secrets
+import random
 import string
 import glob
+import hashlib
+import itertools
 import traceback
+import bisect
+import heapq
+from array import array
+from collections import Counter, OrderedDict, defaultdict, deque
+from collections.abc import MutableMapping
+from functools import lru_cache
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 
 DEFAULT_360_API_URL = "https://api360.yandex.net"
 ITEMS_PER_PAGE = 100
 MAX_RETRIES = 3
 LOG_FILE = "add_users.log"
+# Базовая задержка экспоненциальной паузы между повторными попытками (удваивается с каждой попыткой)
 RETRIES_DELAY_SEC = 2
-SLEEP_TIME_BETWEEN_API_CALLS = 0.5
+# Максимальная пауза между повторными попытками
+MAX_RETRIES_DELAY_SEC = 60
+# Коды ответа API, при которых запрос повторяется (перегрузка и временные ошибки сервера)
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+# Неидемпотентные методы (создание пользователей, алиасов, подразделений): повтор только при 429
+# или если соединение не было установлено и запрос не отправлен
+NON_IDEMPOTENT_METHODS = ('POST',)
+# Ограничение частоты запросов к API 360 (используются, если не заданы API_RATE_LIMIT_RPS и API_RATE_LIMIT_BURST в .env)
+DEFAULT_API_RATE_LIMIT_RPS = 10
+DEFAULT_API_RATE_LIMIT_BURST = 20
+# Размер пула HTTP-соединений к API 360 (используется, если не задан API_POOL_SIZE в .env)
+DEFAULT_API_POOL_SIZE = 10
+# Количество одновременных запросов при массовых операциях (используется, если не задан MAX_PARALLEL_REQUESTS в .env)
+DEFAULT_MAX_PARALLEL_REQUESTS = 1
+# Количество процессов для проверки строк файла пользователей (используется, если не задан VALIDATION_PROCESSES в .env)
+DEFAULT_VALIDATION_PROCESSES = 1
+# Файлы с меньшим числом строк проверяются в одном процессе: запуск процессов дороже самой проверки
+PARALLEL_VALIDATION_MIN_ROWS = 5000
+# Количество строк, передаваемых процессу проверки за один раз
+PARALLEL_VALIDATION_CHUNK_SIZE = 1000
+# Количество первых строк файла, по которым определяются форматы дат и телефонов в колонках
+FORMAT_INFERENCE_SAMPLE_ROWS = 1000
 
 SENSITIVE_FIELDS = ['password', 'oauth_token', 'access_token', 'token']
 # DEFAULT_PASSWORD_PATTERN is used to validate the password
@@ -36,6 +73,42 @@ DEFAULT_PASSWORD_PATTERN = r'^(?=.*[A-Z])(?=.*\d)(?=.*[!@#$%^&*()_+\-=\[\]{};:"\
 # DEFAULT_EMAIL_PATTERN is used to validate the personal email
 DEFAULT_EMAIL_PATTERN = r'^[a-zA-Z0-9]([a-zA-Z0-9._-]*[a-zA-Z0-9])?@[a-zA-Z0-9]([a-zA-Z0-9.-]*[a-zA-Z0-9])?(\.[a-zA-Z]{2,})+$'
 
+# Регулярные выражения проверок значений компилируются один раз при загрузке модуля
+EMAIL_RE = re.compile(DEFAULT_EMAIL_PATTERN)
+NAME_RE = re.compile(r'^[А-ЯЁ][а-яё]+(-[А-ЯЁ][а-яё]+)?$')
+LOGIN_RE = re.compile(r'^[a-z0-9.-]+$')
+ALIAS_CHARS_RE = re.compile(r'^[a-zA-Z0-9._-]+$')
+ALIAS_EDGE_CHAR_RE = re.compile(r'[a-zA-Z0-9]')
+SHARED_MAILBOX_LOCAL_PART_RE = re.compile(r'^[a-zA-Z0-9]([a-zA-Z0-9._-]*[a-zA-Z0-9])?$')
+SHARED_MAILBOX_DOMAIN_RE = re.compile(r'^[a-zA-Z0-9]([a-zA-Z0-9.-]*[a-zA-Z0-9])?(\.[a-zA-Z]{2,})+$')
+PHONE_EXTENSION_RE = re.compile(r'(?:ext|extension|доб|добавочный)(?:ension)?\.?\s*(\d+)', re.IGNORECASE)
+PHONE_CHARS_RE = re.compile(r'^[0-9\s\.\-\+\(\)]+$')
+PHONE_INTERNATIONAL_START_RE = re.compile(r'^\+(\d|\()')
+NON_DIGITS_RE = re.compile(r'[^\d]')
+# Форма номера телефона: цифры заменяются на X (+7 (495) 123-45-67 -> +X (XXX) XXX-XX-XX)
+PHONE_SHAPE_TABLE = str.maketrans('0123456789', 'XXXXXXXXXX')
+# Форма номера без добавочного, которую можно проверять целиком (validate_phone_number_with_shape)
+PHONE_SHAPE_RE = re.compile(r'^[X\s\.\-\+\(\)]+$')
+# Форматы дат в порядке проверки (is_valid_date)
+DATE_FORMATS = (
+    '%d.%m.%Y',  # DD.MM.YYYY
+    '%d/%m/%Y',  # DD/MM/YYYY
+    '%d-%m-%Y',  # DD-MM-YYYY
+    '%Y-%m-%d',  # YYYY-MM-DD (ISO формат)
+    '%Y/%m/%d',  # YYYY/MM/DD
+    '%m/%d/%Y',  # MM/DD/YYYY (US формат)
+    '%d.%m.%y',  # DD.MM.YY
+    '%Y.%m.%d',  # YYYY.MM.DD
+)
+TEXT_DATE_RES = (
+    # Месяц прописью на английском: 25 December 2021, December 25, 2021
+    re.compile(r'(\d{1,2})\s+(January|February|March|April|May|June|July|August|September|October|November|December)\s+(\d{4})', re.IGNORECASE),
+    re.compile(r'(January|February|March|April|May|June|July|August|September|October|November|December)\s+(\d{1,2}),?\s+(\d{4})', re.IGNORECASE),
+)
+MASK_EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+# Пароль: минимум 8 символов, минимум одна заглавная буква, одна цифра, один спецсимвол
+MASK_PASSWORD_RE = re.compile(r'^(?=.*[A-Z])(?=.*\d)(?=.*[!@#$%^&*()_+\-=\[\]{};:"\\|,.<>\/?])[A-Za-z0-9!@#$%^&*()_+\-=\[\]{};:"\\|,.<>\/?]{8,}$')
+
 USERS_CSV_REQUIRED_HEADERS = ["id", "login", "password", "password_change_required", "first_name", "last_name", "middle_name", "position", "gender", "birthday", "language", "work_phone", "mobile_phone", "personal_email", "department", "is_enabled", "is_admin", "aliases", "update_password"]
 
 # MAX value is 1000
@@ -57,6 +130,14 @@ ALL_GROUPS_REFRESH_IN_MINUTES = 15
 ALL_DEPS_REFRESH_IN_MINUTES = 15
 EXTENDED_USERS_REFRESH_IN_MINUTES = 15
 ALL_USERS_REFRESH_IN_MINUTES = 15
+# Версия формата файла снимка справочника (SNAPSHOT_CACHE_FILE). Снимки другой версии игнорируются
+SNAPSHOT_CACHE_SCHEMA_VERSION = 1
+# Версия формата файла отпечатков строк (ROW_FINGERPRINTS_FILE). Файлы другой версии игнорируются
+ROW_FINGERPRINTS_SCHEMA_VERSION = 2
+# Срок годности снимка справочника на диске (используется, если не задан SNAPSHOT_CACHE_TTL_MINUTES в .env)
+DEFAULT_SNAPSHOT_CACHE_TTL_MINUTES = 60
+# Количество результатов сложного поиска в кэше (используется, если не задан QUERY_CACHE_SIZE в .env)
+DEFAULT_QUERY_CACHE_SIZE = 128
 
 # Необходимые права доступа для работы скрипта
 NEEDED_PERMISSIONS = [
@@ -74,8 +155,39 @@ NEEDED_PERMISSIONS = [
 # Глобальная переменная для кэширования загруженных алиасов поисковых атрибутов
 _search_aliases_cache = None
 
+# Разделы снимка справочника на диске и соответствующие им поля SettingParams (список, время загрузки)
+SNAPSHOT_CACHE_SETTINGS_ATTRS = {
+    'users': ('all_users', 'all_users_get_timestamp'),
+    'departments': ('all_deps', 'all_deps_get_timestamp'),
+    'groups': ('all_groups', 'all_groups_get_timestamp'),
+}
+# Блокировка записи файла снимка (фоновые обновления разных разделов могут завершиться одновременно)
+_snapshot_cache_lock = threading.Lock()
+# Блокировка замены разделов справочника в памяти и номера загрузок разделов (store_directory_section):
+# фоновое обновление из API не заменяет данные, загруженные после его запуска
+_directory_load_lock = threading.Lock()
+_directory_load_generations = Counter()
+# Потоки фонового обновления разделов справочника (warm_from_snapshot_cache)
+_snapshot_refresh_threads = {}
+# Блокировка увеличения версии данных организации (bump_snapshot_version вызывается и из параллельных потоков)
+_snapshot_version_lock = threading.Lock()
+
+# Контекст текущей обрабатываемой строки файла (отдельный для каждого потока)
+_log_context = threading.local()
+
+class RowContextFilter(logging.Filter):
+    """Добавляет к сообщениям лога префикс строки файла, обрабатываемой в текущем потоке."""
+
+    def filter(self, record):
+        row_prefix = getattr(_log_context, "row_prefix", "")
+        if row_prefix and not getattr(record, "_row_prefixed", False):
+            record.msg = f"{row_prefix} {record.msg}"
+            record._row_prefixed = True
+        return True
+
 logger = logging.getLogger("add_users.log")
 logger.setLevel(logging.DEBUG)
+logger.addFilter(RowContextFilter())
 console_handler = logging.StreamHandler()
 console_handler.setLevel(logging.INFO)
 console_handler.setFormatter(logging.Formatter('%(asctime)s.%(msecs)03d %(levelname)s:\t%(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
@@ -93,86 +205,582 @@ def read_file_data(settings: "SettingParams"):
             data.append(line.strip().split(';'))
     return data
 
-def add_users_from_file_phase_1(settings: "SettingParams", analyze_only=False):
-    logger.info("-" * 100)
-    logger.info(f'Чтение пользователей из файла {settings.users_file} и проверка корректности данных.')
-    logger.info("-" * 100)
+class UsersFileFormatError(Exception):
+    """Количество полей в строке файла пользователей не соответствует заголовку."""
+
+
+class UsersCsvFile:
+    """
+    Файл пользователей (USERS_FILE) для потокового чтения в add_users_from_file_phase_1
+    и update_users_from_file_phase_1.
+
+    Файл читается модулем csv (разделитель ';', значение в кавычках может содержать ';' и кавычки "")
+    по одной строке, поэтому весь файл в памяти не хранится. Каждый проход по объекту читает файл
+    заново: по нему можно пройти несколько раз (проверка уникальности алиасов, проверка строк).
+    Строки, начинающиеся с '#', и пустые строки пропускаются.
+
+    Args:
+        file_name: Имя файла
+        clear_value: Значение поля, которое заменяется на ' ' (очистка поля при обновлении, CLEAR_FIELD_VALUE)
+    """
+
+    def __init__(self, file_name: str, clear_value: str = None):
+        self.file_name = file_name
+        self.clear_value = clear_value
+        self.headers = []
+
+    def read_headers(self) -> bool:
+        """Читает заголовок файла. Возвращает False, если есть заголовки не из USERS_CSV_REQUIRED_HEADERS."""
+        with open(self.file_name, 'r', encoding='utf-8', newline='') as csvfile:
+            header_row = next(csv.reader([csvfile.readline()], delimiter=';'), [])
+        self.headers = [header.replace('"', '').strip() for header in header_row]
+        bad_header = False
+        for header in self.headers:
+            if header not in USERS_CSV_REQUIRED_HEADERS:
+                logger.error(f'Ошибка! Заголовок {header} не соответствует требуемым: {";".join(USERS_CSV_REQUIRED_HEADERS)}')
+                bad_header = True
+        logger.debug(f'Headers: {self.headers}')
+        return not bad_header
+
+    def _data_lines(self, csvfile, log_skipped: bool):
+        # Первая строка - заголовок
+        csvfile.readline()
+        for line in csvfile:
+            if line.startswith('#'):
+                if log_skipped:
+                    logger.debug(f'Строка начинается с "#". Пропуск строки из файла - {mask_csv_line_safe(line.strip())}')
+                continue
+            yield line
+
+    def iter_rows(self, log_skipped: bool = False):
+        """
+        Возвращает строки файла по одной в виде словарей {заголовок: значение}.
+
+        Args:
+            log_skipped: Записывать в лог пропущенные строки с комментариями
+
+        Raises:
+            UsersFileFormatError: Количество полей в строке не совпадает с количеством заголовков
+        """
+        headers = self.headers
+        clear_value = self.clear_value
+        with open(self.file_name, 'r', encoding='utf-8', newline='') as csvfile:
+            for fields in csv.reader(self._data_lines(csvfile, log_skipped), delimiter=';'):
+                if not fields:
+                    continue
+                if len(fields) != len(headers):
+                    logger.error(f'Ошибка! Строка {mask_csv_line_safe(";".join(fields))} - количество полей не соответствует количеству заголовков в первой строке файла. Возможно, в значении какого-либо поля есть точка с запятой. Заключите значение в кавычки или замените точку с запятой на другой символ.')
+                    raise UsersFileFormatError(f'Количество полей в строке {len(fields)}, заголовков {len(headers)}')
+                entry = {}
+                for header, value in zip(headers, fields):
+                    value = value.strip()
+                    entry[header] = ' ' if value == clear_value else value
+                yield entry
+
+    def __iter__(self):
+        return self.iter_rows()
+
+
+def open_users_file(settings: "SettingParams", clear_value: str = None):
+    """
+    Открывает файл пользователей settings.users_file для потокового чтения (UsersCsvFile).
+    Заголовок и количество полей во всех строках проверяются сразу, без загрузки файла в память.
+
+    Args:
+        settings: Объект настроек приложения
+        clear_value: Значение поля, означающее очистку (CLEAR_FIELD_VALUE при обновлении)
+
+    Returns:
+        Кортеж (UsersCsvFile или None при ошибке, количество строк с данными)
+    """
     users_file_name = settings.users_file
     if not os.path.exists(users_file_name):
         full_path = os.path.join(os.path.dirname(__file__), users_file_name)
         if not os.path.exists(full_path):
             logger.error(f'Ошибка! Файл {users_file_name} не существует!')
-            return
-        else:
-            users_file_name = full_path
-    
-    ## Another way to read file with needed transfromations
-    headers = []
-    data = []
+            return None, 0
+        users_file_name = full_path
+
     try:
         logger.info("-" *100)
         logger.info(f'Чтение файла {users_file_name}')
         logger.info("-" *100)
-        bad_header = False
-        with open(users_file_name, 'r', encoding='utf-8') as csvfile:
-            headers = csvfile.readline().replace('"', '').split(";")
-            for header in headers:
-                if header.strip() not in USERS_CSV_REQUIRED_HEADERS:
-                    logger.error(f'Ошибка! Заголовок {header} не соответствует требуемым: {";".join(USERS_CSV_REQUIRED_HEADERS)}')
-                    bad_header = True
-            if bad_header:
-                return False, []
-            logger.debug(f'Headers: {headers}')
-            for line in csvfile:
-                if line.startswith('#'):
-                    logger.debug(f'Строка начинается с "#"Пропуск строки из файла - {mask_csv_line_safe(line)}')
-                    continue
-                
-                logger.debug(f'Чтение строки из файла - {mask_csv_line_safe(line)}')
-                #fields = line.replace('"','').split(";")
-                fields = line.split(";")
-                if len(fields) != len(headers):
-                    logger.error(f'Ошибка! Строка {mask_csv_line_safe(line)} - количество полей не соответствует количеству заголовков в первой строке файла. Возможно, в значении какого-либо поля есть точка с запятой. Попробуйте заменить её на другой символ.')
-                    return False, []
-                entry = {}
-                for i,value in enumerate(fields):
-                    # Удаляем кавычки только если они обрамляют всю строку
-                    value = remove_quotes_if_wrapped(value)
-                    entry[headers[i].strip()] = value.strip()
-                data.append(entry)
-        logger.info(f'Конец чтения файла {users_file_name}')
+        users_file = UsersCsvFile(users_file_name, clear_value)
+        if not users_file.read_headers():
+            return None, 0
+        rows_count = sum(1 for _ in users_file)
+        logger.info(f'Конец чтения файла {users_file_name}. Строк с данными: {rows_count}')
         logger.info("\n")
     except Exception as e:
         logger.error(f"{type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
+        return None, 0
+    return users_file, rows_count
+
+def normalize_alias(alias: str) -> str:
+    """Приводит алиас из файла (alias или alias@domain) к имени алиаса в нижнем регистре."""
+    return alias.split("@")[0].lower().strip()
+
+
+@dataclass(frozen=True)
+class ColumnRule:
+    """
+    Правило проверки колонки файла в схеме FileSchema.
+
+    Args:
+        column: Имя колонки файла
+        check: Тип значения - имя проверки (см. SchemaValidator)
+        normalize: Функция приведения значения перед проверкой
+        separator: Разделитель, если колонка содержит список значений (каждое значение проверяется отдельно)
+        check_empty: Проверять пустые значения (по умолчанию пустые значения не проверяются)
+    """
+    column: str
+    check: str
+    normalize: object = None
+    separator: str = None
+    check_empty: bool = False
+
+
+class FileSchema:
+    """
+    Декларативная схема проверки файла импорта: для каждой колонки задаются тип значения,
+    нормализация и проверка. Схема компилируется один раз на запуск (compile), дальше все
+    значения проверяются скомпилированной схемой (SchemaValidator).
+
+    Схема проверяет только значения колонок; решение о строке (ошибка, предупреждение, пропуск)
+    принимает сама функция импорта, так как для добавления и обновления оно различается.
+
+    Args:
+        name: Имя схемы (ключ в FILE_SCHEMAS, по нему схема передается в процессы проверки строк)
+        rules: Правила колонок (ColumnRule)
+    """
+
+    def __init__(self, name: str, rules: list):
+        self.name = name
+        self.rules = {rule.column: rule for rule in rules}
+
+    def compile(self, password_pattern: str = None, column_formats: dict = None) -> "SchemaValidator":
+        return SchemaValidator(self, password_pattern, column_formats)
+
+    def infer_formats(self, rows, sample_size: int = FORMAT_INFERENCE_SAMPLE_ROWS) -> dict:
+        """
+        Определяет по первым sample_size строкам преобладающий формат значений в колонках дат и телефонов
+        и записывает найденные форматы в лог.
+
+        Для даты формат - первый из DATE_FORMATS, которым разбирается значение (как в is_valid_date).
+        Для телефона формат - форма номера (PHONE_SHAPE_TABLE), если номер этой формы проходит проверку.
+
+        Returns:
+            Словарь {колонка: формат} для колонок, где формат определен
+        """
+        columns = [rule.column for rule in self.rules.values() if rule.check in ('date', 'phone')]
+        if not columns:
+            return {}
+        samples = {column: Counter() for column in columns}
+        examples = {}
+        for element in itertools.islice(rows, sample_size):
+            for column in columns:
+                value = element.get(column, '')
+                if not value.strip():
+                    continue
+                if self.rules[column].check == 'date':
+                    value_format = match_date_format(value)
+                else:
+                    value_format = value.translate(PHONE_SHAPE_TABLE)
+                    examples.setdefault((column, value_format), value)
+                if value_format:
+                    samples[column][value_format] += 1
+
+        column_formats = {}
+        logger.info(f'Форматы значений в колонках (по первым {sample_size} строкам):')
+        for column in columns:
+            total = sum(samples[column].values())
+            if not total:
+                continue
+            value_format, count = samples[column].most_common(1)[0]
+            if self.rules[column].check == 'phone':
+                example = examples[(column, value_format)]
+                if not PHONE_SHAPE_RE.match(value_format) or not validate_phone_number(example)[0]:
+                    logger.info(f'  {column}: преобладающий формат {value_format} не является корректным номером, быстрая проверка не используется')
+                    continue
+            column_formats[column] = value_format
+            logger.info(f'  {column}: {value_format} ({count} из {total} значений)')
+        return column_formats
+
+
+class SchemaValidator:
+    """
+    Скомпилированная схема файла (FileSchema.compile). Функции проверки колонок выбираются один раз,
+    регулярные выражения проверок скомпилированы заранее (шаблон пароля - compile_password_pattern).
+    Для каждой колонки ведутся счетчики проверенных значений и значений, не прошедших проверку.
+
+    Если для колонки дат или телефонов определен преобладающий формат (FileSchema.infer_formats),
+    значения сначала проверяются в этом формате, остальные форматы проверяются только для других значений.
+
+    Args:
+        schema: Схема файла
+        password_pattern: Регулярное выражение для проверки пароля (PASSWORD_PATTERN)
+        column_formats: Преобладающие форматы колонок {колонка: формат}
+    """
+
+    def __init__(self, schema: FileSchema, password_pattern: str = None, column_formats: dict = None):
+        checks = {
+            'name': validate_name,
+            'password': lambda value: validate_password_pattern(password_pattern, value),
+            'date': is_valid_date,
+            'phone': validate_phone_number,
+            'email': validate_email,
+            'alias': lambda value: validate_alias(None, value),
+            'shared_email': lambda value: validate_shared_mailbox_email(None, value),
+            'required': bool,
+        }
+        self.schema = schema
+        self.password_pattern = password_pattern
+        self.column_formats = column_formats or {}
+        # колонка -> (проверка, нормализация, разделитель, проверять пустые)
+        self.columns = {column: (self._column_check(rule, checks), rule.normalize, rule.separator, rule.check_empty)
+                        for column, rule in schema.rules.items()}
+        self.checked = Counter()
+        self.failed = Counter()
+
+    def _column_check(self, rule: ColumnRule, checks: dict):
+        value_format = self.column_formats.get(rule.column)
+        if value_format and rule.check == 'date':
+            date_formats = (value_format,) + tuple(f for f in DATE_FORMATS if f != value_format)
+            return lambda value: is_valid_date(value, date_formats=date_formats)
+        if value_format and rule.check == 'phone':
+            return lambda value: validate_phone_number_with_shape(value, value_format)
+        return checks[rule.check]
+
+    def check(self, column: str, value: str, results: dict = None):
+        """
+        Проверяет значение колонки и учитывает результат в счетчиках.
+
+        Args:
+            column: Имя колонки
+            value: Значение из файла (нормализуется правилом колонки)
+            results: Готовые результаты проверок строки (check_row) {(колонка, значение): результат}
+
+        Returns:
+            Результат функции проверки колонки (bool или кортеж (bool, значение или сообщение))
+        """
+        check, normalize, _, _ = self.columns[column]
+        if normalize is not None:
+            value = normalize(value)
+        result = _MISSING if results is None else results.get((column, value), _MISSING)
+        if result is _MISSING:
+            result = check(value)
+        self.checked[column] += 1
+        if not (result[0] if isinstance(result, tuple) else result):
+            self.failed[column] += 1
+        return result
+
+    def check_row(self, row: dict) -> dict:
+        """
+        Проверяет все колонки схемы в строке файла, не изменяя счетчики.
+
+        Returns:
+            Словарь {(колонка, значение): результат}. Если проверка завершилась исключением,
+            результата нет - проверка повторяется при вызове check
+        """
+        results = {}
+        for column, (check, normalize, separator, check_empty) in self.columns.items():
+            raw_value = row.get(column, '')
+            for value in (raw_value.split(separator) if separator else (raw_value,)):
+                if normalize is not None:
+                    value = normalize(value)
+                if not check_empty and not value.strip():
+                    continue
+                try:
+                    results[(column, value)] = check(value)
+                except Exception:
+                    pass
+        return results
+
+    def log_summary(self):
+        """Записывает в лог счетчики проверок по колонкам схемы."""
+        logger.info(f'Результаты проверки значений (схема {self.schema.name}):')
+        for column, rule in self.schema.rules.items():
+            if self.checked[column]:
+                logger.info(f'  {column} ({rule.check}): проверено {self.checked[column]}, не прошли проверку {self.failed[column]}')
+
+
+# Схема файла пользователей (USERS_FILE): проверки, не зависящие от данных организации
+USERS_FILE_SCHEMA = FileSchema('users', [
+    ColumnRule('first_name', 'name'),
+    ColumnRule('last_name', 'name'),
+    ColumnRule('middle_name', 'name'),
+    ColumnRule('password', 'password'),
+    ColumnRule('birthday', 'date'),
+    ColumnRule('work_phone', 'phone'),
+    ColumnRule('mobile_phone', 'phone'),
+    ColumnRule('personal_email', 'email'),
+    ColumnRule('aliases', 'alias', normalize=normalize_alias, separator=','),
+])
+
+# Схема файла общих ящиков (SHARED_MAILBOXES_FILE)
+SHARED_MAILBOXES_FILE_SCHEMA = FileSchema('shared_mailboxes', [
+    ColumnRule('email', 'shared_email', check_empty=True),
+    ColumnRule('name', 'required', check_empty=True),
+])
+
+FILE_SCHEMAS = {schema.name: schema for schema in (USERS_FILE_SCHEMA, SHARED_MAILBOXES_FILE_SCHEMA)}
+
+
+def precheck_file_rows(schema_name: str, rows: list, password_pattern: str, column_formats: dict = None) -> list:
+    """
+    Проверяет строки файла по схеме FILE_SCHEMAS[schema_name] (SchemaValidator.check_row).
+    Вызывается в отдельном процессе (iter_prechecked_users_file_rows), поэтому использует только свои аргументы.
+
+    Returns:
+        Список результатов check_row в порядке строк
+    """
+    validator = FILE_SCHEMAS[schema_name].compile(password_pattern, column_formats)
+    return [validator.check_row(element) for element in rows]
+
+
+class RowChecks:
+    """
+    Проверки значений одной строки файла в add_users_from_file_phase_1 и update_users_from_file_phase_1.
+    Если значение уже проверено в процессе проверки строк (precheck_file_rows), используется готовый результат,
+    иначе проверка выполняется сразу; в обоих случаях результат учитывается в счетчиках схемы.
+
+    Args:
+        validator: Скомпилированная схема файла
+        results: Готовые результаты проверок строки {(колонка, значение): результат}
+    """
+
+    __slots__ = ('validator', 'results')
+
+    def __init__(self, validator: SchemaValidator, results: dict = None):
+        self.validator = validator
+        self.results = results
+
+    def check(self, column: str, value: str):
+        return self.validator.check(column, value, self.results)
+
+
+def iter_prechecked_users_file_rows(settings: "SettingParams", validator: SchemaValidator, users_file: UsersCsvFile, rows_count: int, skip_row=None):
+    """
+    Возвращает строки файла пользователей вместе с проверками их значений по схеме (RowChecks).
+    Для строк, которые не нужно проверять (skip_row(строка) == True, см. RowFingerprints), вместо проверок возвращается None.
+
+    Если VALIDATION_PROCESSES больше 1 и в файле не меньше PARALLEL_VALIDATION_MIN_ROWS строк, проверки схемы
+    выполняются в пуле процессов пачками по PARALLEL_VALIDATION_CHUNK_SIZE строк. Строки возвращаются
+    в порядке файла; одновременно в обработке не больше двух пачек на процесс, поэтому файл по-прежнему
+    не загружается в память целиком. Проверки, которым нужны данные организации (конфликты логинов,
+    подразделения), выполняет вызывающая функция.
+    """
+    rows = users_file.iter_rows(log_skipped=True)
+    workers = settings.validation_processes
+    if workers <= 1 or rows_count < PARALLEL_VALIDATION_MIN_ROWS:
+        for element in rows:
+            yield element, None if skip_row and skip_row(element) else RowChecks(validator)
+        return
+
+    logger.info(f'Параллельная проверка строк файла: {workers} процессов.')
+    schema_name = validator.schema.name
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+
+        def submit_chunk(chunk):
+            # Пропускаемые строки остаются в пачке (для порядка), но не проверяются
+            checked_rows = [element for element, skipped in chunk if not skipped]
+            pending.append((chunk, executor.submit(precheck_file_rows, schema_name, checked_rows, validator.password_pattern, validator.column_formats)))
+
+        def next_chunk_rows():
+            chunk, future = pending.popleft()
+            results = iter(future.result())
+            for element, skipped in chunk:
+                yield element, None if skipped else RowChecks(validator, next(results))
+
+        chunk = []
+        for element in rows:
+            chunk.append((element, bool(skip_row and skip_row(element))))
+            if len(chunk) == PARALLEL_VALIDATION_CHUNK_SIZE:
+                submit_chunk(chunk)
+                chunk = []
+                if len(pending) >= 2 * workers:
+                    yield from next_chunk_rows()
+        if chunk:
+            submit_chunk(chunk)
+        while pending:
+            yield from next_chunk_rows()
+
+class RowFingerprints:
+    """
+    Отпечатки строк файла пользователей, обработанных в прошлых запусках (ROW_FINGERPRINTS_FILE).
+
+    Для строки хранится хеш ее содержимого и хеш состояния целевых объектов в Y360 после обработки:
+    для обновления - пользователь, которого обновляет строка; для анализа файла на создание -
+    пользователи с совпадающим логином и подразделение строки. При повторном запуске строка,
+    у которой не изменились ни содержимое, ни целевое состояние, пропускается: она не проверяется
+    и не передается на обновление (update_users_from_file_phase_2). Строки со сменой пароля
+    (update_password = true) не пропускаются и не записываются.
+
+    Раздел mode перезаписывается после каждого запуска и содержит только строки последнего файла.
+
+    Args:
+        settings: Объект настроек приложения
+        mode: 'update' (обновление из файла) или 'analyze' (анализ файла для создания пользователей)
+    """
+
+    def __init__(self, settings: "SettingParams", mode: str):
+        self.settings = settings
+        self.mode = mode
+        self.file_name = settings.row_fingerprints_file
+        # Настройки, от которых зависит результат проверки строки, входят в ключ каждой строки (row_key)
+        self.validation_digest = hashlib.blake2b(digest_size=16)
+        self.validation_digest.update(f'{settings.password_pattern}\x1f{CLEAR_FIELD_VALUE}\x1f{settings.auto_generate_password}\x1e'.encode('utf-8'))
+        self.previous = self._load().get(mode) or {}
+        # Строки текущего запуска: пропущенные и успешно обработанные
+        self.current = {}
+        self.skipped_count = 0
+
+    def _load(self) -> dict:
+        if not os.path.exists(self.file_name):
+            return {}
+        try:
+            with open(self.file_name, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Не удалось прочитать файл отпечатков строк {self.file_name}: {e}")
+            return {}
+        if data.get('schema_version') != ROW_FINGERPRINTS_SCHEMA_VERSION or str(data.get('org_id')) != str(self.settings.org_id):
+            logger.debug(f"Файл отпечатков строк {self.file_name} создан другой версией скрипта или для другой организации. Файл не используется.")
+            return {}
+        return data
+
+    def row_key(self, element: dict) -> str:
+        """
+        Хеш содержимого строки файла (UsersCsvFile.iter_rows) и настроек проверки строк.
+
+        Пароль в хеш не входит (файл отпечатков не должен позволять подбирать пароли) - вместо него
+        учитывается результат его проверки. При изменении PASSWORD_PATTERN, CLEAR_FIELD_VALUE или
+        AUTO_GENERATE_PASSWORD ключи всех строк меняются, и строки проверяются заново.
+        """
+        digest = self.validation_digest.copy()
+        for header, value in element.items():
+            if header == 'password':
+                if not value.strip():
+                    value = 'empty'
+                else:
+                    value = 'valid' if validate_password_pattern(self.settings.password_pattern, value)[0] else 'invalid'
+            digest.update(f'{header}\x1f{value}\x1e'.encode('utf-8'))
+        return digest.hexdigest()
+
+    @staticmethod
+    def state_hash(state) -> str:
+        """Хеш состояния целевых объектов строки в Y360 (target_state)."""
+        data = json.dumps(state, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.blake2b(data.encode('utf-8'), digest_size=16).hexdigest()
+
+    def target_state(self, element: dict):
+        """Возвращает объекты Y360, от которых зависит результат обработки строки (по текущему кэшу пользователей)."""
+        index = get_directory_index(self.settings)
+        login = element.get('login', '').lower().split('@')[0].strip()
+        if self.mode == 'update':
+            user_id = element.get('id', '').strip()
+            if user_id.isdigit() and int(user_id) > 0:
+                return index.find_by_id(user_id)
+            return (index.find_by_nickname(login) or index.find_by_alias(login)) if login else None
+        department = element.get('department', '')
+        return {
+            'conflicts': index.find_login_conflicts(login) if login else [],
+            'department': get_department_tree(self.settings).find_by_id(int(department)) if department.isdigit() else None,
+        }
+
+    def is_unchanged(self, element: dict) -> bool:
+        """Проверяет, что строка и ее целевое состояние не изменились с прошлого запуска. Такая строка переносится в текущий запуск."""
+        if not self.previous or element.get('update_password', '').lower() == 'true':
+            return False
+        key = self.row_key(element)
+        recorded = self.previous.get(key)
+        if recorded is None or recorded != self.state_hash(self.target_state(element)):
+            return False
+        self.current[key] = recorded
+        self.skipped_count += 1
+        return True
+
+    def record(self, key: str, state):
+        """Записывает строку key, успешно обработанную в этом запуске, с состоянием целевых объектов после обработки."""
+        self.current[key] = self.state_hash(state)
+
+    def log_skipped(self):
+        if self.skipped_count:
+            logger.info(f'Пропущено строк без изменений с прошлого запуска: {self.skipped_count} (файл отпечатков {self.file_name}).')
+
+    def save(self):
+        """
+        Сохраняет отпечатки строк текущего запуска в разделе mode файла ROW_FINGERPRINTS_FILE.
+        Запись атомарная (как в save_snapshot_cache).
+        """
+        data = self._load()
+        data['schema_version'] = ROW_FINGERPRINTS_SCHEMA_VERSION
+        data['org_id'] = str(self.settings.org_id)
+        data[self.mode] = self.current
+        file_dir = os.path.dirname(os.path.abspath(self.file_name))
+        tmp_name = None
+        try:
+            with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=file_dir, suffix='.tmp', delete=False) as f:
+                tmp_name = f.name
+                json.dump(data, f)
+            os.replace(tmp_name, self.file_name)
+            logger.debug(f"Отпечатки строк ({self.mode}, {len(self.current)} строк) сохранены в {self.file_name}")
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить файл отпечатков строк {self.file_name}: {e}")
+            if tmp_name and os.path.exists(tmp_name):
+                os.remove(tmp_name)
+
+
+def get_row_fingerprints(settings: "SettingParams", mode: str):
+    """Возвращает отпечатки строк для режима mode или None, если ROW_FINGERPRINTS_FILE не задан."""
+    if not settings.row_fingerprints_file:
+        return None
+    return RowFingerprints(settings, mode)
+
+def add_users_from_file_phase_1(settings: "SettingParams", analyze_only=False):
+    logger.info("-" * 100)
+    logger.info(f'Чтение пользователей из файла {settings.users_file} и проверка корректности данных.')
+    logger.info("-" * 100)
+    users_file, rows_count = open_users_file(settings)
+    if users_file is None:
         return False, []
 
     correct_lines = []
-    error_lines = []
+    error_rows_count = 0
+    # Для предупреждения о подозрительных строках достаточно логина и ФИО
     suspiciose_lines = []
-    error_lines = []
     stop_adding = False
     line_number = 0
 
     logger.info("-" *100)
     logger.info('Проверка корректности данных.')
     logger.info("-" *100)
-    api_deps_hierarchy = generate_deps_hierarchy_from_api(settings)
     # заполнение кэша пользователей API 360 
     users = get_all_api360_users(settings, force=True)
+    # Проверка выполняется по актуальным данным организации, а не по снимку справочника
+    wait_for_snapshot_refresh()
+    deps_tree = get_department_tree(settings, force=True)
 
     if not analyze_only:
-        check_aliases_uniqueness_result, check_aliases_uniqueness_errors = check_aliases_uniqueness(data, mode="add")
+        check_aliases_uniqueness_result, check_aliases_uniqueness_errors = check_aliases_uniqueness(settings, users_file, mode="add")
     else:
-        check_aliases_uniqueness_result, check_aliases_uniqueness_errors = check_aliases_uniqueness(data, mode="modify")
+        check_aliases_uniqueness_result, check_aliases_uniqueness_errors = check_aliases_uniqueness(settings, users_file, mode="modify")
     if not check_aliases_uniqueness_result:
         logger.error('Некоторые алиасы не уникальны. Обновление отменено.')
         return False, []
 
-    for element in data:
+    # Повторный анализ пропускает строки, которые не изменились с прошлого запуска
+    fingerprints = get_row_fingerprints(settings, 'analyze') if analyze_only else None
+    skip_row = fingerprints.is_unchanged if fingerprints is not None else None
+    validator = USERS_FILE_SCHEMA.compile(settings.password_pattern, USERS_FILE_SCHEMA.infer_formats(users_file))
+    for element, row_checks in iter_prechecked_users_file_rows(settings, validator, users_file, rows_count, skip_row):
         entry = {}
         correct = True
         stop_adding = False
         line_number += 1
+        if row_checks is None:
+            continue
         logger.debug(f'Обработка строки #{line_number} {mask_sensitive_data(element)}')
         try:
             temp_login = element["login"].lower()
@@ -197,7 +805,7 @@ def add_users_from_file_phase_1(settings: "SettingParams", analyze_only=False):
 
             temp_first_name = element.get("first_name","")
             if temp_first_name:
-                if not validate_name(temp_first_name):
+                if not row_checks.check('first_name', temp_first_name):
                     correct = False
                     logger.warning(f'Строка #{line_number}. Возможный некорректное Имя пользвоателя _"{temp_first_name}"_')
                 entry["first"] = temp_first_name
@@ -207,7 +815,7 @@ def add_users_from_file_phase_1(settings: "SettingParams", analyze_only=False):
 
             temp_last_name = element.get("last_name","")
             if temp_last_name:
-                if not validate_name(temp_last_name):
+                if not row_checks.check('last_name', temp_last_name):
                     correct = False
                     logger.warning(f'Строка #{line_number}. Возможная некорректная фамилия пользвоателя _"{temp_last_name}"_')
                 entry["last"] = temp_last_name
@@ -217,7 +825,7 @@ def add_users_from_file_phase_1(settings: "SettingParams", analyze_only=False):
 
             temp_middle_name = element.get("middle_name","")
             if temp_middle_name:
-                if not validate_name(temp_middle_name):
+                if not row_checks.check('middle_name', temp_middle_name):
                     correct = False
                     logger.warning(f'Строка #{line_number}. Возможная некорректное отчество пользвоателя _"{temp_middle_name}"_')
             entry["middle"] = temp_middle_name
@@ -225,7 +833,7 @@ def add_users_from_file_phase_1(settings: "SettingParams", analyze_only=False):
             temp_password = element.get("password","")
             if temp_password:
                 # Проверяем пароль с помощью регулярного выражения
-                password_valid, password_message = validate_password(settings, temp_password)
+                password_valid, password_message = row_checks.check('password', temp_password)
                 if not password_valid:
                     #stop_adding = True
                     logger.error(f'Строка #{line_number}. Возможно слабый пароль, который не может быть установлен: {password_message}')
@@ -264,7 +872,7 @@ def add_users_from_file_phase_1(settings: "SettingParams", analyze_only=False):
 
             temp_birthday = element.get("birthday","")
             if temp_birthday:
-                check_date, date_value = is_valid_date(temp_birthday)
+                check_date, date_value = row_checks.check('birthday', temp_birthday)
                 if not check_date:
                     stop_adding = True
                     logger.error(f'Строка #{line_number}. Некорректная дата рождения _"{temp_birthday}"_ ({date_value}). Отмена добавления пользователя.')
@@ -292,7 +900,10 @@ def add_users_from_file_phase_1(settings: "SettingParams", analyze_only=False):
             temp_aliases = element.get("aliases", "").split(",")
             if temp_aliases:
                 for alias in temp_aliases:
-                    if not validate_alias(settings, alias.split("@")[0].lower().strip()):
+                    if not alias.strip():
+                        continue
+                    alias_ok, _ = row_checks.check('aliases', alias)
+                    if not alias_ok:
                         stop_adding = True
                         logger.error(f'Строка #{line_number}. Некорректный алиас _"{alias}"_. Отмена добавления пользователя.')
                 entry["aliases"] = temp_aliases
@@ -304,17 +915,14 @@ def add_users_from_file_phase_1(settings: "SettingParams", analyze_only=False):
                 entry["department"] = element.get("department","")
                 if entry["department"].isdigit():
                     if int(entry["department"]) > 1:
-                        for dep in api_deps_hierarchy:
-                            if dep['id'] == int(entry["department"]):
-                                found_dep = True
-                                break
+                        found_dep = deps_tree.find_by_id(int(entry["department"])) is not None
                         if not found_dep:
                             stop_adding = True
                             logger.error(f'Строка #{line_number}. Подразделение с номером {entry["department"]} не найдено в организации. Отмена добавления пользователя.')
 
             temp_work_phone = element.get("work_phone","")
             if temp_work_phone:
-                check_phone, phone_value = validate_phone_number(temp_work_phone)
+                check_phone, phone_value = row_checks.check('work_phone', temp_work_phone)
                 if not check_phone:
                     stop_adding = True
                     logger.error(f'Строка #{line_number}. Некорректный рабочий телефон _"{temp_work_phone}"_. Отмена добавления пользователя.')
@@ -323,7 +931,7 @@ def add_users_from_file_phase_1(settings: "SettingParams", analyze_only=False):
 
             temp_mobile_phone = element.get("mobile_phone","")
             if temp_mobile_phone:
-                check_phone, phone_value = validate_phone_number(temp_mobile_phone)
+                check_phone, phone_value = row_checks.check('mobile_phone', temp_mobile_phone)
                 if not check_phone:
                     stop_adding = True
                     logger.error(f'Строка #{line_number}. Некорректный мобильный телефон _"{temp_mobile_phone}"_. Отмена добавления пользователя.')
@@ -332,7 +940,7 @@ def add_users_from_file_phase_1(settings: "SettingParams", analyze_only=False):
 
             temp_personal_email = element.get("personal_email","")
             if temp_personal_email:
-                check_email, email_value = validate_email(temp_personal_email)
+                check_email, email_value = row_checks.check('personal_email', temp_personal_email)
                 if not check_email:
                     stop_adding = True
                     logger.error(f'Строка #{line_number}. Некорректный личный email _"{temp_personal_email}"_. Отмена добавления пользователя.')
@@ -340,30 +948,34 @@ def add_users_from_file_phase_1(settings: "SettingParams", analyze_only=False):
                     entry["personal_email"] = temp_personal_email
 
             if stop_adding:
-                if element not in error_lines:
-                    error_lines.append(element)
+                error_rows_count += 1
+                logger.error(f'Строка #{line_number}. Bad line: {mask_sensitive_data(element)}')
             else:
                 correct_lines.append(entry)
+                if fingerprints is not None and correct:
+                    fingerprints.record(fingerprints.row_key(element), fingerprints.target_state(element))
 
             if not correct:
-                suspiciose_lines.append(element)
+                suspiciose_lines.append((element["login"], element["first_name"], element["last_name"], element["middle_name"]))
 
         except Exception as e:
             logger.error(f"{type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
-            error_lines.append(element)
+            error_rows_count += 1
+            logger.error(f'Строка #{line_number}. Bad line: {mask_sensitive_data(element)}')
 
         logger.debug("." * 100)
 
     logger.info('Конец проверки корректности данных.')
+    validator.log_summary()
+    if fingerprints is not None:
+        fingerprints.log_skipped()
+        fingerprints.save()
     logger.info("\n")
 
-    if len(error_lines) > 0:
+    if error_rows_count > 0:
         logger.error('!' * 100)
-        logger.error('Некорректные строки в файле. Исправьте их и попробуйте снова.')
+        logger.error(f'Некорректные строки в файле: {error_rows_count} из {rows_count} (см. Bad line выше). Исправьте их и попробуйте снова.')
         logger.error('!' * 100)
-        for element in error_lines:
-            logger.error(f'Bad line: {mask_sensitive_data(element)}')
-            logger.error("." * 100)
         logger.error('Выход.')
         logger.error('\n')
         return False, []
@@ -372,8 +984,8 @@ def add_users_from_file_phase_1(settings: "SettingParams", analyze_only=False):
         logger.warning('*' * 100)
         logger.warning(f'В файле есть {len(suspiciose_lines)} некорректных строк. Проверьте кириллические буквы или неподдерживаемые символы в этих полях: login, first_name, last_name, middle_name')
         logger.warning('*' * 100)
-        for element in suspiciose_lines:
-            logger.warning(f'login: {element["login"]}; first_name: {element["first_name"]}; last_name: {element["last_name"]}; middle_name: {element["middle_name"]}')
+        for login, first_name, last_name, middle_name in suspiciose_lines:
+            logger.warning(f'login: {login}; first_name: {first_name}; last_name: {last_name}; middle_name: {middle_name}')
             logger.warning("." * 100)
         logger.warning('\n')
         if not analyze_only:
@@ -382,7 +994,7 @@ def add_users_from_file_phase_1(settings: "SettingParams", analyze_only=False):
                 return False, []
     
     if analyze_only:
-        if len(suspiciose_lines) == 0 and len(error_lines) == 0:
+        if len(suspiciose_lines) == 0 and error_rows_count == 0:
             logger.info('*' * 100)
             logger.info('Все строки корректны.')
             logger.info('*' * 100)
@@ -390,6 +1002,98 @@ def add_users_from_file_phase_1(settings: "SettingParams", analyze_only=False):
     
     return True, correct_lines
     
+def build_api_user_from_row(u: dict) -> dict:
+    """Формирует тело запроса на создание пользователя в API 360 из проверенной строки файла."""
+    user = {}
+    user["name"] = {
+        "first": u.get('first'),
+        "last": u.get('last'),
+        "middle": u.get('middle')
+    }
+    user["nickname"] = u.get('login')
+    user["password"] = u.get('password')
+    user["passwordChangeRequired"] = u.get('password_change_required')
+    user["position"] = u.get('position')
+    user["language"] = u.get('language')
+    user["gender"] = u.get('gender')
+    user["birthday"] = u.get('birthday')
+    if u.get('is_admin'):
+        user["isAdmin"] = u.get('is_admin')
+    if u.get('is_enabled'):
+        user["isEnabled"] = u.get('is_enabled')
+    user["contacts"] = []
+    if u.get('work_phone',''):
+        user["contacts"].append({
+            "type": "phone",
+            "value": u.get('work_phone'),
+            'label': 'Work'
+        })
+    if u.get('mobile_phone',''):
+        user["contacts"].append({
+            "type": "phone",
+            "value": u.get('mobile_phone'),
+            'label': 'Mobile'
+        })
+    
+    if u.get('personal_email',''):
+        user["about"] = json.dumps({"personal_email": u.get('personal_email')})
+
+    if u["department"].isdigit():
+        user["departmentId"] = u['department']
+    else:
+        user["departmentId"] = 1
+    return user
+
+def create_user_from_row(settings: "SettingParams", u: dict, row_prefix: str = ""):
+    """
+    Создаёт одного пользователя из проверенной строки файла: сам пользователь,
+    его алиасы и приветственное письмо.
+
+    Args:
+        settings: Настройки скрипта
+        u: Проверенные данные пользователя из файла
+        row_prefix: Префикс для сообщений лога (номер строки при параллельной обработке)
+
+    Returns:
+        dict: Данные добавленного пользователя или None, если создать пользователя не удалось
+    """
+    _log_context.row_prefix = row_prefix
+    try:
+        user = build_api_user_from_row(u)
+        result, created_user = create_user_by_api(settings, user)
+        if not result:
+            return None
+        user["id"] = created_user["id"]
+        temp_dict = {
+            "id": user["id"],
+            "department": u['department'],
+            "isAdmin": u['is_admin'],
+            "login": u['login']
+        }
+        if len(u.get('aliases', [])) > 0:
+            for alias in u.get('aliases', []):
+                if alias:
+                    create_user_alias_by_api(settings, user_id=user["id"], alias=alias.split("@")[0].lower().strip())
+        
+        # Отправка приветственного письма
+        if settings.send_welcome_email:
+            # Добавляем данные для email шаблона
+            email_data = {
+                'first': u.get('first'),
+                'middle': u.get('middle'),
+                'last': u.get('last'),
+                'login': u.get('login'),
+                'password': u.get('password'),
+                'password_change_required': u.get('password_change_required'),
+                'position': u.get('position'),
+                'department_name': u.get('department').split(DEPS_SEPARATOR)[-1] if not u.get('department', '').isdigit() else '',
+                'personal_email': u.get('personal_email')
+            }
+            send_welcome_email(settings, email_data)
+        return temp_dict
+    finally:
+        _log_context.row_prefix = ""
+
 def add_users_from_file_phase_2(settings: "SettingParams", users: list):
     logger.info("-" * 100)
     if len(users) == 0:
@@ -397,82 +1101,26 @@ def add_users_from_file_phase_2(settings: "SettingParams", users: list):
         return
     logger.info(f'Добавление {len(users)} пользователей в Y360.')
     logger.info("-" * 100)
-    user = {}
     added_users = []
-    for u in users:
-        user["name"] = {
-            "first": u.get('first'),
-            "last": u.get('last'),
-            "middle": u.get('middle')
-        }
-        user["nickname"] = u.get('login')
-        user["password"] = u.get('password')
-        user["passwordChangeRequired"] = u.get('password_change_required')
-        user["position"] = u.get('position')
-        user["language"] = u.get('language')
-        user["gender"] = u.get('gender')
-        user["birthday"] = u.get('birthday')
-        if u.get('is_admin'):
-            user["isAdmin"] = u.get('is_admin')
-        if u.get('is_enabled'):
-            user["isEnabled"] = u.get('is_enabled')
-        user["contacts"] = []
-        if u.get('work_phone',''):
-            user["contacts"].append({
-                "type": "phone",
-                "value": u.get('work_phone'),
-                'label': 'Work'
-            })
-        if u.get('mobile_phone',''):
-            user["contacts"].append({
-                "type": "phone",
-                "value": u.get('mobile_phone'),
-                'label': 'Mobile'
-            })
-        
-        if u.get('personal_email',''):
-            user["about"] = json.dumps({"personal_email": u.get('personal_email')})
-
-        if u["department"].isdigit():
-            user["departmentId"] = u['department']
-        else:
-            user["departmentId"] = 1
-
-        if settings.dry_run:
-            logger.info(f"Пробный запуск. Пользователь {user['nickname']} ({user['name']['last']} {user['name']['first']}) не будет добавлен.")
-            #return False, []
-        else:
-            result, created_user = create_user_by_api(settings, user)
-            if result:
-                user["id"] = created_user["id"]
-                temp_dict = {
-                    "id": user["id"],
-                    "department": u['department'],
-                    "isAdmin": u['is_admin'],
-                    "login": u['login']
-                }
-                added_users.append(temp_dict)
-                if len(u.get('aliases', [])) > 0:
-                    for alias in u.get('aliases', []):
-                        if alias:
-                            create_user_alias_by_api(settings, user_id=user["id"], alias=alias.split("@")[0].lower().strip())
-                
-                # Отправка приветственного письма
-                if settings.send_welcome_email:
-                    # Добавляем данные для email шаблона
-                    email_data = {
-                        'first': u.get('first'),
-                        'middle': u.get('middle'),
-                        'last': u.get('last'),
-                        'login': u.get('login'),
-                        'password': u.get('password'),
-                        'password_change_required': u.get('password_change_required'),
-                        'position': u.get('position'),
-                        'department_name': u.get('department').split(DEPS_SEPARATOR)[-1] if not u.get('department', '').isdigit() else '',
-                        'personal_email': u.get('personal_email')
-                    }
-                    send_welcome_email(settings, email_data)
+    if settings.dry_run:
+        for u in users:
+            logger.info(f"Пробный запуск. Пользователь {u.get('login')} ({u.get('last')} {u.get('first')}) не будет добавлен.")
+        return True, added_users
+
+    workers = min(settings.max_parallel_requests, len(users))
+    if workers > 1:
+        logger.info(f'Параллельное добавление пользователей: {workers} потоков.')
+        total = len(users)
+        width = len(str(total))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # map возвращает результаты в порядке исходного списка, поэтому порядок added_users совпадает с порядком строк в файле
+            results = list(executor.map(
+                lambda item: create_user_from_row(settings, item[1], f"[{item[0]:>{width}}/{total}]"),
+                enumerate(users, start=1)))
+    else:
+        results = [create_user_from_row(settings, u) for u in users]
 
+    added_users = [r for r in results if r is not None]
     return True,added_users
 
 def add_users_from_file_phase_3(settings: "SettingParams", users: list):
@@ -488,7 +1136,7 @@ def add_users_from_file_phase_3(settings: "SettingParams", users: list):
             patch_user_by_api(settings, user_id=user["existing_user"]["id"], patch_data={"isAdmin": "true"})
 
     logger.info('Работа с подразделениями пользователей.')
-    api_deps_hierarchy = generate_deps_hierarchy_from_api(settings)
+    deps_tree = get_department_tree(settings)
     deps_to_add = []
     users_without_deps = []
     count = 1
@@ -499,12 +1147,11 @@ def add_users_from_file_phase_3(settings: "SettingParams", users: list):
         user['department'] = user_dep
         found_flag = False
         if not user_dep.isdigit():
-            for dep in api_deps_hierarchy:
-                if dep['path'] == user_dep:
-                    found_flag = True
-                    patch_data={"departmentId": dep['id']}
-                    patch_user_by_api(settings, user_id=user["id"], patch_data=patch_data)
-                    break
+            dep = deps_tree.find_by_path(user_dep)
+            if dep:
+                found_flag = True
+                patch_data={"departmentId": dep['id']}
+                patch_user_by_api(settings, user_id=user["id"], patch_data=patch_data)
             if not found_flag:
                 temp_dict = {
                     "id": count,
@@ -522,17 +1169,16 @@ def add_users_from_file_phase_3(settings: "SettingParams", users: list):
         
         create_dep_from_prepared_list(settings, final_list,max_levels)
 
-    api_deps_hierarchy = generate_deps_hierarchy_from_api(settings)
+    deps_tree = get_department_tree(settings)
     #time.sleep(1)
     for user in users_without_deps:
-        for dep in api_deps_hierarchy:
-            if dep['path'] == user['department']:
-                patch_data={"departmentId": dep['id']}
-                # Если пользователь передан через функцию обновления, то используем поле user_id из словаря "пользователь", иначе используем поле id из словаря "пользоатель"
-                user_id_from_update_func = user.get('user_id',None)
-                user_id = user.get('id',user_id_from_update_func)
-                patch_user_by_api(settings, user_id=user_id, patch_data=patch_data)
-                break
+        dep = deps_tree.find_by_path(user['department'])
+        if dep:
+            patch_data={"departmentId": dep['id']}
+            # Если пользователь передан через функцию обновления, то используем поле user_id из словаря "пользователь", иначе используем поле id из словаря "пользоатель"
+            user_id_from_update_func = user.get('user_id',None)
+            user_id = user.get('id',user_id_from_update_func)
+            patch_user_by_api(settings, user_id=user_id, patch_data=patch_data)
 
     logger.info("-" * 100)
     logger.info('Добавление пользователей в подразделения завершено.')
@@ -553,91 +1199,53 @@ def add_users_from_file(settings: "SettingParams", analyze_only=False):
     data = add_users_from_file_phase_3(settings, data)
     return True, data
 
-def update_users_from_file_phase_1(settings: "SettingParams"):
+def update_users_from_file_phase_1(settings: "SettingParams", fingerprints: RowFingerprints = None):
     """
-    Фаза 1: Чтение и валидация данных из файла для обновления пользователей
+    Фаза 1: Чтение и валидация данных из файла для обновления пользователей.
+    Строки, не изменившиеся с прошлого запуска (fingerprints), пропускаются.
     """
     logger.info("-" * 100)
     logger.info(f'Чтение пользователей из файла {settings.users_file} и проверка корректности данных для обновления.')
     logger.info("-" * 100)
-    users_file_name = settings.users_file
-    if not os.path.exists(users_file_name):
-        full_path = os.path.join(os.path.dirname(__file__), users_file_name)
-        if not os.path.exists(full_path):
-            logger.error(f'Ошибка! Файл {users_file_name} не существует!')
-            return False, []
-        else:
-            users_file_name = full_path
-    
-    headers = []
-    data = []
-    try:
-        logger.info("-" *100)
-        logger.info(f'Чтение файла {users_file_name}')
-        logger.info("-" *100)
-        bad_header = False
-        with open(users_file_name, 'r', encoding='utf-8') as csvfile:
-            headers = csvfile.readline().replace('"', '').split(";")
-            for header in headers:
-                if header.strip() not in USERS_CSV_REQUIRED_HEADERS:
-                    logger.error(f'Ошибка! Заголовок {header} не соответствует требуемым: {";".join(USERS_CSV_REQUIRED_HEADERS)}')
-                    bad_header = True
-            if bad_header:
-                return False, []
-            logger.debug(f'Headers: {headers}')
-            for line in csvfile:
-                if line.startswith('#'):
-                    logger.debug(f'Строка начинается с "#". Пропуск строки из файла - {mask_csv_line_safe(line)}')
-                    continue
-                
-                logger.debug(f'Чтение строки из файла - {mask_csv_line_safe(line)}')
-                fields = line.split(";")
-                if len(fields) != len(headers):
-                    logger.error(f'Ошибка! Строка {mask_csv_line_safe(line)} - количество полей не соответствует количеству заголовков в первой строке файла. Возможно, в значении какого-либо поля есть точка с запятой. Попробуйте заменить её на другой символ.')
-                    return False, []
-                entry = {}
-                for i,value in enumerate(fields):
-                    value = remove_quotes_if_wrapped(value)
-                    if value.strip() == CLEAR_FIELD_VALUE:
-                        entry[headers[i].strip()] = ' '
-                    else:
-                        entry[headers[i].strip()] = value.strip()
-                data.append(entry)
-        logger.info(f'Конец чтения файла {users_file_name}')
-        logger.info("\n")
-    except Exception as e:
-        logger.error(f"{type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
+    users_file, rows_count = open_users_file(settings, clear_value=CLEAR_FIELD_VALUE)
+    if users_file is None:
         return False, []
 
     correct_lines = []
-    error_lines = []
+    error_rows_count = 0
     line_number = 0
 
     logger.info("-" *100)
     logger.info('Проверка корректности данных для обновления.')
     logger.info("-" *100)
-    api_deps_hierarchy = generate_deps_hierarchy_from_api(settings)
     # заполнение кэша пользователей API 360 
-    users = get_all_api360_users(settings, force=True)
-
-    check_aliases_uniqueness_result, check_aliases_uniqueness_errors = check_aliases_uniqueness(data, mode="update")
+    get_all_api360_users(settings, force=True)
+    # Проверка выполняется по актуальным данным организации, а не по снимку справочника
+    wait_for_snapshot_refresh()
+    deps_tree = get_department_tree(settings, force=True)
+    # Поиск пользователя строки по ID - по индексу, а не перебором всех пользователей
+    index = get_directory_index(settings)
+
+    check_aliases_uniqueness_result, check_aliases_uniqueness_errors = check_aliases_uniqueness(settings, users_file, mode="update")
     if not check_aliases_uniqueness_result:
         logger.error('Некоторые алиасы не уникальны. Обновление отменено.')
         return False, []
 
-    for element in data:
+    skip_row = fingerprints.is_unchanged if fingerprints is not None else None
+    validator = USERS_FILE_SCHEMA.compile(settings.password_pattern, USERS_FILE_SCHEMA.infer_formats(users_file))
+    for element, row_checks in iter_prechecked_users_file_rows(settings, validator, users_file, rows_count, skip_row):
         entry = {}
         stop_updating = False
         user_id = 0
         line_number += 1
+        if row_checks is None:
+            continue
         logger.debug(f'Обработка строки #{line_number} {mask_sensitive_data(element)}')
         
         try:
             temp_user_id = element.get("id", "0")
             if not all(c.isdigit() for c in temp_user_id):
                 logger.error(f'Строка #{line_number}. Некорректный ID пользователя _"{temp_user_id}"_. Должно быть число или пустая строка. Пропуск строки.')
-                if element not in error_lines:
-                    error_lines.append(element)
                 stop_updating = True
 
             else:
@@ -645,20 +1253,15 @@ def update_users_from_file_phase_1(settings: "SettingParams"):
                 if temp_user_id > 0:
                     if not temp_user_id >= 1130000000000000:
                         logger.error(f'Строка #{line_number}. Некорректный ID пользователя _"{temp_user_id}"_. Должно быть число >= 1130000000000000. Пропуск строки.')
-                        if element not in error_lines:
-                            error_lines.append(element)
                         stop_updating = True
                     else:
-                        for user in users:
-                            if user['id'] == str(temp_user_id):
-                                entry["user_id"] = user["id"]
-                                user_id = int(user["id"])
-                                entry["existing_user"] = user
-                                break
-                        if user_id == 0:
+                        user = index.find_by_id(temp_user_id)
+                        if user:
+                            entry["user_id"] = user["id"]
+                            user_id = int(user["id"])
+                            entry["existing_user"] = user
+                        else:
                             logger.error(f'Строка #{line_number}. Пользователь с ID _"{temp_user_id}"_ не найден в системе. Обновление отменено.')
-                            if element not in error_lines:
-                                error_lines.append(element)
                             stop_updating = True
 
             # Логин (обязательное поле для поиска пользователя если нет ID пользователя)
@@ -673,8 +1276,6 @@ def update_users_from_file_phase_1(settings: "SettingParams"):
                 found, existing_user = find_user_by_login(settings, temp_login)
                 if not found:
                     logger.error(f'Строка #{line_number}. Пользователь с логином "{temp_login}" не найден в системе. Обновление отменено.')
-                    if element not in error_lines:
-                        error_lines.append(element)
                     stop_updating = True
                 else:
                     entry["login"] = temp_login
@@ -684,39 +1285,35 @@ def update_users_from_file_phase_1(settings: "SettingParams"):
                     logger.info(f'Строка #{line_number}. Найден пользователь: {existing_user["nickname"]} (ID: {existing_user["id"]})')
             else:
                 logger.error(f'Строка #{line_number}. Логин и ID пользователя пусты. Отмена обновления пользователя.')
-                if element not in error_lines:
-                    error_lines.append(element)
                 stop_updating = True
 
             if stop_updating:
+                error_rows_count += 1
+                logger.error(f'Строка #{line_number}. Bad line: {mask_sensitive_data(element)}')
                 continue
 
             # Имя
             entry["first"] = element.get("first_name",'')
             if entry["first"] and entry["first"].strip():
-                if not validate_name(entry["first"]):
+                if not row_checks.check('first_name', entry["first"]):
                     logger.warning(f'Строка #{line_number}. Возможное некорректное имя пользователя _"{entry["first"]}"_')
             elif entry["first"] and not entry["first"].strip():
                 logger.error(f'Строка #{line_number}. Очистить параметр first нельзя. Нужно указать имя.')
-                if element not in error_lines:
-                    error_lines.append(element)
-                    stop_updating = True
+                stop_updating = True
             # Если пустое - не обновляем
 
             # Фамилия
             entry["last"] = element.get("last_name",'')
             if entry["last"] and entry["last"].strip():
-                if not validate_name(entry["last"]):
+                if not row_checks.check('last_name', entry["last"]):
                     logger.warning(f'Строка #{line_number}. Возможная некорректная фамилия пользователя _"{entry["last"]}"_')
             elif entry["last"] and not entry["last"].strip():
                 logger.error(f'Строка #{line_number}. Очистить параметр last нельзя. Нужно указать фамилию.')
-                if element not in error_lines:
-                    error_lines.append(element)
-                    stop_updating = True
+                stop_updating = True
             # Отчество
             entry["middle"] = element.get("middle_name",'')
             if entry["middle"] and entry["middle"].strip():
-                if not validate_name(entry["middle"]):
+                if not row_checks.check('middle_name', entry["middle"]):
                     logger.warning(f'Строка #{line_number}. Возможное некорректное отчество пользователя _"{entry["middle"]}"_')
 
             # Обработка пароля
@@ -725,8 +1322,6 @@ def update_users_from_file_phase_1(settings: "SettingParams"):
             
             if password_change_required not in ['true', 'false', '']:
                 logger.error(f'Строка #{line_number}. Некорректный параметр password_change_required _"{password_change_required}"_. Должно быть true, false или пусто.')
-                if element not in error_lines:
-                    error_lines.append(element)
                 stop_updating = True
             
             entry["update_password"] = element.get("update_password",'false').lower()
@@ -744,16 +1339,12 @@ def update_users_from_file_phase_1(settings: "SettingParams"):
                         entry["password_was_generated"] = True
                     else:
                         logger.error(f'Строка #{line_number}. Требуется изменение пароля, но пароль не указан и автогенерация отключена.')
-                        if element not in error_lines:
-                            error_lines.append(element)
                         stop_updating = True
                 elif temp_password:
                     # Если пароль указан, проверяем его
-                    password_valid, password_message = validate_password(settings, temp_password)
+                    password_valid, password_message = row_checks.check('password', temp_password)
                     if not password_valid:
                         logger.error(f'Строка #{line_number}. Некорректный пароль: {password_message}')
-                        if element not in error_lines:
-                            error_lines.append(element)
                         stop_updating = True
                     else:
                         entry["password"] = temp_password
@@ -763,8 +1354,6 @@ def update_users_from_file_phase_1(settings: "SettingParams"):
                     entry["password_change_required"] = password_change_required
                 else:
                     logger.error(f'Строка #{line_number}. Требуется изменение пароля, но не указан параметр password_change_required.')
-                    if element not in error_lines:
-                        error_lines.append(element)
                     stop_updating = True
             else:
                 if temp_password:
@@ -775,13 +1364,9 @@ def update_users_from_file_phase_1(settings: "SettingParams"):
             if entry["language"] and entry["language"].strip():
                 if entry["language"] not in ['ru', 'en']:
                     logger.error(f'Строка #{line_number}. Некорректный язык _"{entry["language"]}"_. Должно быть ru или en.')
-                    if element not in error_lines:
-                        error_lines.append(element)
                     stop_updating = True
             elif entry["language"] and not entry["language"].strip():
                 logger.error(f'Строка #{line_number}. Очистить параметр language после создания пользователя нельзя. Нужно указать ru или en.') 
-                if element not in error_lines:
-                    error_lines.append(element)
                 stop_updating = True
 
             # Пол
@@ -789,18 +1374,14 @@ def update_users_from_file_phase_1(settings: "SettingParams"):
             if entry["gender"] and entry["gender"].strip():
                 if entry["gender"] not in ['male', 'female']:
                     logger.error(f'Строка #{line_number}. Некорректный пол _"{entry["gender"]}"_. Должно быть male или female.')
-                    if element not in error_lines:
-                        error_lines.append(element)
                     stop_updating = True
 
             # Дата рождения
             entry["birthday"] = element.get("birthday",'')
             if entry["birthday"] and entry["birthday"].strip():
-                check_date, date_value = is_valid_date(entry["birthday"])
+                check_date, date_value = row_checks.check('birthday', entry["birthday"])
                 if not check_date:
                     logger.error(f'Строка #{line_number}. Некорректная дата рождения _"{entry["birthday"]}"_ ({date_value}).')
-                    if element not in error_lines:
-                        error_lines.append(element)
                     stop_updating = True
                 else:
                     entry["birthday"] = date_value.strftime('%Y-%m-%d')
@@ -812,8 +1393,6 @@ def update_users_from_file_phase_1(settings: "SettingParams"):
             if entry["is_enabled"] and entry["is_enabled"].strip():
                 if entry["is_enabled"] not in ['true', 'false']:
                     logger.error(f'Строка #{line_number}. Некорректный параметр is_enabled _"{entry["is_enabled"]}"_. Должно быть true или false.')
-                    if element not in error_lines:
-                        error_lines.append(element)
                     stop_updating = True
             elif entry["is_enabled"] and not entry["is_enabled"].strip():
                 logger.error(f'Строка #{line_number}. Очистить параметр is_enabled нельзя. Нужно указать true или false.')
@@ -822,8 +1401,6 @@ def update_users_from_file_phase_1(settings: "SettingParams"):
             if entry["is_admin"] and entry["is_admin"].strip():
                 if entry["is_admin"] not in ['true', 'false']:
                     logger.error(f'Строка #{line_number}. Некорректный параметр is_admin _"{entry["is_admin"]}"_. Должно быть true или false.')
-                    if element not in error_lines:
-                        error_lines.append(element)
                     stop_updating = True
             elif entry["is_admin"] and not entry["is_admin"].strip():
                 logger.error(f'Строка #{line_number}. Очистить параметр is_admin нельзя. Нужно указать true или false.')
@@ -835,14 +1412,15 @@ def update_users_from_file_phase_1(settings: "SettingParams"):
             if temp_aliases and temp_aliases.strip():
                 bad_aliases = False
                 for alias in temp_aliases.split(","):
-                    if not validate_alias(settings, alias.split("@")[0].lower().strip()):
+                    if not alias.strip():
+                        continue
+                    alias_ok, _ = row_checks.check('aliases', alias)
+                    if not alias_ok:
                         bad_aliases = True
                         logger.error(f'Строка #{line_number}. Некорректный алиас _"{alias}"_. Отмена добавления пользователя.')
                     else:
-                        entry["aliases"].append(alias.split("@")[0].lower().strip())
+                        entry["aliases"].append(normalize_alias(alias))
                 if bad_aliases:
-                    if element not in error_lines:
-                        error_lines.append(element)
                     stop_updating = True
 
             # Подразделение
@@ -850,26 +1428,18 @@ def update_users_from_file_phase_1(settings: "SettingParams"):
             if entry["department"] and entry["department"].strip():
                 if entry["department"].isdigit():
                     if int(entry["department"]) > 1:
-                        found_dep = False
-                        for dep in api_deps_hierarchy:
-                            if dep['id'] == int(entry["department"]):
-                                found_dep = True
-                                break
+                        found_dep = deps_tree.find_by_id(int(entry["department"])) is not None
                         if not found_dep:
                             logger.error(f'Строка #{line_number}. Подразделение с номером {entry["department"]} не найдено в организации.')
-                            if element not in error_lines:
-                                error_lines.append(element)
                             stop_updating = True
 
 
             # Рабочий телефон
             entry["work_phone"] = element.get("work_phone",'')
             if entry["work_phone"] and entry["work_phone"].strip():
-                check_phone, phone_value = validate_phone_number(entry["work_phone"])
+                check_phone, phone_value = row_checks.check('work_phone', entry["work_phone"])
                 if not check_phone:
                     logger.error(f'Строка #{line_number}. Некорректный рабочий телефон _"{entry["work_phone"]}"_.')
-                    if element not in error_lines:
-                        error_lines.append(element)
                     stop_updating = True
                 else:
                     entry["work_phone"] = phone_value
@@ -877,11 +1447,9 @@ def update_users_from_file_phase_1(settings: "SettingParams"):
             # Мобильный телефон
             entry["mobile_phone"] = element.get("mobile_phone",'')
             if entry["mobile_phone"] and entry["mobile_phone"].strip():
-                check_phone, phone_value = validate_phone_number(entry["mobile_phone"])
+                check_phone, phone_value = row_checks.check('mobile_phone', entry["mobile_phone"])
                 if not check_phone:
                     logger.error(f'Строка #{line_number}. Некорректный мобильный телефон _"{entry["mobile_phone"]}"_.')
-                    if element not in error_lines:
-                        error_lines.append(element)
                     stop_updating = True
                 else:
                     entry["mobile_phone"] = phone_value
@@ -889,55 +1457,64 @@ def update_users_from_file_phase_1(settings: "SettingParams"):
             # Личный email
             entry["personal_email"] = element.get("personal_email",'')
             if entry["personal_email"] and entry["personal_email"].strip():
-                check_email, email_value = validate_email(entry["personal_email"])
+                check_email, email_value = row_checks.check('personal_email', entry["personal_email"])
                 if not check_email:
                     logger.error(f'Строка #{line_number}. Некорректный личный email _"{entry["personal_email"]}"_.')
-                    if element not in error_lines:
-                        error_lines.append(element)
                     stop_updating = True
 
-            if not stop_updating:
+            if stop_updating:
+                error_rows_count += 1
+                logger.error(f'Строка #{line_number}. Bad line: {mask_sensitive_data(element)}')
+            else:
+                if fingerprints is not None and entry["update_password"] != 'true':
+                    entry["row_key"] = fingerprints.row_key(element)
                 correct_lines.append(entry)
 
         except Exception as e:
             logger.error(f"{type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
-            if element not in error_lines:
-                error_lines.append(element)
+            error_rows_count += 1
+            logger.error(f'Строка #{line_number}. Bad line: {mask_sensitive_data(element)}')
 
         logger.debug("." * 100)
 
     logger.info('Конец проверки корректности данных.')
+    validator.log_summary()
+    if fingerprints is not None:
+        fingerprints.log_skipped()
     logger.info("\n")
 
-    if len(error_lines) > 0:
+    if error_rows_count > 0:
         logger.error('!' * 100)
-        logger.error('Некорректные строки в файле. Исправьте их и попробуйте снова.')
+        logger.error(f'Некорректные строки в файле: {error_rows_count} из {rows_count} (см. Bad line выше). Исправьте их и попробуйте снова.')
         logger.error('!' * 100)
-        for element in error_lines:
-            logger.error(f'Bad line: {mask_sensitive_data(element)}')
-            logger.error("." * 100)
         logger.error('Выход.')
         logger.error('\n')
         return False, []
     
     return True, correct_lines
 
-def update_users_from_file_phase_2(settings: "SettingParams", users: list):
+def update_users_from_file_phase_2(settings: "SettingParams", users: list, fingerprints: RowFingerprints = None):
     """
-    Фаза 2: Обновление пользователей в Yandex 360
+    Фаза 2: Обновление пользователей в Yandex 360.
+    Если передан fingerprints, успешно обработанные строки записываются в него вместе с состоянием
+    пользователей после обновления (см. record_updated_rows).
     """
     logger.info("-" * 100)
     if len(users) == 0:
         logger.info('Нет пользователей для обновления.')
+        if fingerprints is not None and not settings.dry_run:
+            fingerprints.save()
         return True, []
     logger.info(f'Обновление {len(users)} пользователей в Y360.')
     logger.info("-" * 100)
     
     updated_users = []
+    # Строки, обработанные без ошибок (для fingerprints)
+    synced_users = []
     users_with_new_deps = []
     # Часть атрибутов, нельзя изменить, если пользователь заблокирован в 360. Для них будем записывать в этот список и потом обновлять отдельным процессом 
     
-    api_deps_hierarchy = generate_deps_hierarchy_from_api(settings)
+    deps_tree = get_department_tree(settings)
     
     for u in users:
         try:
@@ -946,6 +1523,7 @@ def update_users_from_file_phase_2(settings: "SettingParams", users: list):
             changes = {}
             changes_for_disabled_users = {}
             password_changed = False
+            row_failed = False
             
             logger.info(f"Обработка пользователя: {u.get('login')} (ID: {user_id})")
             
@@ -1127,11 +1705,10 @@ def update_users_from_file_phase_2(settings: "SettingParams", users: list):
                     # Ищем подразделение по пути
                     strip_list = [x.strip() for x in u['department'].split(DEPS_SEPARATOR)]
                     user_dep = DEPS_SEPARATOR.join(strip_list)
-                    for dep in api_deps_hierarchy:
-                        if dep['path'] == user_dep:
-                            dep_id = dep['id']
-                            found_deps = True
-                            break
+                    dep = deps_tree.find_by_path(user_dep)
+                    if dep:
+                        dep_id = dep['id']
+                        found_deps = True
                 if not found_deps:
                     logger.error(f"Подразделение {u['department']} для пользователя {u.get('login')} (UID - {user_id}) не найдено в иерархии подразделений. Запрос на создание нового подразделения.")
                 
@@ -1157,6 +1734,7 @@ def update_users_from_file_phase_2(settings: "SettingParams", users: list):
                             logger.info(f"Успех - пользователь {u.get('login')} обновлен.")
                             updated_users.append(u)
                         else:
+                            row_failed = True
                             logger.error(f"Ошибка при обновлении пользователя {u.get('login')}")
                     if u['raw_aliases'] and u['raw_aliases'].strip():
                         # Обработка алиасов
@@ -1172,14 +1750,20 @@ def update_users_from_file_phase_2(settings: "SettingParams", users: list):
                                 remove_aliases.append(alias.split("@")[0].lower().strip())
                         if add_aliases:
                             for alias in add_aliases:
-                                create_user_alias_by_api(settings, existing_user["id"], alias)
+                                success, _ = create_user_alias_by_api(settings, existing_user["id"], alias)
+                                if not success:
+                                    row_failed = True
                         if remove_aliases:
                             for alias in remove_aliases:
-                                delete_user_alias_by_api(settings, existing_user["id"], alias)
+                                success, _ = delete_user_alias_by_api(settings, existing_user["id"], alias)
+                                if not success:
+                                    row_failed = True
                     elif u['raw_aliases'] and not u['raw_aliases'].strip():
                         old_aliases = existing_user.get('aliases', [])
                         for alias in old_aliases:
-                            delete_user_alias_by_api(settings, existing_user["id"], alias)
+                            success, _ = delete_user_alias_by_api(settings, existing_user["id"], alias)
+                            if not success:
+                                row_failed = True
 
                     if changes_for_disabled_users:
                         logger.info(f"Изменение данных пользователя, требующих разблокировки: {changes_for_disabled_users}")
@@ -1189,12 +1773,16 @@ def update_users_from_file_phase_2(settings: "SettingParams", users: list):
                             logger.info(f"Установка новых параметров для пользователя {u.get('login')} (UID - {user_id})")
                             result = patch_user_by_api(settings, user_id=user_id, patch_data=changes_for_disabled_users)
                             if not result:
+                                row_failed = True
                                 logger.error(f"Ошибка при обновлении пользователя {u.get('login')} (UID - {user_id})")
                             logger.info(f"Блокировка пользователя {u.get('login')} (UID - {user_id})")
                             result = patch_user_by_api(settings, user_id=user_id, patch_data={"isEnabled":"false"})
                             if not result:
+                                row_failed = True
                                 logger.error(f"!!! Пользователь {u.get('login')} (UID - {user_id}) не был снова заблокирован.")
                             updated_users.append(u)
+                        else:
+                            row_failed = True
 
                     # Если пароль был изменен - отправляем письмо
                     if password_changed:
@@ -1227,6 +1815,10 @@ def update_users_from_file_phase_2(settings: "SettingParams", users: list):
                     #logger.info(f"Нет изменений для пользователя {u.get('login')}")
                 else:
                     logger.info(f"Пользователь {u.get('login')} имеет новые подразделения. Запрос на создание новых подразделений отложен до завершения обновления всех пользователей.")
+
+            # Строки с новыми подразделениями обрабатываются в фазе 3 и будут проверены при следующем запуске
+            if u.get('row_key') and not row_failed and not (users_with_new_deps and users_with_new_deps[-1] is u):
+                synced_users.append(u)
         
         except Exception as e:
             logger.error(f"{type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
@@ -1235,12 +1827,28 @@ def update_users_from_file_phase_2(settings: "SettingParams", users: list):
     if users_with_new_deps:
         logger.info(f"Есть запрос на добавление новых подразделений для {len(users_with_new_deps)} пользователей. Выполняем.")
         add_users_from_file_phase_3(settings, users_with_new_deps)
+
+    if fingerprints is not None and not settings.dry_run:
+        record_updated_rows(settings, fingerprints, synced_users)
     
     logger.info("-" * 100)
     logger.info(f'Обновление пользователей завершено. Обновлено: {len(updated_users)}')
     logger.info("-" * 100)
     return True, updated_users
 
+def record_updated_rows(settings: "SettingParams", fingerprints: RowFingerprints, synced_users: list):
+    """
+    Записывает строки, успешно обработанные в update_users_from_file_phase_2, в fingerprints
+    вместе с состоянием пользователей после обновления и сохраняет файл отпечатков.
+    Список пользователей для этого загружается из API заново.
+    """
+    if synced_users:
+        get_all_api360_users(settings, force=True)
+        index = get_directory_index(settings)
+        for u in synced_users:
+            fingerprints.record(u['row_key'], index.find_by_id(u['user_id']))
+    fingerprints.save()
+
 def update_users_from_file(settings: "SettingParams"):
     """
     Основная функция для обновления пользователей из файла
@@ -1281,11 +1889,12 @@ def update_users_from_file(settings: "SettingParams"):
     settings.users_file = user_input
     
     try:
-        result, data = update_users_from_file_phase_1(settings)
+        fingerprints = get_row_fingerprints(settings, 'update')
+        result, data = update_users_from_file_phase_1(settings, fingerprints)
         if not result:
             return False, []
         
-        result, data = update_users_from_file_phase_2(settings, data)
+        result, data = update_users_from_file_phase_2(settings, data, fingerprints)
         return result, data
     finally:
         # Восстанавливаем оригинальное значение
@@ -1293,56 +1902,47 @@ def update_users_from_file(settings: "SettingParams"):
 
 # Регулярное выражение для проверки фамилии
 def validate_name(line):
-    pattern = r'^[А-ЯЁ][а-яё]+(-[А-ЯЁ][а-яё]+)?$'
-    if re.match(pattern, line):
+    if NAME_RE.match(line):
         return True
     return False
 
 def validate_login(settings: "SettingParams", alias: str):
     alias = alias.lower()
 
-    users = get_all_api360_users(settings)
     first_iteration = True
     while True:
-        no_conflicts = True
-        conflicts = []
-        for user in users:
-            if alias == user['nickname'].lower():
-                conflicts.append(user)
-                no_conflicts = False
-                
-            aliases = [a.lower() for a in user['aliases']]
-            if alias in aliases:
-                if user not in conflicts:
-                    conflicts.append(user)
-                no_conflicts = False
-                
-            for contact in user['contacts']:
-                if contact['type'] == 'email' and contact['value'].split('@')[0].lower() == alias:
-                    if user not in conflicts:
-                        conflicts.append(user)
-                    no_conflicts = False
+        conflicts = get_directory_index(settings).find_login_conflicts(alias)
+        no_conflicts = not conflicts
 
         if not no_conflicts and first_iteration:
-            users = get_all_api360_users(settings, force=True)
+            get_all_api360_users(settings, force=True)
             first_iteration = False
         else:
             break
 
     if no_conflicts:
-        pattern = r'^[a-z0-9.-]+$'
-        if not re.match(pattern, alias):
+        if not LOGIN_RE.match(alias):
             return False, []
         if alias.startswith('_'):
             return False, []
     
     return no_conflicts, conflicts
 
-def is_valid_date(date_string, min_years_diff=10, max_years_diff=100):
+def match_date_format(date_string: str):
+    """Возвращает первый формат из DATE_FORMATS, которым разбирается строка, или None."""
+    for date_format in DATE_FORMATS:
+        try:
+            datetime.strptime(date_string, date_format)
+            return date_format
+        except ValueError:
+            continue
+    return None
+
+def is_valid_date(date_string, min_years_diff=10, max_years_diff=100, date_formats=None):
     """
     Проверяет, можно ли преобразовать строку в дату.
     
-    Поддерживает несколько распространенных форматов даты:
+    Поддерживает несколько распространенных форматов даты (DATE_FORMATS):
     - DD.MM.YYYY
     - DD/MM/YYYY
     - DD-MM-YYYY
@@ -1351,6 +1951,8 @@ def is_valid_date(date_string, min_years_diff=10, max_years_diff=100):
     
     Args:
         date_string (str): Строка для проверки
+        date_formats (tuple): Форматы в порядке проверки (по умолчанию DATE_FORMATS,
+            при импорте файла первым идет преобладающий формат колонки - см. FileSchema.infer_formats)
         
     Returns:
         bool: True если строка может быть преобразована в дату, иначе False
@@ -1360,21 +1962,9 @@ def is_valid_date(date_string, min_years_diff=10, max_years_diff=100):
     if not date_string or not isinstance(date_string, str):
         return False, None
     
-    # Набор возможных форматов для проверки
-    date_formats = [
-        '%d.%m.%Y',  # DD.MM.YYYY
-        '%d/%m/%Y',  # DD/MM/YYYY
-        '%d-%m-%Y',  # DD-MM-YYYY
-        '%Y-%m-%d',  # YYYY-MM-DD (ISO формат)
-        '%Y/%m/%d',  # YYYY/MM/DD
-        '%m/%d/%Y',  # MM/DD/YYYY (US формат)
-        '%d.%m.%y',  # DD.MM.YY
-        '%Y.%m.%d',  # YYYY.MM.DD
-    ]
-    
     # Попытка парсинга каждым из форматов
     current_date = date.today()
-    for date_format in date_formats:
+    for date_format in date_formats or DATE_FORMATS:
         try:
             date_obj = datetime.strptime(date_string, date_format).date()
 
@@ -1393,20 +1983,14 @@ def is_valid_date(date_string, min_years_diff=10, max_years_diff=100):
             continue
     
     # Если ни один из форматов не подошел, проверяем с помощью регулярных выражений
-    # для потенциально более сложных форматов
-    date_patterns = [
-        # Месяц прописью на английском: 25 December 2021, December 25, 2021
-        r'(\d{1,2})\s+(January|February|March|April|May|June|July|August|September|October|November|December)\s+(\d{4})',
-        r'(January|February|March|April|May|June|July|August|September|October|November|December)\s+(\d{1,2}),?\s+(\d{4})',
-    ]
-    
+    # для потенциально более сложных форматов (TEXT_DATE_RES)
     month_map = {
         'January': 1, 'February': 2, 'March': 3, 'April': 4, 'May': 5, 'June': 6,
         'July': 7, 'August': 8, 'September': 9, 'October': 10, 'November': 11, 'December': 12
     }
     
-    for pattern in date_patterns:
-        match = re.search(pattern, date_string, re.IGNORECASE)
+    for pattern in TEXT_DATE_RES:
+        match = pattern.search(date_string)
         if match:
             groups = match.groups()
             try:
@@ -1490,18 +2074,29 @@ def validate_password(settings: "SettingParams", password: str) -> Tuple[bool, s
     Returns:
         tuple: (bool, str) - (результат проверки, сообщение об ошибке или "OK")
     """
+    return validate_password_pattern(settings.password_pattern, password)
+
+def validate_password_pattern(pattern: str, password: str) -> Tuple[bool, str]:
+    """
+    Проверяет пароль по регулярному выражению pattern (см. validate_password).
+    Не использует настройки, поэтому может выполняться в процессе проверки строк файла (precheck_file_rows).
+    """
     if not password:
         return False, "Пароль не может быть пустым"
     
-    pattern = settings.password_pattern
     try:
-        if re.match(pattern, password):
+        if compile_password_pattern(pattern).match(password):
             return True, "OK"
         else:
             return False, f'Пароль не соответствует требованиям безопасности. Используемый шаблон: {pattern}'
     except re.error as e:
         return False, f'Ошибка в регулярном выражении: {e}'
 
+@lru_cache(maxsize=8)
+def compile_password_pattern(pattern: str):
+    """Компилирует шаблон пароля (PASSWORD_PATTERN) один раз для каждого процесса. При ошибке в шаблоне выбрасывает re.error."""
+    return re.compile(pattern)
+
 def mask_csv_line(line: str, headers: list) -> str:
     """
     Безопасно маскирует чувствительные данные в CSV строке.
@@ -1753,18 +2348,18 @@ def find_user_by_login(settings: "SettingParams", login: str, search_in_aliases:
     if '@' in login:
         login = login.split('@')[0]
     
-    users = get_all_api360_users(settings, force=False)
+    index = get_directory_index(settings)
     
-    for user in users:
-        # Проверяем nickname
-        if user['nickname'].lower() == login:
-            logger.debug(f"Пользователь найден по nickname: {user['nickname']} (ID: {user['id']})")
-            return True, user
+    # Проверяем nickname
+    user = index.find_by_nickname(login)
+    if user:
+        logger.debug(f"Пользователь найден по nickname: {user['nickname']} (ID: {user['id']})")
+        return True, user
         
-        # Проверяем aliases
+    # Проверяем aliases
     if search_in_aliases:
-        aliases_lower = [a.lower() for a in user.get('aliases', [])]
-        if login in aliases_lower:
+        user = index.find_by_alias(login)
+        if user:
             logger.debug(f"Пользователь найден по alias: {user['nickname']} (ID: {user['id']})")
             return True, user
     
@@ -1821,20 +2416,15 @@ def mask_csv_line_safe(line: str) -> str:
     fields = line.split(";")
     masked_fields = []
     
-    # Регулярные выражения для определения типов полей
-    email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    # Пароль: минимум 8 символов, минимум одна заглавная буква, одна цифра, один спецсимвол
-    password_pattern = r'^(?=.*[A-Z])(?=.*\d)(?=.*[!@#$%^&*()_+\-=\[\]{};:"\\|,.<>\/?])[A-Za-z0-9!@#$%^&*()_+\-=\[\]{};:"\\|,.<>\/?]{8,}$'
-    
     for field in fields:
         field = field.strip()
         
         # Проверяем, является ли поле email адресом
-        if re.match(email_pattern, field):
+        if MASK_EMAIL_RE.match(field):
             # Email адреса не маскируем
             masked_fields.append(field)
         # Проверяем, является ли поле потенциальным паролем
-        elif re.match(password_pattern, field) and len(field) >= 8:
+        elif MASK_PASSWORD_RE.match(field) and len(field) >= 8:
             # Маскируем пароли
             masked_fields.append("***MASKED***")
         else:
@@ -1930,16 +2520,10 @@ def validate_email(email: str) -> Tuple[bool, str]:
     if '..' in local_part or '..' in domain:
         return False, "Email адрес не может содержать последовательные точки"
     
-    # Регулярное выражение для проверки формата email
-    email_pattern = DEFAULT_EMAIL_PATTERN
-    
-    try:
-        if re.match(email_pattern, email):
-            return True, "OK"
-        else:
-            return False, "Email адрес имеет некорректный формат"
-    except re.error as e:
-        return False, f'Ошибка в регулярном выражении: {e}'
+    # Проверка формата email (DEFAULT_EMAIL_PATTERN)
+    if EMAIL_RE.match(email):
+        return True, "OK"
+    return False, "Email адрес имеет некорректный формат"
 
 def validate_phone_number(phone):
     """
@@ -1961,8 +2545,7 @@ def validate_phone_number(phone):
     
     # Обработка добавочного номера
     extension = None
-    ext_pattern = re.compile(r'(?:ext|extension|доб|добавочный)(?:ension)?\.?\s*(\d+)', re.IGNORECASE)
-    ext_match = ext_pattern.search(phone)
+    ext_match = PHONE_EXTENSION_RE.search(phone)
     
     # Если нашли добавочный номер, сохраняем его и удаляем из основного номера для проверки
     if ext_match:
@@ -1970,7 +2553,7 @@ def validate_phone_number(phone):
         phone = phone[:ext_match.start()].strip() + phone[ext_match.end():].strip()
     
     # Проверка на допустимые символы
-    if not re.match(r'^[0-9\s\.\-\+\(\)]+$', phone):
+    if not PHONE_CHARS_RE.match(phone):
         return False, "Номер содержит недопустимые символы"
     
     # Проверка, что + только в начале номера
@@ -1994,7 +2577,7 @@ def validate_phone_number(phone):
             return False, "Неправильный порядок скобок в номере"
     
     # Очистка номера от всех символов кроме цифр для проверки длины
-    clean_number = re.sub(r'[^\d]', '', phone)
+    clean_number = NON_DIGITS_RE.sub('', phone)
     
     # Проверка длины номера (минимум 10, максимум 15 цифр)
     if len(clean_number) < 3:
@@ -2006,9 +2589,13 @@ def validate_phone_number(phone):
     # Проверка международного формата
     if phone.startswith('+'):
         # Если номер начинается с +, проверяем, что следующий символ - цифра или открывающая скобка
-        if not re.match(r'^\+(\d|\()', phone):
+        if not PHONE_INTERNATIONAL_START_RE.match(phone):
             return False, "После '+' должна следовать цифра или открывающая скобка"
     
+    return True, format_phone_number(clean_number, extension)
+
+def format_phone_number(clean_number: str, extension: str = None) -> str:
+    """Форматирует проверенный номер телефона (только цифры) и добавочный номер для записи в Y360."""
     # Форматирование номера
     formatted_number = clean_number
     
@@ -2021,11 +2608,23 @@ def validate_phone_number(phone):
     elif extension:
         formatted_number += f' доб. {extension}'
     
-    return True, formatted_number
+    return formatted_number
 
-def validate_alias(settings: "SettingParams", alias: str) -> Tuple[bool, str]:
+def validate_phone_number_with_shape(phone, shape: str):
     """
-    Проверяет корректность алиаса пользователя.
+    Проверяет номер телефона с быстрым путем для преобладающей формы номера в колонке (FileSchema.infer_formats).
+
+    Результат validate_phone_number для номера без добавочного зависит только от его формы
+    (расположения цифр и разделителей), поэтому номер той же формы, что и проверенная форма shape,
+    только очищается от разделителей и форматируется. Номера другой формы проверяются validate_phone_number.
+    """
+    if phone and phone.translate(PHONE_SHAPE_TABLE) == shape:
+        return True, format_phone_number(NON_DIGITS_RE.sub('', phone))
+    return validate_phone_number(phone)
+
+def validate_alias(settings: "SettingParams", alias: str) -> Tuple[bool, str]:
+    """
+    Проверяет корректность алиаса пользователя.
     
     Алиас должен:
     - Не быть пустым
@@ -2056,14 +2655,14 @@ def validate_alias(settings: "SettingParams", alias: str) -> Tuple[bool, str]:
         return False, "Алиас не может содержать более 50 символов"
     
     # Проверка на допустимые символы (буквы, цифры, точки, дефисы, подчеркивания)
-    if not re.match(r'^[a-zA-Z0-9._-]+$', alias):
+    if not ALIAS_CHARS_RE.match(alias):
         return False, "Алиас может содержать только буквы, цифры, точки, дефисы и подчеркивания"
     
     # Проверка на начало и конец (должны быть буквой или цифрой)
-    if not re.match(r'^[a-zA-Z0-9]', alias):
+    if not ALIAS_EDGE_CHAR_RE.match(alias[0]):
         return False, "Алиас должен начинаться с буквы или цифры"
     
-    if not re.match(r'[a-zA-Z0-9]$', alias):
+    if not ALIAS_EDGE_CHAR_RE.match(alias[-1]):
         return False, "Алиас должен заканчиваться буквой или цифрой"
     
     # Проверка на последовательные точки
@@ -2110,15 +2709,15 @@ def validate_shared_mailbox_email(settings: "SettingParams", email: str) -> Tupl
             return False, "Домен email адреса не может быть пустым"
         
         # Проверка локальной части (alias)
-        if not re.match(r'^[a-zA-Z0-9]([a-zA-Z0-9._-]*[a-zA-Z0-9])?$', local_part):
+        if not SHARED_MAILBOX_LOCAL_PART_RE.match(local_part):
             return False, "Локальная часть должна начинаться и заканчиваться буквой или цифрой, может содержать точки, дефисы и подчеркивания"
         
         # Проверка домена
-        if not re.match(r'^[a-zA-Z0-9]([a-zA-Z0-9.-]*[a-zA-Z0-9])?(\.[a-zA-Z]{2,})+$', domain):
+        if not SHARED_MAILBOX_DOMAIN_RE.match(domain):
             return False, "Домен имеет некорректный формат"
     else:
         # Если нет @, проверяем только alias
-        if not re.match(r'^[a-zA-Z0-9]([a-zA-Z0-9._-]*[a-zA-Z0-9])?$', email):
+        if not SHARED_MAILBOX_LOCAL_PART_RE.match(email):
             return False, "Алиас должен начинаться и заканчиваться буквой или цифрой, может содержать точки, дефисы и подчеркивания"
     
     return True, "OK"
@@ -2152,6 +2751,7 @@ def read_shared_mailboxes_file(settings: "SettingParams", file_path: str):
     errors = []
     emails_seen = {}
     line_number = 0
+    validator = SHARED_MAILBOXES_FILE_SCHEMA.compile()
     
     try:
         with open(file_path, 'r', encoding='utf-8') as csvfile:
@@ -2198,7 +2798,7 @@ def read_shared_mailboxes_file(settings: "SettingParams", file_path: str):
                 description = row[2].strip()
                 
                 # Проверяем email
-                is_valid, error_msg = validate_shared_mailbox_email(settings, email)
+                is_valid, error_msg = validator.check('email', email)
                 if not is_valid:
                     errors.append((line_number, f'Некорректный email "{email}": {error_msg}'))
                     continue
@@ -2209,7 +2809,7 @@ def read_shared_mailboxes_file(settings: "SettingParams", file_path: str):
                     continue
                 
                 # Проверяем обязательные поля
-                if not name:
+                if not validator.check('name', name):
                     errors.append((line_number, f'Поле "name" не может быть пустым для email "{email}"'))
                     continue
                 
@@ -2226,6 +2826,7 @@ def read_shared_mailboxes_file(settings: "SettingParams", file_path: str):
         errors.append((0, f'Ошибка при чтении файла: {e}'))
         return False, [], errors
     
+    validator.log_summary()
     if errors:
         return False, mailboxes, errors
     
@@ -2246,7 +2847,6 @@ def create_shared_mailbox_by_api(settings: "SettingParams", mailbox: dict):
         Tuple: (bool, dict) - (успех, ответ API)
     """
     url = f'{DEFAULT_360_API_URL}/admin/v1/org/{settings.org_id}/mailboxes/shared'
-    headers = {"Authorization": f"OAuth {settings.oauth_token}"}
     
     # Подготовка данных для API
     api_data = {
@@ -2267,7 +2867,6 @@ def create_shared_mailbox_by_api(settings: "SettingParams", mailbox: dict):
     logger.debug(f"PUT URL: {url}")
     logger.debug(f"PUT DATA: {api_data}")
     
-    retries = 1
     success = False
     response_data = {}
     
@@ -2277,7 +2876,7 @@ def create_shared_mailbox_by_api(settings: "SettingParams", mailbox: dict):
                 logger.info(f"[DRY RUN] Пропущено создание общего ящика '{api_data['email']}' ('{mailbox['name']}')")
                 return True, {'email': api_data['email'], 'dry_run': True}
             
-            response = requests.put(url, headers=headers, json=api_data)
+            response = settings.api_client.put(url, json=api_data)
             logger.debug(f"x-request-id: {response.headers.get('x-request-id','')}")
             
             if response.status_code == HTTPStatus.OK or response.status_code == HTTPStatus.CREATED:
@@ -2356,21 +2955,15 @@ def create_shared_mailbox_by_api(settings: "SettingParams", mailbox: dict):
                     pass
                 
                 logger.error(f"Ошибка при создании общего ящика: {response.status_code}. Сообщение: {response.text}")
-                if retries < MAX_RETRIES:
-                    logger.error(f"Повторная попытка ({retries+1}/{MAX_RETRIES})")
-                    time.sleep(RETRIES_DELAY_SEC * retries)
-                    retries += 1
-                else:
-                    logger.error(f"!!! Ошибка. Создание общего ящика '{api_data['email']}' не удалось.")
-                    response_data = {'error': response.text, 'status_code': response.status_code}
-                    break
-                    
+                logger.error(f"!!! Ошибка. Создание общего ящика '{api_data['email']}' не удалось.")
+                response_data = {'error': response.text, 'status_code': response.status_code}
+                break
+                
         except Exception as e:
             logger.error(f"{type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
             response_data = {'error': str(e)}
             break
     
-    time.sleep(SLEEP_TIME_BETWEEN_API_CALLS)
     return success, response_data
 
 
@@ -2486,6 +3079,211 @@ def import_shared_mailboxes_prompt(settings: "SettingParams"):
     
     import_shared_mailboxes_from_file(settings, file_path)
 
+class ExtendedUserResolver:
+    """
+    Вычисляет расширенные атрибуты пользователя: путь подразделения (department)
+    и список групп пользователя (full_groups). Подразделение и группы ищутся по id в словарях.
+
+    Args:
+        deps_tree: Дерево подразделений (get_department_tree)
+        groups: Список групп организации
+        share_groups: Хранить одинаковые списки групп пользователей в одном экземпляре (COMPACT_USER_RECORDS)
+    """
+
+    def __init__(self, deps_tree: "DepartmentTree", groups: list, share_groups: bool = False):
+        self.deps_tree = deps_tree
+        self.groups_by_id = {}
+        for group in groups:
+            self.groups_by_id.setdefault(group['id'], group)
+        # Списки групп по набору групп пользователя: пользователи с одинаковыми группами ссылаются на один список
+        self.shared_groups = {} if share_groups else None
+
+    def department_of(self, user) -> str:
+        department_id = user.get('departmentId')
+        if department_id == 1:
+            return 'Все сотрудники'
+        department = self.deps_tree.find_by_id(department_id)
+        return department['path'] if department else None
+
+    def groups_of(self, user) -> list:
+        user_groups = []
+        if user.get('groups'):
+            for group_id in user['groups']:
+                found_group = self.groups_by_id.get(group_id)
+                if found_group:
+                    user_groups.append(found_group)
+                else:
+                    logger.warning(f"Группа с id {group_id} не найдена в списке групп. Пользователь: {user['name']}")
+        if self.shared_groups is not None:
+            return self.shared_groups.setdefault(tuple(group['id'] for group in user_groups), user_groups)
+        return user_groups
+
+
+# Признак отсутствующего атрибута расширенного пользователя (ExtendedUser)
+_MISSING = object()
+
+
+class ExtendedUser(MutableMapping):
+    """
+    Пользователь из расширенного списка (get_extended_api360_users).
+
+    Представление словаря пользователя из кэша (user): атрибуты пользователя не копируются,
+    а читаются из словаря кэша. В слотах хранятся только атрибуты department и full_groups,
+    которые вычисляются при первом обращении к ним (или к пользователю целиком: перебор ключей,
+    выгрузка в файл). Пока к ним не обращались, расширение пользователя ничего не стоит,
+    поэтому поиск и вывод платят только за реально просмотренных пользователей.
+
+    Поддерживает интерфейс словаря (user['nickname'], user.get(...), items() и т.д.). Атрибуты,
+    заданные или удаленные для расширенного пользователя, хранятся в дополнительном словаре
+    и не изменяют пользователя в кэше.
+    """
+
+    LAZY_FIELDS = ('department', 'full_groups')
+    __slots__ = ('user', 'department', 'full_groups', '_resolver', '_extra')
+
+    def __init__(self, user: dict, resolver: ExtendedUserResolver):
+        self.user = user
+        self.department = _MISSING
+        self.full_groups = _MISSING
+        self._resolver = resolver
+        # Измененные атрибуты пользователя (_MISSING - атрибут удален)
+        self._extra = None
+
+    def _materialize(self):
+        resolver = self._resolver
+        if resolver is not None:
+            self._resolver = None
+            if self.department is _MISSING:
+                self.department = resolver.department_of(self.user)
+            if self.full_groups is _MISSING:
+                self.full_groups = resolver.groups_of(self.user)
+
+    def __getitem__(self, key):
+        if key in self.LAZY_FIELDS:
+            if self._resolver is not None:
+                self._materialize()
+            value = getattr(self, key)
+        elif self._extra is not None and key in self._extra:
+            value = self._extra[key]
+        else:
+            return self.user[key]
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        if key in self.LAZY_FIELDS:
+            return self._resolver is not None or getattr(self, key) is not _MISSING
+        if self._extra is not None and key in self._extra:
+            return self._extra[key] is not _MISSING
+        return key in self.user
+
+    def __setitem__(self, key, value):
+        if key in self.LAZY_FIELDS:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self.LAZY_FIELDS:
+            # Удаленный атрибут не вычисляется заново
+            self._materialize()
+            setattr(self, key, _MISSING)
+        elif key in self.user:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = _MISSING
+        else:
+            del self._extra[key]
+
+    def __iter__(self):
+        extra = self._extra or {}
+        for key in self.user:
+            if extra.get(key) is not _MISSING:
+                yield key
+        for key in self.LAZY_FIELDS:
+            if key in self:
+                yield key
+        for key, value in extra.items():
+            if value is not _MISSING and key not in self.user:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(self.copy())
+
+    def __reduce__(self):
+        # Копия (copy.deepcopy, pickle) - обычный словарь со всеми атрибутами
+        return (dict, (self.copy(),))
+
+    def copy(self):
+        return dict(self.items())
+
+
+# Типы объектов пользователя со словарным интерфейсом (обычный словарь или ExtendedUser)
+USER_MAPPING_TYPES = (dict, ExtendedUser)
+
+# Строковые атрибуты пользователя с повторяющимися значениями, которые хранятся в одном экземпляре (intern_user_strings)
+INTERNED_USER_FIELDS = ('gender', 'position', 'timezone', 'language')
+INTERNED_USER_NAME_FIELDS = ('first', 'last', 'middle')
+
+
+def intern_user_strings(users: list):
+    """
+    Заменяет повторяющиеся строки (пол, должность, часовой пояс, язык, части ФИО) в пользователях
+    из API одним экземпляром строки (sys.intern). Значения не меняются, сокращается только
+    расход памяти: у тысяч пользователей одинаковые должности и имена.
+    """
+    for user in users:
+        for field in INTERNED_USER_FIELDS:
+            value = user.get(field)
+            if value.__class__ is str:
+                user[field] = sys.intern(value)
+        name = user.get('name')
+        if name.__class__ is dict:
+            for field in INTERNED_USER_NAME_FIELDS:
+                value = name.get(field)
+                if value.__class__ is str:
+                    name[field] = sys.intern(value)
+
+
+def bump_snapshot_version(settings: "SettingParams"):
+    """
+    Увеличивает версию данных организации в памяти (settings.snapshot_version).
+    Вызывается при каждом обновлении кэша пользователей, подразделений и групп и после
+    каждого изменения данных через API (в том числе из параллельных потоков): результаты
+    поиска прежней версии (QueryResultCache) больше не используются. Расширенный список
+    пользователей и построенные по нему структуры не сбрасываются - они перестраиваются,
+    когда заменяется сам кэш (replace_directory_section).
+    """
+    with _snapshot_version_lock:
+        settings.snapshot_version += 1
+
+def replace_directory_section(settings: "SettingParams", kind: str, items: list):
+    """
+    Заменяет раздел справочника ('users', 'departments' или 'groups') в памяти. Вызывается под _directory_load_lock.
+    Расширенный список пользователей строится из пользователей, подразделений и групп - он и его колоночный
+    снимок сбрасываются и строятся заново при следующем обращении к get_extended_api360_users.
+    """
+    items_attr, timestamp_attr = SNAPSHOT_CACHE_SETTINGS_ATTRS[kind]
+    setattr(settings, items_attr, items)
+    setattr(settings, timestamp_attr, datetime.now())
+    settings.extended_users = []
+    settings.user_columns = None
+    bump_snapshot_version(settings)
+
 def get_extended_api360_users(settings: "SettingParams", force = False):
     if not force:
         logger.info("Получение расширенного списка всех пользователей организации из кэша...")
@@ -2493,22 +3291,15 @@ def get_extended_api360_users(settings: "SettingParams", force = False):
     if not settings.extended_users or force or (datetime.now() - settings.extended_users_get_timestamp).total_seconds() > EXTENDED_USERS_REFRESH_IN_MINUTES * 60:
         #logger.info("Получение всех пользователей организации из API...")
         users = get_all_api360_users(settings, force)
-        deps = generate_deps_hierarchy_from_api(settings, force)
-        deps.append({'id': 1, 'path': 'Все сотрудники'})
+        deps_tree = get_department_tree(settings, force)
         groups = get_all_api360_groups(settings, force)
-        for user in users:
-            user['department'] = next((d['path'] for d in deps if d['id'] == user['departmentId']), None)
-            user_groups = []
-            if user.get('groups'):
-                for group_id in user['groups']:
-                    found_group = next((g for g in groups if g['id'] == group_id), None)
-                    if found_group:
-                        user_groups.append(found_group)  
-                    else:
-                        logger.warning(f"Группа с id {group_id} не найдена в списке групп. Пользователь: {user['name']}")
-            user['full_groups'] = user_groups
-        settings.extended_users = users
+        # Подразделение и группы каждого пользователя вычисляются при первом обращении (см. ExtendedUser).
+        # Пользователи из кэша не изменяются: расширенный список состоит из представлений пользователей кэша
+        resolver = ExtendedUserResolver(deps_tree, groups, share_groups=settings.compact_user_records)
+        bump_snapshot_version(settings)
+        settings.extended_users = [ExtendedUser(user, resolver) for user in users]
         settings.extended_users_get_timestamp = datetime.now()
+        settings.user_columns = UserColumns(settings.extended_users)
 
     return settings.extended_users
 
@@ -2518,57 +3309,441 @@ def get_all_api360_users(settings: "SettingParams", force = False):
 
     if not settings.all_users or force or (datetime.now() - settings.all_users_get_timestamp).total_seconds() > ALL_USERS_REFRESH_IN_MINUTES * 60:
         #logger.info("Получение всех пользователей организации из API...")
-        settings.all_users = get_all_api360_users_from_api(settings)
-        settings.all_users_get_timestamp = datetime.now()
+        if force or settings.all_users or not warm_from_snapshot_cache(settings, 'users', get_all_api360_users_from_api):
+            store_directory_section(settings, 'users', get_all_api360_users_from_api(settings))
+        elif settings.compact_user_records:
+            # Пользователи загружены из снимка справочника
+            intern_user_strings(settings.all_users)
     return settings.all_users
 
+def load_snapshot_cache(settings: "SettingParams") -> dict:
+    """
+    Читает снимок справочника организации из файла SNAPSHOT_CACHE_FILE.
+
+    Returns:
+        dict: Содержимое снимка или пустой словарь, если кэш отключён, файла нет,
+        он повреждён, относится к другой организации или имеет другую версию формата
+    """
+    if not settings.snapshot_cache_file or not os.path.exists(settings.snapshot_cache_file):
+        return {}
+    try:
+        with open(settings.snapshot_cache_file, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Не удалось прочитать снимок справочника {settings.snapshot_cache_file}: {e}")
+        return {}
+    if snapshot.get('schema_version') != SNAPSHOT_CACHE_SCHEMA_VERSION or str(snapshot.get('org_id')) != str(settings.org_id):
+        logger.debug(f"Снимок справочника {settings.snapshot_cache_file} создан другой версией скрипта или для другой организации. Снимок не используется.")
+        return {}
+    return snapshot
+
+def save_snapshot_cache(settings: "SettingParams", kind: str, items: list):
+    """
+    Сохраняет раздел снимка справочника ('users', 'departments' или 'groups') в файл SNAPSHOT_CACHE_FILE.
+
+    Запись атомарная: снимок пишется во временный файл в том же каталоге и затем
+    заменяет старый файл, поэтому прерванный запуск не оставляет повреждённый снимок.
+    Пустые списки (результат ошибки загрузки из API) не сохраняются.
+    """
+    if not settings.snapshot_cache_file or not items:
+        return
+    with _snapshot_cache_lock:
+        snapshot = load_snapshot_cache(settings)
+        snapshot['schema_version'] = SNAPSHOT_CACHE_SCHEMA_VERSION
+        snapshot['org_id'] = str(settings.org_id)
+        snapshot[kind] = {'saved_at': datetime.now().isoformat(), 'items': items}
+        cache_dir = os.path.dirname(os.path.abspath(settings.snapshot_cache_file))
+        tmp_name = None
+        try:
+            with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=cache_dir, suffix='.tmp', delete=False) as f:
+                tmp_name = f.name
+                json.dump(snapshot, f, ensure_ascii=False)
+            os.replace(tmp_name, settings.snapshot_cache_file)
+            logger.debug(f"Снимок справочника ({kind}, {len(items)} записей) сохранён в {settings.snapshot_cache_file}")
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить снимок справочника {settings.snapshot_cache_file}: {e}")
+            if tmp_name and os.path.exists(tmp_name):
+                os.remove(tmp_name)
+
+def warm_from_snapshot_cache(settings: "SettingParams", kind: str, fetch_func) -> bool:
+    """
+    Заполняет кэш в памяти данными из снимка справочника на диске и запускает
+    фоновое обновление этих данных из API.
+
+    Args:
+        settings: Настройки скрипта
+        kind: Раздел снимка - 'users', 'departments' или 'groups'
+        fetch_func: Функция загрузки раздела из API (например, get_all_api360_users_from_api)
+
+    Returns:
+        bool: True, если кэш заполнен из снимка, False - если снимка нет или он устарел
+    """
+    section = load_snapshot_cache(settings).get(kind)
+    if not section or not section.get('items'):
+        return False
+    try:
+        saved_at = datetime.fromisoformat(section['saved_at'])
+    except (KeyError, TypeError, ValueError):
+        return False
+    age_minutes = (datetime.now() - saved_at).total_seconds() / 60
+    if age_minutes > settings.snapshot_cache_ttl_minutes:
+        logger.debug(f"Снимок справочника ({kind}) устарел ({age_minutes:.0f} мин.). Загрузка из API.")
+        return False
+
+    with _directory_load_lock:
+        replace_directory_section(settings, kind, section['items'])
+        _directory_load_generations[kind] += 1
+        generation = _directory_load_generations[kind]
+    logger.info(f"Данные ({kind}) загружены из снимка {settings.snapshot_cache_file} от {saved_at.strftime('%Y-%m-%d %H:%M:%S')}. Обновление из API выполняется в фоне.")
+
+    def refresh():
+        items = fetch_func(settings)
+        if not items:
+            return
+        if store_directory_section(settings, kind, items, generation):
+            logger.debug(f"Фоновое обновление данных ({kind}) из API завершено.")
+        else:
+            logger.debug(f"Фоновое обновление данных ({kind}) из API отброшено: данные уже загружены заново.")
+
+    thread = threading.Thread(target=refresh, name=f"snapshot-refresh-{kind}", daemon=True)
+    _snapshot_refresh_threads[kind] = thread
+    thread.start()
+    return True
+
+def store_directory_section(settings: "SettingParams", kind: str, items: list, generation: int = None) -> bool:
+    """
+    Заменяет раздел справочника ('users', 'departments' или 'groups') в памяти загруженными из API данными
+    и сохраняет его в снимок на диске. Замена выполняется под блокировкой, чтобы фоновое обновление
+    и загрузка в основном потоке не перезаписывали данные друг друга.
+
+    Args:
+        settings: Настройки скрипта
+        kind: Раздел справочника
+        items: Загруженные данные
+        generation: Номер загрузки раздела, после которой запущено фоновое обновление. Если раздел
+            с тех пор загружен заново, данные фонового обновления устарели и отбрасываются
+
+    Returns:
+        bool: True, если данные заменены
+    """
+    with _directory_load_lock:
+        if generation is not None and generation != _directory_load_generations[kind]:
+            return False
+        _directory_load_generations[kind] += 1
+        replace_directory_section(settings, kind, items)
+        save_snapshot_cache(settings, kind, items)
+    return True
+
+def wait_for_snapshot_refresh():
+    """
+    Дожидается завершения фоновых обновлений справочника из API (warm_from_snapshot_cache).
+    Вызывается перед проверкой файлов импорта, чтобы проверка не выполнялась по устаревшему снимку.
+    """
+    for kind, thread in list(_snapshot_refresh_threads.items()):
+        if thread.is_alive():
+            logger.info(f"Ожидание завершения фонового обновления данных ({kind}) из API...")
+            thread.join()
+        _snapshot_refresh_threads.pop(kind, None)
+
+class DirectoryIndex:
+    """
+    Индекс пользователей организации для поиска за O(1).
+
+    Строится один раз для списка пользователей из кэша (get_all_api360_users) и содержит
+    словари: id -> пользователь, nickname/алиас/локальная часть email-контакта/фамилия
+    (в нижнем регистре) -> позиции пользователей в исходном списке. Позиции позволяют
+    возвращать найденных пользователей в том же порядке, что и при полном переборе списка.
+
+    Args:
+        users: Список пользователей из API 360
+    """
+
+    def __init__(self, users: list):
+        self.users = users
+        self.by_id = {}
+        self.by_nickname = {}
+        self.by_alias = {}
+        self.by_email_local = {}
+        self.by_last_name = {}
+        for pos, user in enumerate(users):
+            self.by_id[str(user['id'])] = user
+            self._add(self.by_nickname, user['nickname'].lower(), pos)
+            for alias in user.get('aliases', []):
+                if alias.strip():
+                    self._add(self.by_alias, alias.lower().strip(), pos)
+            for contact in user.get('contacts', []):
+                if contact['type'] == 'email':
+                    self._add(self.by_email_local, contact['value'].split('@')[0].lower(), pos)
+            self._add(self.by_last_name, user.get('name', {}).get('last', '').lower(), pos)
+
+    @staticmethod
+    def _add(index: dict, key: str, pos: int):
+        positions = index.setdefault(key, [])
+        if not positions or positions[-1] != pos:
+            positions.append(pos)
+
+    def _users_at(self, positions) -> list:
+        return [self.users[pos] for pos in sorted(set(positions))]
+
+    def find_by_id(self, user_id: str):
+        return self.by_id.get(str(user_id))
+
+    def find_by_nickname(self, nickname: str):
+        positions = self.by_nickname.get(nickname.lower().strip())
+        return self.users[positions[0]] if positions else None
+
+    def find_by_alias(self, alias: str):
+        positions = self.by_alias.get(alias.lower().strip())
+        return self.users[positions[0]] if positions else None
+
+    def find_by_last_name(self, last_name: str) -> list:
+        return self._users_at(self.by_last_name.get(last_name.lower().strip(), []))
+
+    def find_login_conflicts(self, login: str) -> list:
+        """Возвращает пользователей, у которых login совпадает с nickname, алиасом или локальной частью email."""
+        login = login.lower()
+        return self._users_at(self.by_nickname.get(login, []) + self.by_alias.get(login, []) + self.by_email_local.get(login, []))
+
+def get_directory_index(settings: "SettingParams") -> DirectoryIndex:
+    """
+    Возвращает индекс пользователей для текущего кэша get_all_api360_users.
+
+    Индекс перестраивается только когда кэш пользователей заменяется новым списком
+    (обновление из API, снимка на диске или фоновое обновление).
+    """
+    users = get_all_api360_users(settings)
+    if settings.directory_index is None or settings.directory_index.users is not users:
+        settings.directory_index = DirectoryIndex(users)
+    return settings.directory_index
+
 def get_all_api360_users_from_api(settings: "SettingParams"):
     logger.info("Получение всех пользователей организации из API...")
     url = f'{DEFAULT_360_API_URL}/directory/v1/org/{settings.org_id}/users'
-    headers = {"Authorization": f"OAuth {settings.oauth_token}"}
-    has_errors = False
+    success, pages = fetch_all_pages_from_api(settings, url, 'users', USERS_PER_PAGE_FROM_API)
+    if not success:
+        print("Есть ошибки при GET запросах. Возвращается пустой список пользователей.")
+        return []
+
     users = []
-    current_page = 1
-    last_page = 1
-    while current_page <= last_page:
-        params = {'page': current_page, 'perPage': USERS_PER_PAGE_FROM_API}
-        try:
-            retries = 1
-            while True:
-                logger.debug(f"GET URL - {url}")
-                response = requests.get(url, headers=headers, params=params)
-                logger.debug(f"x-request-id: {response.headers.get('x-request-id','')}")
-                if response.status_code != HTTPStatus.OK.value:
-                    logger.error(f"!!! ОШИБКА !!! при GET запросе url - {url}: {response.status_code}. Сообщение об ошибке: {response.text}")
-                    if retries < MAX_RETRIES:
-                        logger.error(f"Повторная попытка ({retries+1}/{MAX_RETRIES})")
-                        time.sleep(RETRIES_DELAY_SEC * retries)
-                        retries += 1
-                    else:
-                        has_errors = True
-                        break
-                else:
-                    for user in response.json()['users']:
-                        if not user.get('isRobot') and int(user["id"]) >= 1130000000000000:
-                            users.append(user)
-                    logger.debug(f"Загружено {len(response.json()['users'])} пользователей. Текущая страница - {current_page} (всего {last_page} страниц).")
-                    current_page += 1
-                    last_page = response.json()['pages']
-                    break
+    for page_users in pages:
+        for user in page_users:
+            if not user.get('isRobot') and int(user["id"]) >= 1130000000000000:
+                users.append(user)
+    if settings.compact_user_records:
+        intern_user_strings(users)
+    return users
+
+def fetch_all_pages_from_api(settings: "SettingParams", url: str, items_key: str, per_page: int) -> Tuple[bool, list]:
+    """
+    Загружает все страницы списка из API 360.
 
+    Первая страница запрашивается отдельно, чтобы узнать общее количество страниц (поле pages),
+    остальные страницы загружаются параллельно (не больше потоков, чем соединений в пуле API-клиента).
+    Тело каждого ответа разбирается один раз.
+
+    Args:
+        settings: Настройки скрипта
+        url: Адрес списка в API
+        items_key: Имя поля ответа со списком элементов ('users', 'departments', 'groups')
+        per_page: Количество элементов на странице
+
+    Returns:
+        tuple: (success: bool, pages: list) - списки элементов каждой страницы в порядке номеров страниц
+    """
+    def fetch_page(page: int):
+        params = {'page': page, 'perPage': per_page}
+        logger.debug(f"GET URL - {url} (страница {page})")
+        try:
+            response = settings.api_client.get(url, params=params)
         except requests.exceptions.RequestException as e:
             logger.error(f"!!! ERROR !!! {type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
-            has_errors = True
-            break
+            return None
+        logger.debug(f"x-request-id: {response.headers.get('x-request-id','')}")
+        if response.status_code != HTTPStatus.OK.value:
+            logger.error(f"!!! ОШИБКА !!! при GET запросе url - {url}: {response.status_code}. Сообщение об ошибке: {response.text}")
+            return None
+        try:
+            data = response.json()
+        except ValueError as e:
+            logger.error(f"!!! ОШИБКА !!! при GET запросе url - {url}: ответ не в формате JSON ({e}). Ответ: {response.text[:200]}")
+            return None
+        if not isinstance(data, dict) or not isinstance(data.get(items_key), list):
+            logger.error(f"!!! ОШИБКА !!! при GET запросе url - {url}: в ответе нет списка {items_key}. Ответ: {response.text[:200]}")
+            return None
+        logger.debug(f"Загружено {len(data[items_key])} элементов ({items_key}). Страница - {page} (всего {data.get('pages', 1)} страниц).")
+        return data
 
-        if has_errors:
-            break
+    first_page = fetch_page(1)
+    if first_page is None:
+        return False, []
+    last_page = first_page.get('pages', 1)
+    pages = [first_page[items_key]]
+    if last_page > 1:
+        workers = min(settings.api_client.pool_size, last_page - 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for data in executor.map(fetch_page, range(2, last_page + 1)):
+                if data is None:
+                    return False, []
+                pages.append(data[items_key])
+    return True, pages
 
-    if has_errors:
-        print("Есть ошибки при GET запросах. Возвращается пустой список пользователей.")
-        return []
-    
-    return users
+class RateLimiter:
+    """
+    Ограничитель частоты запросов по алгоритму token bucket (потокобезопасный).
+
+    Корзина пополняется со скоростью rate токенов в секунду и вмещает не более
+    burst токенов, поэтому после простоя можно сразу выполнить burst запросов,
+    а затем запросы идут не чаще rate в секунду. Если API ответил 429, все потоки
+    приостанавливаются на время, указанное в Retry-After (см. pause).
+
+    Args:
+        rate: Количество запросов в секунду (0 - без ограничения)
+        burst: Максимальное количество запросов подряд без ожидания
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Ожидает, пока будет доступен токен, и забирает его."""
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+                    self.updated_at = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Приостанавливает выдачу токенов всем потокам на указанное время."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+
+def get_retry_after_seconds(response: requests.Response):
+    """
+    Возвращает паузу из заголовка Retry-After (в секундах) или None, если заголовка нет.
+
+    Заголовок может содержать как количество секунд, так и дату в формате HTTP.
+    Пауза ограничивается MAX_RETRIES_DELAY_SEC.
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return min(MAX_RETRIES_DELAY_SEC, float(value))
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return min(MAX_RETRIES_DELAY_SEC, max(0.0, (retry_at - datetime.now(retry_at.tzinfo)).total_seconds()))
+
+
+def is_request_not_sent(error: Exception) -> bool:
+    """Проверяет, что сетевая ошибка произошла до отправки запроса (соединение с сервером не установлено)."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, ConnectTimeoutError)
+
+
+def get_backoff_delay(attempt: int) -> float:
+    """Экспоненциальная пауза перед повторной попыткой номер attempt (с 1) со случайным разбросом."""
+    delay = min(MAX_RETRIES_DELAY_SEC, RETRIES_DELAY_SEC * (2 ** (attempt - 1)))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class Api360Client:
+    """
+    HTTP-клиент для API Yandex 360.
+
+    Все запросы к API выполняются через одну сессию requests.Session с пулом
+    keep-alive соединений, поэтому TCP/TLS-соединение с api360.yandex.net
+    устанавливается один раз и переиспользуется между вызовами.
+    Заголовок авторизации задаётся один раз при создании клиента.
+
+    Каждый запрос проходит через общий RateLimiter. Ответы с кодами из
+    RETRYABLE_STATUS_CODES и сетевые ошибки повторяются до MAX_RETRIES раз
+    с экспоненциальной паузой (или паузой из Retry-After); остальные ответы
+    возвращаются вызывающему коду сразу. Запросы NON_IDEMPOTENT_METHODS повторяются
+    только при ответе 429 и при ошибке соединения до отправки запроса, чтобы не создать объект дважды.
+
+    Args:
+        oauth_token: OAuth токен для доступа к API
+        pool_size: Размер пула соединений (количество одновременно открытых соединений)
+        rate_limiter: Ограничитель частоты запросов (None - без ограничения)
+    """
+
+    def __init__(self, oauth_token: str, pool_size: int = DEFAULT_API_POOL_SIZE, rate_limiter: RateLimiter = None):
+        self.pool_size = max(1, pool_size)
+        self.rate_limiter = rate_limiter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Authorization": f"OAuth {oauth_token}",
+            "Connection": "keep-alive",
+        })
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        attempt = 1
+        idempotent = method.upper() not in NON_IDEMPOTENT_METHODS
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= MAX_RETRIES or not (idempotent or is_request_not_sent(e)):
+                    raise
+                delay = get_backoff_delay(attempt)
+                logger.error(f"{type(e).__name__} при {method} запросе url - {url}: {e}")
+            else:
+                retryable = response.status_code in RETRYABLE_STATUS_CODES if idempotent else response.status_code == HTTPStatus.TOO_MANY_REQUESTS.value
+                if not retryable or attempt >= MAX_RETRIES:
+                    return response
+                retry_after = get_retry_after_seconds(response)
+                delay = retry_after if retry_after is not None else get_backoff_delay(attempt)
+                if response.status_code == HTTPStatus.TOO_MANY_REQUESTS.value and self.rate_limiter:
+                    self.rate_limiter.pause(delay)
+                logger.error(f"Ответ {response.status_code} при {method} запросе url - {url}. Сообщение: {response.text}")
+            attempt += 1
+            logger.error(f"Повторная попытка ({attempt}/{MAX_RETRIES}) через {delay:.1f} сек.")
+            time.sleep(delay)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url: str, **kwargs) -> requests.Response:
+        return self.request("PUT", url, **kwargs)
+
+    def patch(self, url: str, **kwargs) -> requests.Response:
+        return self.request("PATCH", url, **kwargs)
+
+    def delete(self, url: str, **kwargs) -> requests.Response:
+        return self.request("DELETE", url, **kwargs)
+
+    def close(self):
+        self.session.close()
 
 @dataclass
 class SettingParams:
@@ -2602,6 +3777,24 @@ class SettingParams:
     short_file_dir : str
     search_aliases_file : str
     display_users_fields_file : str
+    api_pool_size : int
+    max_parallel_requests : int
+    validation_processes : int
+    api_rate_limit_rps : float
+    api_rate_limit_burst : int
+    snapshot_cache_file : str
+    snapshot_cache_ttl_minutes : int
+    row_fingerprints_file : str
+    api_client : Api360Client
+    department_tree : "DepartmentTree"
+    directory_index : "DirectoryIndex"
+    search_use_indexes : bool
+    search_index : "SearchIndex"
+    user_columns : "UserColumns"
+    compact_user_records : bool
+    snapshot_version : int
+    query_cache_size : int
+    query_cache : "QueryResultCache"
 
 def get_settings():
     exit_flag = False
@@ -2637,6 +3830,24 @@ def get_settings():
         short_file_dir = os.environ.get("SHORT_FILE_DIR", "."),
         search_aliases_file = os.environ.get("SEARCH_ALIASES_FILE", "search_aliases.txt"),
         display_users_fields_file = os.environ.get("DISPLAY_USERS_IN_CONSOLE_FIELDS", "fields_spec.txt"),
+        api_pool_size = int(os.environ.get("API_POOL_SIZE", str(DEFAULT_API_POOL_SIZE))),
+        max_parallel_requests = max(1, int(os.environ.get("MAX_PARALLEL_REQUESTS", str(DEFAULT_MAX_PARALLEL_REQUESTS)))),
+        validation_processes = max(1, int(os.environ.get("VALIDATION_PROCESSES", str(DEFAULT_VALIDATION_PROCESSES)))),
+        api_rate_limit_rps = float(os.environ.get("API_RATE_LIMIT_RPS", str(DEFAULT_API_RATE_LIMIT_RPS))),
+        api_rate_limit_burst = int(os.environ.get("API_RATE_LIMIT_BURST", str(DEFAULT_API_RATE_LIMIT_BURST))),
+        snapshot_cache_file = os.environ.get("SNAPSHOT_CACHE_FILE", ""),
+        snapshot_cache_ttl_minutes = int(os.environ.get("SNAPSHOT_CACHE_TTL_MINUTES", str(DEFAULT_SNAPSHOT_CACHE_TTL_MINUTES))),
+        row_fingerprints_file = os.environ.get("ROW_FINGERPRINTS_FILE", ""),
+        api_client = None,
+        department_tree = None,
+        directory_index = None,
+        search_use_indexes = os.environ.get("SEARCH_USE_INDEXES", "true").lower() == "true",
+        search_index = None,
+        user_columns = None,
+        compact_user_records = os.environ.get("COMPACT_USER_RECORDS", "false").lower() == "true",
+        snapshot_version = 0,
+        query_cache_size = int(os.environ.get("QUERY_CACHE_SIZE", str(DEFAULT_QUERY_CACHE_SIZE))),
+        query_cache = None,
     )
 
     if not settings.users_file:
@@ -2662,6 +3873,13 @@ def get_settings():
             input("Нажмите Enter для продолжения..")
 
 
+    # Пул соединений должен быть не меньше числа параллельных потоков, иначе потоки будут ждать свободное соединение
+    settings.api_client = Api360Client(
+        settings.oauth_token,
+        max(settings.api_pool_size, settings.max_parallel_requests),
+        RateLimiter(settings.api_rate_limit_rps, settings.api_rate_limit_burst),
+    )
+
     if not settings.password_pattern:
         logger.error("PASSWORD_PATTERN не установлен. Используется значение по умолчанию.")
         settings.password_pattern = DEFAULT_PASSWORD_PATTERN
@@ -2782,32 +4000,27 @@ def check_token_permissions(token: str, org_id: int, needed_permissions: list) -
 def create_user_by_api(settings: "SettingParams", user: dict):
 
     url = f'{DEFAULT_360_API_URL}/directory/v1/org/{settings.org_id}/users'
-    headers = {"Authorization": f"OAuth {settings.oauth_token}"}
     logger.debug(f"POST URL: {url}")
     logger.debug(f"POST DATA: {mask_sensitive_data(user)}")
-    retries = 1
     added_user = {}
     success = False
     while True:
         try:
-            response = requests.post(f"{url}", headers=headers, json=user)
+            response = settings.api_client.post(url, json=user)
             logger.debug(f"x-request-id: {response.headers.get('x-request-id','')}")
             if response.status_code != HTTPStatus.OK.value:
                 logger.error(f"Error during POST request: {response.status_code}. Error message: {response.text}")
-                if retries < MAX_RETRIES:
-                    logger.error(f"Retrying ({retries+1}/{MAX_RETRIES})")
-                    time.sleep(RETRIES_DELAY_SEC * retries)
-                    retries += 1
-                else:
-                    logger.error(f"Ошибка. Создание пользователя {user['nickname']} ({user['name']['last']} {user['name']['first']}) не удалось.")
-                    break
+                logger.error(f"Ошибка. Создание пользователя {user['nickname']} ({user['name']['last']} {user['name']['first']}) не удалось.")
+                break
             else:
                 added_user = response.json()
                 logger.info(f"Успех - пользователь {user['nickname']} ({user['name']['last']} {user['name']['first']}) создан успешно. UID = {added_user.get('uid')}")
+                bump_snapshot_version(settings)
                 success = True
                 break
         except Exception as e:
             logger.error(f"{type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
+            break
 
     return success, added_user
 
@@ -2825,15 +4038,13 @@ def get_user_by_api(settings: "SettingParams", user_id: str):
         - user_data: Словарь с данными пользователя или пустой словарь при ошибке
     """
     url = f'{DEFAULT_360_API_URL}/directory/v1/org/{settings.org_id}/users/{user_id}'
-    headers = {"Authorization": f"OAuth {settings.oauth_token}"}
     logger.debug(f"GET URL: {url}")
-    retries = 1
     user_data = {}
     success = False
     
     while True:
         try:
-            response = requests.get(url, headers=headers)
+            response = settings.api_client.get(url)
             logger.debug(f"x-request-id: {response.headers.get('x-request-id','')}")
             
             if response.status_code == HTTPStatus.OK.value:
@@ -2852,21 +4063,11 @@ def get_user_by_api(settings: "SettingParams", user_id: str):
                 break
             else:
                 logger.error(f"Ошибка при GET запросе: {response.status_code}. Сообщение об ошибке: {response.text}")
-                if retries < MAX_RETRIES:
-                    logger.error(f"Повторная попытка ({retries+1}/{MAX_RETRIES})")
-                    time.sleep(RETRIES_DELAY_SEC * retries)
-                    retries += 1
-                else:
-                    logger.error(f"Ошибка. Получение данных пользователя с ID {user_id} не удалось.")
-                    break
+                logger.error(f"Ошибка. Получение данных пользователя с ID {user_id} не удалось.")
+                break
         except requests.exceptions.RequestException as e:
             logger.error(f"!!! ERROR !!! {type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
-            if retries < MAX_RETRIES:
-                logger.error(f"Повторная попытка ({retries+1}/{MAX_RETRIES})")
-                time.sleep(RETRIES_DELAY_SEC * retries)
-                retries += 1
-            else:
-                break
+            break
         except Exception as e:
             logger.error(f"{type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
             break
@@ -2876,30 +4077,25 @@ def get_user_by_api(settings: "SettingParams", user_id: str):
 def patch_user_by_api(settings: "SettingParams", user_id: int, patch_data: dict):
 
     url = f'{DEFAULT_360_API_URL}/directory/v1/org/{settings.org_id}/users/{user_id}'
-    headers = {"Authorization": f"OAuth {settings.oauth_token}"}
     logger.debug(f"PATCH URL: {url}")
     logger.debug(f"PATCH DATA: {mask_sensitive_data(patch_data)}")
-    retries = 1
     success = False
     while True:
         try:
-            response = requests.patch(f"{url}", headers=headers, json=patch_data)
+            response = settings.api_client.patch(url, json=patch_data)
             logger.debug(f"x-request-id: {response.headers.get('x-request-id','')}")
             if response.status_code != HTTPStatus.OK.value:
                 logger.error(f"Error during PATCH request: {response.status_code}. Error message: {response.text}")
-                if retries < MAX_RETRIES:
-                    logger.error(f"Retrying ({retries+1}/{MAX_RETRIES})")
-                    time.sleep(RETRIES_DELAY_SEC * retries)
-                    retries += 1
-                else:
-                    logger.error(f"Ошибка. Изменение пользователя {user_id} не удалось.")
-                    break
+                logger.error(f"Ошибка. Изменение пользователя {user_id} не удалось.")
+                break
             else:
                 logger.info(f"Успех - данные пользователя {user_id} изменены успешно.")
+                bump_snapshot_version(settings)
                 success = True
                 break
         except Exception as e:
             logger.error(f"{type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
+            break
 
     return success
 
@@ -2916,43 +4112,32 @@ def create_user_alias_by_api(settings: "SettingParams", user_id: str, alias: str
         tuple: (success: bool, response_data: dict)
     """
     url = f'{DEFAULT_360_API_URL}/directory/v1/org/{settings.org_id}/users/{user_id}/aliases'
-    headers = {"Authorization": f"OAuth {settings.oauth_token}"}
     data = {"alias": alias}
     
     logger.debug(f"POST URL: {url}")
     logger.debug(f"POST DATA: {data}")
     
-    retries = 1
     success = False
     response_data = {}
     
     while True:
         try:
-            response = requests.post(url, headers=headers, json=data)
+            response = settings.api_client.post(url, json=data)
             logger.debug(f"x-request-id: {response.headers.get('x-request-id','')}")
             
             if response.status_code == HTTPStatus.OK:
                 logger.info(f"Успех - алиас '{alias}' добавлен пользователю {user_id}.")
                 response_data = response.json()
+                bump_snapshot_version(settings)
                 success = True
                 break
             else:
                 logger.error(f"Ошибка при добавлении алиаса: {response.status_code}. Сообщение: {response.text}")
-                if retries < MAX_RETRIES:
-                    logger.error(f"Повторная попытка ({retries+1}/{MAX_RETRIES})")
-                    time.sleep(RETRIES_DELAY_SEC * retries)
-                    retries += 1
-                else:
-                    logger.error(f"Ошибка. Добавление алиаса '{alias}' пользователю {user_id} не удалось.")
-                    break
+                logger.error(f"Ошибка. Добавление алиаса '{alias}' пользователю {user_id} не удалось.")
+                break
         except Exception as e:
             logger.error(f"{type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
-            if retries < MAX_RETRIES:
-                logger.error(f"Повторная попытка ({retries+1}/{MAX_RETRIES})")
-                time.sleep(RETRIES_DELAY_SEC * retries)
-                retries += 1
-            else:
-                break
+            break
     
     return success, response_data
 
@@ -2969,41 +4154,30 @@ def delete_user_alias_by_api(settings: "SettingParams", user_id: str, alias: str
         tuple: (success: bool, response_data: dict)
     """
     url = f'{DEFAULT_360_API_URL}/directory/v1/org/{settings.org_id}/users/{user_id}/aliases/{alias}'
-    headers = {"Authorization": f"OAuth {settings.oauth_token}"}
     
     logger.debug(f"DELETE URL: {url}")
     
-    retries = 1
     success = False
     response_data = {}
     
     while True:
         try:
-            response = requests.delete(url, headers=headers)
+            response = settings.api_client.delete(url)
             logger.debug(f"x-request-id: {response.headers.get('x-request-id','')}")
             
             if response.status_code == HTTPStatus.OK:
                 logger.info(f"Успех - алиас '{alias}' удален пользователю {user_id}.")
                 response_data = response.json()
+                bump_snapshot_version(settings)
                 success = True
                 break
             else:
                 logger.error(f"Ошибка при удалении алиаса: {response.status_code}. Сообщение: {response.text}")
-                if retries < MAX_RETRIES:
-                    logger.error(f"Повторная попытка ({retries+1}/{MAX_RETRIES})")
-                    time.sleep(RETRIES_DELAY_SEC * retries)
-                    retries += 1
-                else:
-                    logger.error(f"Ошибка. Удаление алиаса '{alias}' пользователю {user_id} не удалось.")
-                    break
+                logger.error(f"Ошибка. Удаление алиаса '{alias}' пользователю {user_id} не удалось.")
+                break
         except Exception as e:
             logger.error(f"{type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
-            if retries < MAX_RETRIES:
-                logger.error(f"Повторная попытка ({retries+1}/{MAX_RETRIES})")
-                time.sleep(RETRIES_DELAY_SEC * retries)
-                retries += 1
-            else:
-                break
+            break
     
     return success, response_data
 
@@ -3019,7 +4193,6 @@ def delete_user_by_api(settings: "SettingParams", user_id: str):
         tuple: (success: bool, response_data: dict)
     """
     url = f'{DEFAULT_360_API_URL}/directory/v1/org/{settings.org_id}/users/{user_id}'
-    headers = {"Authorization": f"OAuth {settings.oauth_token}"}
     
     logger.debug(f"DELETE URL: {url}")
     
@@ -3027,42 +4200,33 @@ def delete_user_by_api(settings: "SettingParams", user_id: str):
         logger.info(f"DRY RUN: Пользователь {user_id} был бы удален.")
         return True, {"dry_run": True}
     
-    retries = 1
     success = False
     response_data = {}
     
     while True:
         try:
-            response = requests.delete(url, headers=headers)
+            response = settings.api_client.delete(url)
             logger.debug(f"x-request-id: {response.headers.get('x-request-id','')}")
             
             if response.status_code == HTTPStatus.OK:
                 logger.info(f"Успех - пользователь {user_id} удален.")
                 response_data = response.json() if response.text else {}
+                bump_snapshot_version(settings)
                 success = True
                 break
             elif response.status_code == HTTPStatus.NO_CONTENT:
                 logger.info(f"Успех - пользователь {user_id} удален (204 No Content).")
                 response_data = {}
+                bump_snapshot_version(settings)
                 success = True
                 break
             else:
                 logger.error(f"Ошибка при удалении пользователя: {response.status_code}. Сообщение: {response.text}")
-                if retries < MAX_RETRIES:
-                    logger.error(f"Повторная попытка ({retries+1}/{MAX_RETRIES})")
-                    time.sleep(RETRIES_DELAY_SEC * retries)
-                    retries += 1
-                else:
-                    logger.error(f"Ошибка. Удаление пользователя {user_id} не удалось.")
-                    break
+                logger.error(f"Ошибка. Удаление пользователя {user_id} не удалось.")
+                break
         except Exception as e:
             logger.error(f"{type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
-            if retries < MAX_RETRIES:
-                logger.error(f"Повторная попытка ({retries+1}/{MAX_RETRIES})")
-                time.sleep(RETRIES_DELAY_SEC * retries)
-                retries += 1
-            else:
-                break
+            break
     
     return success, response_data
 
@@ -3146,133 +4310,59 @@ def get_all_api360_departments(settings: "SettingParams", force = False, show_me
         else:
             logger.debug("Получение всех подразделений организации из кэша...")
     if not settings.all_deps or force or (datetime.now() - settings.all_deps_get_timestamp).total_seconds() > ALL_DEPS_REFRESH_IN_MINUTES * 60:
-        settings.all_deps = get_all_api360_departments_from_api(settings)
-        settings.all_deps_get_timestamp = datetime.now()
+        if force or settings.all_deps or not warm_from_snapshot_cache(settings, 'departments', get_all_api360_departments_from_api):
+            store_directory_section(settings, 'departments', get_all_api360_departments_from_api(settings))
     return settings.all_deps
 
 def get_all_api360_departments_from_api(settings: "SettingParams"):
     logger.info("Получение всех подразделений организации из API...")
     url = f'{DEFAULT_360_API_URL}/directory/v1/org/{settings.org_id}/departments'
-    headers = {"Authorization": f"OAuth {settings.oauth_token}"}
-
-    has_errors = False
-    departments = []
-    current_page = 1
-    last_page = 1
-    while current_page <= last_page:
-        params = {'page': current_page, 'perPage': DEPARTMENTS_PER_PAGE_FROM_API}
-        try:
-            retries = 1
-            while True:
-                logger.debug(f"GET URL - {url}")
-                response = requests.get(url, headers=headers, params=params)
-                logger.debug(f"x-request-id: {response.headers.get('x-request-id','')}")
-                if response.status_code != HTTPStatus.OK.value:
-                    logger.error(f"!!! ОШИБКА !!! при GET запросе url - {url}: {response.status_code}. Сообщение об ошибке: {response.text}")
-                    if retries < MAX_RETRIES:
-                        logger.error(f"Повторная попытка ({retries+1}/{MAX_RETRIES})")
-                        time.sleep(RETRIES_DELAY_SEC * retries)
-                        retries += 1
-                    else:
-                        has_errors = True
-                        break
-                else:
-                    for deps in response.json()['departments']:
-                        departments.append(deps)
-                    logger.debug(f"Загружено {len(response.json()['departments'])} подразделений. Текущая страница - {current_page} (всего {last_page} страниц).")
-                    current_page += 1
-                    last_page = response.json()['pages']
-                    break
-
-        except requests.exceptions.RequestException as e:
-            logger.error(f"!!! ERROR !!! {type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
-            has_errors = True
-            break
-
-        if has_errors:
-            break
-
-    if has_errors:
+    success, pages = fetch_all_pages_from_api(settings, url, 'departments', DEPARTMENTS_PER_PAGE_FROM_API)
+    if not success:
         print("Есть ошибки при GET запросах. Возвращается пустой список подразделений.")
         return []
-    
+
+    departments = []
+    for page_deps in pages:
+        departments.extend(page_deps)
     return departments
 
 def get_all_api360_groups(settings: "SettingParams", force = False):
     if not force:
         logger.info("Получение всех групп организации из кэша...")
     if not settings.all_groups or force or (datetime.now() - settings.all_groups_get_timestamp).total_seconds() > ALL_GROUPS_REFRESH_IN_MINUTES * 60:
-        settings.all_groups = get_all_api360_groups_from_api(settings)
-        settings.all_groups_get_timestamp = datetime.now()
+        if force or settings.all_groups or not warm_from_snapshot_cache(settings, 'groups', get_all_api360_groups_from_api):
+            store_directory_section(settings, 'groups', get_all_api360_groups_from_api(settings))
     return settings.all_groups
 
 def get_all_api360_groups_from_api(settings: "SettingParams"):
     logger.info("Получение всех групп организации из API...")
     url = f"{DEFAULT_360_API_URL}/directory/v1/org/{settings.org_id}/groups"
-    headers = {"Authorization": f"OAuth {settings.oauth_token}"}
-    has_errors = False
-    groups = []
-    current_page = 1
-    last_page = 1
-    while current_page <= last_page:
-        params = {'page': current_page, 'perPage': GROUPS_PER_PAGE_FROM_API}
-        try:
-            retries = 1
-            while True:
-                logger.debug(f"GET URL - {url}")
-                response = requests.get(url, headers=headers, params=params)
-                logger.debug(f"x-request-id: {response.headers.get('x-request-id','')}")
-                if response.status_code != HTTPStatus.OK.value:
-                    logger.error(f"!!! ERROR !!! during GET request url - {url}: {response.status_code}. Error message: {response.text}")
-                    if retries < MAX_RETRIES:
-                        logger.error(f"Retrying ({retries+1}/{MAX_RETRIES})")
-                        time.sleep(RETRIES_DELAY_SEC * retries)
-                        retries += 1
-                    else:
-                        has_errors = True
-                        break
-                else:
-                    groups.extend(response.json()['groups'])
-                    logger.debug(f"Get {len(response.json()['groups'])} groups from page {current_page} (total {last_page} page(s)).")
-                    current_page += 1
-                    last_page = response.json()['pages']
-                    break
-
-        except requests.exceptions.RequestException as e:
-            logger.error(f"!!! ERROR !!! {type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
-            has_errors = True
-            break
-
-        if has_errors:
-            break
-
-    if has_errors:
+    success, pages = fetch_all_pages_from_api(settings, url, 'groups', GROUPS_PER_PAGE_FROM_API)
+    if not success:
         logger.error("There are some error during GET requests. Return empty groups list.")
         return []
-    
+
+    groups = []
+    for page_groups in pages:
+        groups.extend(page_groups)
     return groups
 
 def delete_department_by_api(settings: "SettingParams", department: dict):
     logger.info(f"Удаление подразделения {department['id']} ({department['name']}) из API...")
     url = f"{DEFAULT_360_API_URL}/directory/v1/org/{settings.org_id}/departments/{department['id']}"
-    headers = {"Authorization": f"OAuth {settings.oauth_token}"}
     logger.debug(f"DELETE URL: {url}")
     try:
-        retries = 1
         while True:
-            response = requests.delete(f"{url}", headers=headers)
+            response = settings.api_client.delete(url)
             logger.debug(f"x-request-id: {response.headers.get('x-request-id','')}")
             if response.status_code != HTTPStatus.OK.value:
                 logger.error(f"!!! ОШИБКА !!! при DELETE запросе url - {url}: {response.status_code}. Сообщение об ошибке: {response.text}")
-                if retries < MAX_RETRIES:
-                    logger.error(f"Повторная попытка ({retries+1}/{MAX_RETRIES})")
-                    time.sleep(RETRIES_DELAY_SEC * retries)
-                    retries += 1
-                else:
-                    has_errors = True
-                    break
+                has_errors = True
+                break
             else:
                 logger.info(f"Успех - подразделение {department['id']} ({department['name']}) удалено успешно.")
+                bump_snapshot_version(settings)
                 return True
     except requests.exceptions.RequestException as e:
         logger.error(f"!!! ERROR !!! {type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
@@ -3300,25 +4390,19 @@ def delete_all_departments(settings: "SettingParams"):
 def create_department_by_api(settings: "SettingParams", department: dict):
     logger.info(f"Создание подразделения {department['name']} в API...")
     url = f'{DEFAULT_360_API_URL}/directory/v1/org/{settings.org_id}/departments'
-    headers = {"Authorization": f"OAuth {settings.oauth_token}"}
     logger.debug(f"POST URL: {url}")
     logger.debug(f"POST DATA: {department}")
     try:
-        retries = 1
         while True:
-            response = requests.post(f"{url}", headers=headers, json=department)
+            response = settings.api_client.post(url, json=department)
             logger.debug(f"x-request-id: {response.headers.get('x-request-id','')}")
             if response.status_code != HTTPStatus.OK.value:
                 logger.error(f"!!! ОШИБКА !!! при POST запросе url - {url}: {response.status_code}. Сообщение об ошибке: {response.text}")
-                if retries < MAX_RETRIES:
-                    logger.error(f"Повторная попытка ({retries+1}/{MAX_RETRIES})")
-                    time.sleep(RETRIES_DELAY_SEC * retries)
-                    retries += 1
-                else:
-                    has_errors = True
-                    break
+                has_errors = True
+                break
             else:
                 logger.info(f"Успех - подразделение {department['name']} создано успешно.")
+                bump_snapshot_version(settings)
                 return True
 
     except requests.exceptions.RequestException as e:
@@ -3351,7 +4435,7 @@ def clear_dep_info_for_users(settings: "SettingParams"):
 def create_dep_from_prepared_list(settings: "SettingParams", deps_list, max_levels):
     # Фнункция создания департамента из предварительно подготовленного списка
     logger.info('Создание новых подразделений...')
-    api_prepared_list = generate_deps_hierarchy_from_api(settings)
+    deps_tree = get_department_tree(settings)
     for i in range(0, max_levels):
             #Выбираем департаменты, которые будем добавлять на каждом шаге (зависит от уровня level)
             deps_to_add = [d for d in deps_list if d['level'] == i+1]
@@ -3361,7 +4445,7 @@ def create_dep_from_prepared_list(settings: "SettingParams", deps_list, max_leve
                 d = next((e for e in deps_list if e['path'] == item['prev']), None)
                 item['prevId'] = d['360id']
                 #Проверяем, что данный департамент уже добавлен в систему
-                t = next((e for e in api_prepared_list if e['path'] == item['path']), None)   
+                t = deps_tree.find_by_path(item['path'])
                 if t is None:
                     department_info = {
                                     "name": item['current'],
@@ -3371,11 +4455,11 @@ def create_dep_from_prepared_list(settings: "SettingParams", deps_list, max_leve
                     need_update_deps = True
             #all_deps_from_api = organization.get_departments_list()
             if need_update_deps:
-                api_prepared_list = generate_deps_hierarchy_from_api(settings, force=True, )
+                deps_tree = get_department_tree(settings, force=True)
             for item in deps_to_add:
                 # Ищем в списке департаментов в 360 конкретное значение
                 #d = next(i for i in all_deps_from_api if i['name'] == item['current'] and i['parentId'] == item['prevId'])
-                d = next(i for i in api_prepared_list if i['path'] == item['path'])
+                d = deps_tree.find_by_path(item['path'])
                 #Обновляем информацию в final_list для записанных в 360 департаментов
                 item['360id'] = d['id']
     logger.info('Создание новых подразделений завершено.')
@@ -3557,45 +4641,113 @@ def generate_unique_file_name(name):
     return final_file_name
 
 
-def generate_deps_hierarchy_from_api(settings: "SettingParams", force = False, show_messages = False):
-    all_deps_from_api = get_all_api360_departments(settings, force, show_messages)
-    if len(all_deps_from_api) == 1:
-        #print('There are no departments in organozation! Exit.')
+class DepartmentTree:
+    """
+    Дерево подразделений организации.
+
+    Строится один раз для списка подразделений из кэша (get_all_api360_departments).
+    Полный путь каждого подразделения (имена от верхнего уровня, разделённые DEPS_SEPARATOR)
+    вычисляется один раз и запоминается, поиск по id и по пути выполняется через словари.
+    Корневое подразделение "Все" (id = 1) в иерархию не входит.
+
+    Args:
+        departments: Список подразделений из API 360
+    """
+
+    def __init__(self, departments: list):
+        self.departments = departments
+        self.by_id = {dep['id']: dep for dep in departments}
+        self.path_by_id = {}
+        self.depth_by_id = {}
+        # Элементы иерархии в формате generate_deps_hierarchy_from_api: {'id', 'parentId', 'path'}
+        self.hierarchy = []
+        self.hierarchy_by_id = {}
+        self.hierarchy_by_path = {}
+        for dep in departments:
+            if dep['parentId'] > 0:
+                element = {'id': dep['id'], 'parentId': dep['parentId'], 'path': self.get_path(dep['id'])}
+                self.hierarchy.append(element)
+                self.hierarchy_by_id[dep['id']] = element
+                self.hierarchy_by_path.setdefault(element['path'], element)
+
+    def get_path(self, dep_id: int) -> str:
+        """Возвращает полный путь подразделения (пути всех его родителей запоминаются)."""
+        if dep_id in self.path_by_id:
+            return self.path_by_id[dep_id]
+        # Поднимаемся к корню до первого подразделения с уже известным путём
+        chain = []
+        current_id = dep_id
+        while current_id not in self.path_by_id and current_id in self.by_id and current_id != 1:
+            chain.append(current_id)
+            current_id = self.by_id[current_id]['parentId']
+        path = self.path_by_id.get(current_id, '')
+        depth = self.depth_by_id.get(current_id, 0)
+        for chain_id in reversed(chain):
+            name = self.by_id[chain_id]['name'].strip()
+            path = f'{path}{DEPS_SEPARATOR}{name}' if path else name
+            depth += 1
+            self.path_by_id[chain_id] = path
+            self.depth_by_id[chain_id] = depth
+        return path
+
+    def find_by_id(self, dep_id: int):
+        """Возвращает элемент иерархии {'id', 'parentId', 'path'} по id подразделения или None."""
+        return self.hierarchy_by_id.get(dep_id)
+
+    def find_by_path(self, path: str):
+        """Возвращает элемент иерархии {'id', 'parentId', 'path'} по полному пути подразделения или None."""
+        return self.hierarchy_by_path.get(path)
+
+    def count_users(self, users: list) -> Tuple[dict, dict]:
+        """
+        Считает пользователей в подразделениях за один проход по списку пользователей.
+
+        Прямые счётчики суммируются снизу вверх: подразделения обходятся от самых глубоких
+        к верхнему уровню, и итог каждого подразделения добавляется к его родителю.
+
+        Returns:
+            tuple: (direct, total) - словари id подразделения -> количество пользователей
+            непосредственно в подразделении и во всём поддереве (включая вложенные подразделения)
+        """
+        direct = Counter(user['departmentId'] for user in users)
+        total = {dep_id: direct.get(dep_id, 0) for dep_id in self.by_id}
+        for dep_id in sorted(self.hierarchy_by_id, key=lambda i: self.depth_by_id.get(i, 0), reverse=True):
+            parent_id = self.by_id[dep_id]['parentId']
+            if parent_id in total:
+                total[parent_id] += total[dep_id]
+        return direct, total
+
+def get_department_tree(settings: "SettingParams", force = False, show_messages = False) -> DepartmentTree:
+    """
+    Возвращает дерево подразделений для текущего кэша get_all_api360_departments.
+
+    Дерево перестраивается только когда кэш подразделений заменяется новым списком.
+    """
+    departments = get_all_api360_departments(settings, force, show_messages)
+    if settings.department_tree is None or settings.department_tree.departments is not departments:
+        settings.department_tree = DepartmentTree(departments)
+    return settings.department_tree
+
+def generate_deps_hierarchy_from_api(settings: "SettingParams", force = False, show_messages = False):
+    deps_tree = get_department_tree(settings, force, show_messages)
+    if len(deps_tree.departments) == 1:
+        #print('There are no departments in organozation! Exit.')
         return []
-    all_deps = []
-    for item in all_deps_from_api:        
-        path = item['name'].strip()
-        prevId = item['parentId']
-        if prevId > 0:
-            while not prevId == 1:
-                d = next(i for i in all_deps_from_api if i['id'] == prevId)
-                path = f'{d["name"].strip()}{DEPS_SEPARATOR}{path}'
-                prevId = d['parentId']
-            element = {'id':item['id'], 'parentId':item['parentId'], 'path':path}
-            all_deps.append(element)
-    return all_deps
+    return list(deps_tree.hierarchy)
 
 def generate_deps_hierarchy_and_count_users_from_api(settings: "SettingParams", force = False):
     users = get_all_api360_users(settings, force)
     if not users:
         return []
-    all_deps_from_api = generate_deps_hierarchy_from_api(settings, force)
-    if len(all_deps_from_api) == 1:
+    deps_tree = get_department_tree(settings, force)
+    if len(deps_tree.departments) == 1:
         #print('There are no departments in organozation! Exit.')
         return []
+    direct, total = deps_tree.count_users(users)
     all_deps = []
-    for item in all_deps_from_api:        
-        path = item['name'].strip()
-        users_count = sum( user['departmentId'] == item['id'] for user in users)
-        prevId = item['parentId']
-        if prevId > 0:
-            while not prevId == 1:
-                users_count += sum( user['departmentId'] == prevId for user in users)
-                d = next(i for i in all_deps_from_api if i['id'] == prevId)
-                path = f'{d["name"].strip()}{DEPS_SEPARATOR}{path}'
-                prevId = d['parentId']
-            element = {'id':item['id'], 'parentId':item['parentId'], 'path':path, 'users_count':users_count}
-            all_deps.append(element)
+    for item in deps_tree.hierarchy:
+        element = {'id':item['id'], 'parentId':item['parentId'], 'path':item['path'], 'direct_users_count':direct.get(item['id'], 0), 'users_count':total[item['id']]}
+        all_deps.append(element)
     return all_deps
 
 def load_dep_info_to_file(settings: "SettingParams", force = False):
@@ -3697,6 +4849,7 @@ def show_user_attributes(settings: "SettingParams", answer):
     if not users:
         logger.error("Не найдено пользователей из API 360. Проверьте ваши настройки.")
         return
+    index = get_directory_index(settings)
 
     found_last_name_user = []
     double_users_flag = False
@@ -3709,23 +4862,20 @@ def show_user_attributes(settings: "SettingParams", answer):
         found_flag = False
         if all(char.isdigit() for char in searched.strip()):
             if len(searched.strip()) == 16 and searched.strip().startswith("113"):
-                for user in users:
-                    if user["id"] == searched.strip():
-                        logger.debug(f"Пользователь найден: {user['nickname']} ({user['id']})")
-                        target_user = user
-                        found_flag = True
-                        break
-        else:
-            found_last_name_user = []
-            for user in users:
-                aliases_lower_case = [r.lower() for r in user["aliases"]]
-                if user["nickname"].lower() == searched.lower().strip() or searched.lower().strip() in aliases_lower_case:
+                user = index.find_by_id(searched.strip())
+                if user:
                     logger.debug(f"Пользователь найден: {user['nickname']} ({user['id']})")
                     target_user = user
                     found_flag = True
-                    break
-                if user["name"]["last"].lower() == searched.lower().strip():
-                    found_last_name_user.append(user)
+        else:
+            found_last_name_user = []
+            user = index.find_by_nickname(searched) or index.find_by_alias(searched)
+            if user:
+                logger.debug(f"Пользователь найден: {user['nickname']} ({user['id']})")
+                target_user = user
+                found_flag = True
+            else:
+                found_last_name_user = index.find_by_last_name(searched)
             if not found_flag and found_last_name_user:
                 if len(found_last_name_user) == 1:
                     logger.debug(f"Пользователь найден ({searched}): {found_last_name_user[0]['nickname']} ({found_last_name_user[0]['id']}, {found_last_name_user[0]['position']})")
@@ -3882,7 +5032,7 @@ def download_users_attrib_to_file_short(settings: "SettingParams", users: list =
     #     return
 
     # --- 2. Выгрузка в формате для импорта (создания пользователей) ---
-    departments = generate_deps_hierarchy_from_api(settings)
+    deps_tree = get_department_tree(settings)
     creation_fields = [
         "id",
         "login",
@@ -3929,7 +5079,7 @@ def download_users_attrib_to_file_short(settings: "SettingParams", users: list =
         if department_id == 1:
             row["department"] = "Все пользователи"
         else:
-            department = next((d for d in departments if d['id'] == department_id), None)
+            department = deps_tree.find_by_id(department_id)
             if department:
                 row["department"] = department['path']
             else:
@@ -3991,78 +5141,100 @@ def download_users_attrib_to_file_short(settings: "SettingParams", users: list =
             writer.writerow(row)
         logger.info(f"Сохранено {len(export_rows)} пользователей в файл {import_file}")
 
-def check_aliases_uniqueness(new_users, mode: str = "add"):
+def check_aliases_uniqueness(settings: "SettingParams", new_users, mode: str = "add"):
     """
     Проверяет уникальность всех алиасов среди nickname и aliases существующих пользователей (existing_users)
     и среди nickname и aliases новых пользователей (new_users).
     Возвращает True если все уникальны, иначе False и список конфликтов.
+
+    Проверка выполняется за один проход по файлу: для каждого значения (логин или алиас)
+    считается, в скольких строках оно встречается всего и в скольких строках с тем же логином.
+    Значение конфликтует со строкой, если оно есть хотя бы в одной строке с другим логином.
+    Существующие пользователи проверяются по индексу DirectoryIndex.
+    В режиме update строка сначала сопоставляется с пользователем (по id или по логину),
+    и алиасы этого же пользователя конфликтом не считаются.
     """
 
+    def used_by_other_login(value, login, total_counter: Counter, counters_by_login: dict) -> bool:
+        return total_counter[value] > counters_by_login[login][value]
+
     conflicts = []
-    temp_set = set()
-    existing_users = get_all_api360_users(settings, force=False)
+    index = get_directory_index(settings)
     if mode == "add":
         for idx,new_user in enumerate(new_users):
-            found_flag = False
-            for y360_user in existing_users:
-                if new_user.get("login") == y360_user.get("nickname"):
-                    conflicts.append((idx+1, "login", new_user.get("login")))
-                    found_flag = True
-                temp_aliases = [item.lower().strip() for item in y360_user.get("aliases", []) if item.strip()]
-                for alias in new_user.get("aliases", "").strip().split(","):
-                    if alias:
-                        if alias.strip().split("@")[0].lower().strip() in temp_aliases:
-                            conflicts.append((idx+1, "alias", alias.strip().split("@")[0].lower().strip()))
-                            found_flag = True
-                if found_flag:
-                    break
+            new_aliases = [normalize_alias(alias) for alias in new_user.get("aliases", "").strip().split(",") if alias]
+            # Конфликты отчитываются по первому (в порядке списка) существующему пользователю, с которым есть совпадение
+            positions = [pos for pos in index.by_nickname.get(str(new_user.get("login")).lower(), []) if index.users[pos].get("nickname") == new_user.get("login")]
+            for alias in new_aliases:
+                positions.extend(index.by_alias.get(alias, []))
+            if not positions:
+                continue
+            y360_user = index.users[min(positions)]
+            if new_user.get("login") == y360_user.get("nickname"):
+                conflicts.append((idx+1, "login", new_user.get("login")))
+            temp_aliases = [item.lower().strip() for item in y360_user.get("aliases", []) if item.strip()]
+            for alias in new_aliases:
+                if alias in temp_aliases:
+                    conflicts.append((idx+1, "alias", alias))
+
+        # Логины и алиасы каждой строки: сколько строк всего и сколько строк с тем же логином их содержат
+        total_counter = Counter()
+        counters_by_login = defaultdict(Counter)
+        for new_user in new_users:
+            values = {new_user.get("login")}
+            values.update(normalize_alias(alias) for alias in new_user.get("aliases", "").strip().split(","))
+            total_counter.update(values)
+            counters_by_login[new_user.get("login")].update(values)
 
-        for idx,new_user1 in enumerate(new_users):
-            temp_set.clear()
-            for new_user2 in new_users:
-                if new_user1.get("login") != new_user2.get("login"):
-                    temp_set.add(new_user2.get("login"))
-                    for alias in new_user2.get("aliases", "").strip().split(","):
-                        temp_set.add(alias.strip().split("@")[0].lower().strip())
-            if new_user1.get("login") in temp_set:
-                conflicts.append((idx+1, "login", new_user1.get("login")))
-            for alias in new_user1.get("aliases", "").strip().split(","):
+        for idx,new_user in enumerate(new_users):
+            login = new_user.get("login")
+            if used_by_other_login(login, login, total_counter, counters_by_login):
+                conflicts.append((idx+1, "login", login))
+            for alias in new_user.get("aliases", "").strip().split(","):
                 if alias:
-                    if alias.strip().split("@")[0].lower().strip() in temp_set:
-                        conflicts.append((idx+1, "alias", alias.strip().split("@")[0].lower().strip()))
+                    if used_by_other_login(normalize_alias(alias), login, total_counter, counters_by_login):
+                        conflicts.append((idx+1, "alias", normalize_alias(alias)))
     elif mode == "update":
+        def target_user_key(new_user) -> str:
+            # Строка обновления указывает пользователя по id или по логину (без учета регистра и домена)
+            row_id = str(new_user.get("id", "")).strip()
+            login = normalize_alias(str(new_user.get("login", "")))
+            if row_id.isdigit() and int(row_id) > 0:
+                y360_user = index.find_by_id(row_id)
+            elif login:
+                y360_user = index.find_by_nickname(login) or index.find_by_alias(login)
+            else:
+                y360_user = None
+            if y360_user:
+                return str(y360_user.get("id"))
+            return f"id:{row_id}" if row_id else f"login:{login}"
+
         for idx,new_user in enumerate(new_users):
             if not new_user.get("aliases"):
                 continue
-            found_flag = False
-            temp_set.clear()
-            for y360_user in existing_users:
-                if new_user.get("login") != y360_user.get("nickname"):
-                    temp_set.add(y360_user.get("nickname"))
-                    temp_aliases = [item.lower().strip() for item in y360_user.get("aliases", []) if item.strip()]
-                    for alias in temp_aliases:
-                        temp_set.add(alias)
+            target_key = target_user_key(new_user)
             for alias in new_user.get("aliases", "").strip().split(","):
-                if alias:
-                    if alias.strip().split("@")[0].lower().strip() in temp_aliases:
-                        conflicts.append((idx+1, "alias", alias.strip().split("@")[0].lower().strip()))
-                        found_flag = True
-            if found_flag:
-                break
+                if alias.strip():
+                    alias = normalize_alias(alias)
+                    owners = index.by_nickname.get(alias, []) + index.by_alias.get(alias, [])
+                    if any(str(index.users[pos].get("id")) != target_key for pos in owners):
+                        conflicts.append((idx+1, "alias", alias))
+
+        total_counter = Counter()
+        counters_by_login = defaultdict(Counter)
+        for new_user in new_users:
+            values = {normalize_alias(alias) for alias in new_user.get("aliases", "").strip().split(",") if alias.strip()}
+            total_counter.update(values)
+            counters_by_login[target_user_key(new_user)].update(values)
 
         for idx,new_user1 in enumerate(new_users):
             if not new_user1.get("aliases"):
                 continue
-            temp_set.clear()
-            for new_user2 in new_users:
-                if new_user1.get("login") != new_user2.get("login"):
-                    for alias in new_user2.get("aliases", "").strip().split(","):
-                        temp_set.add(alias.split("@")[0].lower().strip())
-            
+            target_key = target_user_key(new_user1)
             for alias in new_user1.get("aliases", "").strip().split(","):
-                if alias:
-                    if alias.split("@")[0].lower().strip() in temp_set:
-                        conflicts.append((idx+1, "alias", alias.strip().split("@")[0].lower().strip()))
+                if alias.strip():
+                    if used_by_other_login(normalize_alias(alias), target_key, total_counter, counters_by_login):
+                        conflicts.append((idx+1, "alias", normalize_alias(alias)))
 
     if conflicts:
         logger.error("Обнаружены неуникальные алиасы или логины среди новых и/или существующих пользователей:")
@@ -4105,24 +5277,16 @@ def search_department_prompt(settings: "SettingParams"):
             search_department_by_name(settings, answer.lower())
 
 def search_department_by_name(settings: "SettingParams", name: str):
-    all_deps_from_api = get_all_api360_departments(settings)
+    deps_tree = get_department_tree(settings)
+    all_deps_from_api = deps_tree.departments
     if len(all_deps_from_api) == 1:
         logger.error('В организации нет никаких подразделений! Выход.')
         return 
     if '@' in name:
         name = name.split('@')[0]
-    all_deps = {}
     target_dep = []
     deps_found = False
     for item in all_deps_from_api:        
-        path = item['name'].strip()
-        prevId = item['parentId']
-        if prevId > 0:
-            while not prevId == 1:
-                d = next(i for i in all_deps_from_api if i['id'] == prevId)
-                path = f'{d["name"].strip()}{DEPS_SEPARATOR}{path}'
-                prevId = d['parentId']
-            all_deps[str(item['id'])] = path
         if name.isdigit():
             if item['id'] == int(name):
                 logger.info(f"Подразделение найдено: {item['name']} ({item['id']})")
@@ -4148,7 +5312,7 @@ def search_department_by_name(settings: "SettingParams", name: str):
             logger.info(f"ID          : {item['id']}")
             logger.info(f"ParentId    : {item['parentId']}")
             count = 0
-            for label in all_deps[str(item['id'])].split(DEPS_SEPARATOR):
+            for label in deps_tree.get_path(item['id']).split(DEPS_SEPARATOR):
                 logger.info(f"Name + {count}    : {label}")
                 count += 1
             logger.info(f"label       : {item['label']}")
@@ -4180,77 +5344,112 @@ def download_users_attrib_to_file_prompt(settings: "SettingParams"):
     find_users_prompt(settings)
 
 
-def wildcard_match(text: str, pattern: str) -> bool:
+def _match_wildcard_parts(text: str, parts: list, start: int, end: int) -> bool:
+    # Проверяет, что части паттерна встречаются в text[start:end] по порядку
+    for part in parts:
+        pos = text.find(part, start, end)
+        if pos < 0:
+            return False
+        start = pos + len(part)
+    return True
+
+
+@lru_cache(maxsize=256)
+def compile_wildcard_match(pattern: str):
     """
-    Проверяет, соответствует ли текст паттерну с поддержкой wildcards (*).
-    
+    Компилирует паттерн с поддержкой wildcards (*) в функцию проверки соответствия.
+    Паттерн приводится к нижнему регистру один раз, проверяемый текст должен быть уже в нижнем регистре.
+    Скомпилированные паттерны кэшируются: повторный вызов с тем же паттерном не создает новую функцию.
+
     Args:
-        text: Текст для проверки
-        pattern: Паттерн для сопоставления (может содержать * в начале или конце)
-    
+        pattern: Паттерн для сопоставления (* в начале, в конце или в середине: iva*, *nov, *петр*, iv*ov)
+
     Returns:
-        True если текст соответствует паттерну, иначе False
+        Функция text -> bool
     """
-    text = text.lower()
     pattern = pattern.lower().strip()
-    
+
     # Если нет wildcards, используем точное совпадение
     if '*' not in pattern:
-        return text == pattern
-    
+        return lambda text: text == pattern
+
+    parts = pattern.split('*')
+    prefix, middle, suffix = parts[0], [part for part in parts[1:-1] if part], parts[-1]
+
     # Паттерн начинается и заканчивается wildcard: *pattern*
-    if pattern.startswith('*') and pattern.endswith('*'):
-        core = pattern[1:-1]
-        return core in text
-    
+    if not prefix and not suffix and len(middle) == 1:
+        core = middle[0]
+        return lambda text: core in text
+
     # Паттерн начинается с wildcard: *pattern
-    if pattern.startswith('*'):
-        core = pattern[1:]
-        return text.endswith(core)
-    
+    if not prefix and not middle:
+        return lambda text: text.endswith(suffix)
+
     # Паттерн заканчивается wildcard: pattern*
-    if pattern.endswith('*'):
-        core = pattern[:-1]
-        return text.startswith(core)
-    
-    # Если wildcard в середине (не поддерживается по требованиям)
-    return False
+    if not suffix and not middle:
+        return lambda text: text.startswith(prefix)
+
+    # Wildcard в середине: начало, конец и промежуточные части по порядку
+    min_length = len(prefix) + len(suffix)
+    return lambda text: (len(text) >= min_length and text.startswith(prefix) and text.endswith(suffix)
+                         and _match_wildcard_parts(text, middle, len(prefix), len(text) - len(suffix)))
+
+
+@lru_cache(maxsize=256)
+def compile_wildcard_contains(pattern: str):
+    """
+    Компилирует паттерн с поддержкой wildcards (*) в функцию поиска подстроки.
+    Паттерн приводится к нижнему регистру один раз, проверяемый текст должен быть уже в нижнем регистре.
+    Скомпилированные паттерны кэшируются: повторный вызов с тем же паттерном не создает новую функцию.
+
+    Args:
+        pattern: Паттерн для сопоставления (* в начале или конце не влияет на поиск подстроки,
+            * в середине - любые символы между частями: ив*ов)
+
+    Returns:
+        Функция text -> bool
+    """
+    pattern = pattern.lower().strip()
+
+    # Если нет wildcards, используем простой поиск подстроки
+    if '*' not in pattern:
+        return lambda text: pattern in text
+
+    parts = [part for part in pattern.split('*') if part]
+    if len(parts) == 1:
+        core = parts[0]
+        return lambda text: core in text
+
+    # Wildcard в середине: части паттерна по порядку в любом месте текста
+    return lambda text: _match_wildcard_parts(text, parts, 0, len(text))
+
+
+def wildcard_match(text: str, pattern: str) -> bool:
+    """
+    Проверяет, соответствует ли текст паттерну с поддержкой wildcards (*).
+
+    Args:
+        text: Текст для проверки
+        pattern: Паттерн для сопоставления (может содержать * в начале или конце)
+
+    Returns:
+        True если текст соответствует паттерну, иначе False
+    """
+    return compile_wildcard_match(pattern)(text.lower())
 
 
 def wildcard_contains(text: str, pattern: str) -> bool:
     """
     Проверяет, содержится ли паттерн в тексте с поддержкой wildcards.
-    
+
     Args:
         text: Текст для проверки
         pattern: Паттерн для сопоставления (может содержать * в начале или конце)
-    
+
     Returns:
         True если паттерн найден в тексте, иначе False
     """
-    text = text.lower()
-    pattern = pattern.lower().strip()
-    
-    # Если нет wildcards, используем простой поиск подстроки
-    if '*' not in pattern:
-        return pattern in text
-    
-    # Паттерн начинается и заканчивается wildcard: *pattern*
-    if pattern.startswith('*') and pattern.endswith('*'):
-        core = pattern[1:-1]
-        return core in text
-    
-    # Паттерн начинается с wildcard: *pattern
-    if pattern.startswith('*'):
-        core = pattern[1:]
-        return core in text
-    
-    # Паттерн заканчивается wildcard: pattern*
-    if pattern.endswith('*'):
-        core = pattern[:-1]
-        return core in text
-    
-    return False
+    return compile_wildcard_contains(pattern)(text.lower())
 
 
 def load_search_aliases(settings: "SettingParams") -> dict:
@@ -4369,6 +5568,141 @@ def load_search_aliases(settings: "SettingParams") -> dict:
         raise
 
 
+# Встроенные алиасы поисковых атрибутов (резервные для алиасов из файла SEARCH_ALIASES_FILE)
+# Формат: {alias: (real_attr, invert, contact_type, data_type)}
+SEARCH_BUILTIN_ALIASES = {
+    # name.first алиасы
+    'first_name': ('name.first', False, None, None),
+    'имя': ('name.first', False, None, None),
+    'first': ('name.first', False, None, None),
+
+    # name.last алиасы
+    'last_name': ('name.last', False, None, None),
+    'фамилия': ('name.last', False, None, None),
+    'last': ('name.last', False, None, None),
+
+    # name.middle алиасы
+    'middle_name': ('name.middle', False, None, None),
+    'отчество': ('name.middle', False, None, None),
+    'middle': ('name.middle', False, None, None),
+
+    # isAdmin алиасы
+    'admin': ('isAdmin', False, None, None),
+    'админ': ('isAdmin', False, None, None),
+    'is_admin': ('isAdmin', False, None, None),
+
+    # isEnabled алиасы
+    'enabled': ('isEnabled', False, None, None),
+    'is_enabled': ('isEnabled', False, None, None),
+
+    # isEnabled алиасы с инверсией (заблокирован = NOT isEnabled)
+    'blocked': ('isEnabled', True, None, None),
+    'заблокирован': ('isEnabled', True, None, None),
+
+    # position алиасы
+    'должность': ('position', False, None, None),
+
+    # department алиасы
+    'department': ('department', False, None, None),
+    'подразделение': ('department', False, None, None),
+    'ou': ('department', False, None, None),
+    'dep': ('department', False, None, None),
+
+    # nickname алиасы
+    'алиас': ('nickname', False, None, None),
+
+    # aliases алиасы (массив алиасов)
+    'aliases': ('aliases', False, None, 'array'),
+    'алиасы': ('aliases', False, None, 'array'),
+
+    # contacts - phone алиасы
+    'телефон': ('contacts', False, 'phone', None),
+    'phone': ('contacts', False, 'phone', None),
+    'work_phone': ('contacts', False, 'phone', None),
+    'mobile_phone': ('contacts', False, 'phone', None),
+
+    # contacts - email алиасы
+    'почта': ('contacts', False, 'email', None),
+    'mail': ('contacts', False, 'email', None),
+    'email': ('contacts', False, 'email', None),
+
+    # date атрибуты - createdAt
+    'created': ('createdAt', False, None, 'date'),
+    'создан': ('createdAt', False, None, 'date'),
+
+    # date атрибуты - isEnabledUpdatedAt
+    'дата_блокировки': ('isEnabledUpdatedAt', False, None, 'date'),
+
+    # date атрибуты - updatedAt
+    'updated': ('updatedAt', False, None, 'date'),
+    'изменен': ('updatedAt', False, None, 'date'),
+
+    # group атрибуты - имя группы
+    'groupname': ('full_groups.name', False, None, None),
+    'group_name': ('full_groups.name', False, None, None),
+    'имя_группы': ('full_groups.name', False, None, None),
+
+    # group атрибуты - алиасы группы (поиск по group.aliases и group.label)
+    'groupaliases': ('full_groups.aliases', False, 'group_aliases', 'array'),
+    'group_aliases': ('full_groups.aliases', False, 'group_aliases', 'array'),
+    'алиасы_группы': ('full_groups.aliases', False, 'group_aliases', 'array'),
+}
+
+# Допустимые реальные имена атрибутов из API Yandex 360 (в нижнем регистре): {attr: (contact_type, data_type)}
+SEARCH_VALID_REAL_ATTRIBUTES = {
+    # Основные атрибуты
+    'id': (None, None),
+    'nickname': (None, None),
+    'aliases': (None, 'array'),  # массив алиасов
+    'name.first': (None, None),
+    'name.last': (None, None),
+    'name.middle': (None, None),
+    'isadmin': (None, None),
+    'isenabled': (None, None),
+    'position': (None, None),
+    'department': (None, None),
+    'departmentid': (None, None),
+    'gender': (None, None),
+    'language': (None, None),
+    'timezone': (None, None),
+    'about': (None, None),
+    'birthday': (None, None),
+    'contacts': (None, None),
+
+    # Атрибуты группы
+    'full_groups.aliases': ('full_groups.aliases', 'array'),  # массив алиасов группы
+    'full_groups.label': (None, None),  # label группы (строка)
+    'full_groups.name': (None, None),  # имя группы
+
+    # Атрибуты дат
+    'createdat': (None, 'date'),
+    'updatedat': (None, 'date'),
+    'isenabledupdatedat': (None, 'date'),  # правильное имя
+}
+
+# Маппинг для нормализации регистра ключевых атрибутов
+SEARCH_ATTRIBUTES_CASE_NORMALIZATION = {
+    'isadmin': 'isAdmin',
+    'isenabled': 'isEnabled',
+    'createdat': 'createdAt',
+    'updatedat': 'updatedAt',
+    'isenabledupdatedat': 'isEnabledUpdatedAt',
+    'departmentid': 'departmentId',
+}
+
+# Форматы дат, поддерживаемые в условиях поиска и в атрибутах пользователей
+SEARCH_DATE_FORMATS = (
+    '%d.%m.%Y',  # DD.MM.YYYY
+    '%d/%m/%Y',  # DD/MM/YYYY
+    '%d-%m-%Y',  # DD-MM-YYYY
+    '%Y-%m-%d',  # YYYY-MM-DD (ISO формат)
+    '%Y/%m/%d',  # YYYY/MM/DD
+    '%m/%d/%Y',  # MM/DD/YYYY (US формат)
+    '%d.%m.%y',  # DD.MM.YY
+    '%Y.%m.%d',  # YYYY.MM.DD
+)
+
+
 def normalize_attribute_name(attr_alias: str, settings: "SettingParams" = None) -> tuple:
     """
     Преобразует алиас атрибута в его реальное имя с флагом инверсии, типом контакта и типом данных.
@@ -4392,142 +5726,20 @@ def normalize_attribute_name(attr_alias: str, settings: "SettingParams" = None)
         except Exception as e:
             logger.warning(f"Не удалось загрузить алиасы из файла: {e}. Используются встроенные алиасы.")
     
-    # Встроенные алиасы атрибутов (используются как резервные)
-    builtin_aliases = {
-        # name.first алиасы
-        'first_name': ('name.first', False, None, None),
-        'имя': ('name.first', False, None, None),
-        'first': ('name.first', False, None, None),
-        
-        # name.last алиасы
-        'last_name': ('name.last', False, None, None),
-        'фамилия': ('name.last', False, None, None),
-        'last': ('name.last', False, None, None),
-        
-        # name.middle алиасы
-        'middle_name': ('name.middle', False, None, None),
-        'отчество': ('name.middle', False, None, None),
-        'middle': ('name.middle', False, None, None),
-        
-        # isAdmin алиасы
-        'admin': ('isAdmin', False, None, None),
-        'админ': ('isAdmin', False, None, None),
-        'is_admin': ('isAdmin', False, None, None),
-        
-        # isEnabled алиасы
-        'enabled': ('isEnabled', False, None, None),
-        'is_enabled': ('isEnabled', False, None, None),
-        
-        # isEnabled алиасы с инверсией (заблокирован = NOT isEnabled)
-        'blocked': ('isEnabled', True, None, None),
-        'заблокирован': ('isEnabled', True, None, None),
-        
-        # position алиасы
-        'должность': ('position', False, None, None),
-        
-        # department алиасы
-        'department': ('department', False, None, None),
-        'подразделение': ('department', False, None, None),
-        'ou': ('department', False, None, None),
-        'dep': ('department', False, None, None),
-        
-        # nickname алиасы
-        'алиас': ('nickname', False, None, None),
-        
-        # aliases алиасы (массив алиасов)
-        'aliases': ('aliases', False, None, 'array'),
-        'алиасы': ('aliases', False, None, 'array'),
-        
-        # contacts - phone алиасы
-        'телефон': ('contacts', False, 'phone', None),
-        'phone': ('contacts', False, 'phone', None),
-        'work_phone': ('contacts', False, 'phone', None),
-        'mobile_phone': ('contacts', False, 'phone', None),
-        
-        # contacts - email алиасы
-        'почта': ('contacts', False, 'email', None),
-        'mail': ('contacts', False, 'email', None),
-        'email': ('contacts', False, 'email', None),
-        
-        # date атрибуты - createdAt
-        'created': ('createdAt', False, None, 'date'),
-        'создан': ('createdAt', False, None, 'date'),
-        
-        # date атрибуты - isEnabledUpdatedAt
-        'дата_блокировки': ('isEnabledUpdatedAt', False, None, 'date'),
-        
-        # date атрибуты - updatedAt
-        'updated': ('updatedAt', False, None, 'date'),
-        'изменен': ('updatedAt', False, None, 'date'),
-        
-        # group атрибуты - имя группы
-        'groupname': ('full_groups.name', False, None, None),
-        'group_name': ('full_groups.name', False, None, None),
-        'имя_группы': ('full_groups.name', False, None, None),
-        
-        # group атрибуты - алиасы группы (поиск по group.aliases и group.label)
-        'groupaliases': ('full_groups.aliases', False, 'group_aliases', 'array'),
-        'group_aliases': ('full_groups.aliases', False, 'group_aliases', 'array'),
-        'алиасы_группы': ('full_groups.aliases', False, 'group_aliases', 'array'),
-    }
-    
-    # Объединяем загруженные и встроенные алиасы (загруженные имеют приоритет)
-    aliases = {**builtin_aliases, **loaded_aliases}
-    
-    # Список допустимых реальных имен атрибутов из API Yandex 360
-    valid_real_attributes = {
-        # Основные атрибуты
-        'id': (None, None),
-        'nickname': (None, None),
-        'aliases': (None, 'array'),  # массив алиасов
-        'name.first': (None, None),
-        'name.last': (None, None),
-        'name.middle': (None, None),
-        'isadmin': (None, None),
-        'isenabled': (None, None),
-        'position': (None, None),
-        'department': (None, None),
-        'departmentid': (None, None),
-        'gender': (None, None),
-        'language': (None, None),
-        'timezone': (None, None),
-        'about': (None, None),
-        'birthday': (None, None),
-        'contacts': (None, None),
-        
-        # Атрибуты группы
-        'full_groups.aliases': ('full_groups.aliases', 'array'),  # массив алиасов группы
-        'full_groups.label': (None, None),  # label группы (строка)
-        'full_groups.name': (None, None),  # имя группы
-        
-        # Атрибуты дат
-        'createdat': (None, 'date'),
-        'updatedat': (None, 'date'),
-        'isenabledupdatedat': (None, 'date'),  # правильное имя
-    }
-    
-    # Маппинг для нормализации регистра ключевых атрибутов
-    case_normalization = {
-        'isadmin': 'isAdmin',
-        'isenabled': 'isEnabled',
-        'createdat': 'createdAt',
-        'updatedat': 'updatedAt',
-        'isenabledupdatedat': 'isEnabledUpdatedAt',
-        'departmentid': 'departmentId',
-    }
-    
     # Приводим к нижнему регистру для поиска
     attr_lower = attr_alias.lower().strip()
     
-    # Если это алиас, возвращаем реальное имя с флагами
-    if attr_lower in aliases:
-        return aliases[attr_lower]
+    # Если это алиас, возвращаем реальное имя с флагами (алиасы из файла имеют приоритет над встроенными)
+    if attr_lower in loaded_aliases:
+        return loaded_aliases[attr_lower]
+    if attr_lower in SEARCH_BUILTIN_ALIASES:
+        return SEARCH_BUILTIN_ALIASES[attr_lower]
     
     # Проверяем, является ли это реальным именем атрибута
-    if attr_lower in valid_real_attributes:
-        contact_type, data_type = valid_real_attributes[attr_lower]
+    if attr_lower in SEARCH_VALID_REAL_ATTRIBUTES:
+        contact_type, data_type = SEARCH_VALID_REAL_ATTRIBUTES[attr_lower]
         # Нормализуем регистр для ключевых атрибутов
-        normalized_attr = case_normalization.get(attr_lower, attr_alias)
+        normalized_attr = SEARCH_ATTRIBUTES_CASE_NORMALIZATION.get(attr_lower, attr_alias)
         return (normalized_attr, False, contact_type, data_type)
     
     # Атрибут не найден - возбуждаем исключение
@@ -4594,164 +5806,169 @@ def parse_relative_date(value: str):
 def parse_date_value(value: str):
     """
     Парсит значение даты - может быть относительная дата или различные форматы.
-    
+
     Поддерживает форматы:
     - Относительные: -7d, 30д, 2w, -1м
     - DD.MM.YYYY, DD/MM/YYYY, DD-MM-YYYY
     - YYYY-MM-DD, YYYY/MM/DD
     - MM/DD/YYYY, DD.MM.YY, YYYY.MM.DD
     - ISO формат с временем: YYYY-MM-DDTHH:MM:SSZ
-    
+
     Args:
         value: Строка с датой
-    
+
     Returns:
         datetime объект или None
     """
-    from datetime import datetime
-    
     # Сначала пробуем относительную дату
     relative = parse_relative_date(value)
     if relative:
         return relative
-    
-    # Набор возможных форматов для проверки
-    date_formats = [
-        '%d.%m.%Y',  # DD.MM.YYYY
-        '%d/%m/%Y',  # DD/MM/YYYY
-        '%d-%m-%Y',  # DD-MM-YYYY
-        '%Y-%m-%d',  # YYYY-MM-DD (ISO формат)
-        '%Y/%m/%d',  # YYYY/MM/DD
-        '%m/%d/%Y',  # MM/DD/YYYY (US формат)
-        '%d.%m.%y',  # DD.MM.YY
-        '%Y.%m.%d',  # YYYY.MM.DD
-    ]
-    
+
     # Попытка парсинга каждым из форматов
-    for date_format in date_formats:
+    for date_format in SEARCH_DATE_FORMATS:
         try:
             return datetime.strptime(value, date_format)
         except:
             pass
-    
+
     # Пробуем ISO формат с временем
     try:
         if 'T' in value:
             return datetime.fromisoformat(value.replace('Z', '+00:00'))
     except:
         pass
-    
+
     return None
 
 
-def compare_dates(date1_str: str, operator: str, date2_str: str) -> bool:
+@lru_cache(maxsize=65536)
+def parse_attribute_date(date_str: str, date_formats: tuple = SEARCH_DATE_FORMATS):
     """
-    Сравнивает две даты с учетом оператора.
-    
+    Парсит дату из атрибута пользователя (createdAt, birthday и т.п.) и убирает timezone.
+    Результат кэшируется: у разных пользователей часто совпадают значения дат, а при поиске
+    одна и та же дата проверяется многократно.
+
     Args:
-        date1_str: Первая дата (строка в различных форматах)
-        operator: Оператор сравнения (<, >, <=, >=, =)
-        date2_str: Вторая дата (может быть относительной)
-    
+        date_str: Строка с датой (ISO формат с временем или один из date_formats)
+        date_formats: Допустимые форматы даты без времени
+
     Returns:
-        True если условие выполняется, иначе False
+        datetime объект без timezone или None
     """
-    from datetime import datetime
-    
-    # Парсим первую дату (из API или других источников)
-    date_formats = [
-        '%d.%m.%Y',  # DD.MM.YYYY
-        '%d/%m/%Y',  # DD/MM/YYYY
-        '%d-%m-%Y',  # DD-MM-YYYY
-        '%Y-%m-%d',  # YYYY-MM-DD (ISO формат)
-        '%Y/%m/%d',  # YYYY/MM/DD
-        '%m/%d/%Y',  # MM/DD/YYYY (US формат)
-        '%d.%m.%y',  # DD.MM.YY
-        '%Y.%m.%d',  # YYYY.MM.DD
-    ]
-    
-    date1 = None
-    
+    date_value = None
+
     # Пробуем ISO формат с временем
     try:
-        if 'T' in date1_str:
-            date1 = datetime.fromisoformat(date1_str.replace('Z', '+00:00'))
+        if 'T' in date_str:
+            date_value = datetime.fromisoformat(date_str.replace('Z', '+00:00'))
     except:
         pass
-    
+
     # Если не удалось, пробуем другие форматы
-    if not date1:
+    if not date_value:
         for date_format in date_formats:
             try:
-                date1 = datetime.strptime(date1_str, date_format)
+                date_value = datetime.strptime(date_str, date_format)
                 break
             except:
                 pass
-    
+
+    if date_value and date_value.tzinfo:
+        date_value = date_value.replace(tzinfo=None)
+    return date_value
+
+
+# Операторы сравнения дат: для равенства сравниваются только даты, время игнорируется
+DATE_COMPARISON_OPERATORS = {
+    '<': lambda date1, date2: date1 < date2,
+    '>': lambda date1, date2: date1 > date2,
+    '<=': lambda date1, date2: date1 <= date2,
+    '>=': lambda date1, date2: date1 >= date2,
+    '=': lambda date1, date2: date1.date() == date2.date(),
+    'is': lambda date1, date2: date1.date() == date2.date(),
+}
+
+
+def compare_dates(date1_str: str, operator: str, date2_str: str) -> bool:
+    """
+    Сравнивает две даты с учетом оператора.
+
+    Args:
+        date1_str: Первая дата (строка в различных форматах)
+        operator: Оператор сравнения (<, >, <=, >=, =)
+        date2_str: Вторая дата (может быть относительной)
+
+    Returns:
+        True если условие выполняется, иначе False
+    """
+    # Парсим первую дату (из API или других источников)
+    date1 = parse_attribute_date(date1_str)
     if not date1:
         return False
-    
+
     # Парсим вторую дату (из запроса)
     date2 = parse_date_value(date2_str)
     if not date2:
         return False
-    
+
     # Убираем timezone для сравнения
-    if date1.tzinfo:
-        date1 = date1.replace(tzinfo=None)
     if date2.tzinfo:
         date2 = date2.replace(tzinfo=None)
-    
+
     # Выполняем сравнение
-    if operator == '<':
-        return date1 < date2
-    elif operator == '>':
-        return date1 > date2
-    elif operator == '<=':
-        return date1 <= date2
-    elif operator == '>=':
-        return date1 >= date2
-    elif operator in ['=', 'is']:
-        # Для равенства сравниваем только даты, игнорируя время
-        return date1.date() == date2.date()
-    
-    return False
+    compare = DATE_COMPARISON_OPERATORS.get(operator)
+    return compare(date1, date2) if compare else False
 
 
-def get_user_attribute(user: dict, attr_path: str):
+def compile_attribute_getter(attr_path: str):
     """
-    Получает значение атрибута пользователя по пути (например, name.first).
-    Поиск атрибутов выполняется без учета регистра.
-    
+    Компилирует путь к атрибуту (например, name.first) в функцию получения значения из пользователя.
+    Поиск атрибутов выполняется без учета регистра; точное совпадение имени ключа проверяется первым.
+
     Args:
-        user: Объект пользователя
         attr_path: Путь к атрибуту (например, 'name.first', 'nickname', 'isAdmin')
-    
+
     Returns:
-        Значение атрибута или None если атрибут не найден
+        Функция user -> значение атрибута или None если атрибут не найден
     """
-    parts = attr_path.split('.')
-    value = user
-    
-    for part in parts:
-        if isinstance(value, dict):
+    parts = [(part, part.lower()) for part in attr_path.split('.')]
+
+    def getter(user: dict):
+        value = user
+        for part, part_lower in parts:
+            if not isinstance(value, USER_MAPPING_TYPES):
+                return None
+            try:
+                value = value[part]
+                continue
+            except KeyError:
+                pass
             # Поиск атрибута без учета регистра
-            part_lower = part.lower()
-            found_key = None
-            
             for key in value.keys():
                 if key.lower() == part_lower:
-                    found_key = key
+                    value = value[key]
                     break
-            
-            if found_key is not None:
-                value = value[found_key]
             else:
                 return None
-        else:
-            return None
-    
-    return value
+        return value
+
+    return getter
+
+
+def get_user_attribute(user: dict, attr_path: str):
+    """
+    Получает значение атрибута пользователя по пути (например, name.first).
+    Поиск атрибутов выполняется без учета регистра.
+
+    Args:
+        user: Объект пользователя
+        attr_path: Путь к атрибуту (например, 'name.first', 'nickname', 'isAdmin')
+
+    Returns:
+        Значение атрибута или None если атрибут не найден
+    """
+    return compile_attribute_getter(attr_path)(user)
 
 
 def is_complex_query(query: str) -> bool:
@@ -4826,345 +6043,313 @@ def parse_complex_query(query: str):
     return tokens
 
 
-def evaluate_condition(user: dict, attribute: str, operator: str, value: str, contact_type: str = None, data_type: str = None) -> bool:
+def _compile_text_matcher(operator_lower: str, value_lower: str, in_values: str):
     """
-    Оценивает одно условие для пользователя.
-    
+    Компилирует оператор сравнения строк (=, is, contains, in) в функцию text -> bool.
+    Проверяемый текст должен быть уже в нижнем регистре.
+
+    Args:
+        operator_lower: Оператор в нижнем регистре
+        value_lower: Значение для сравнения в нижнем регистре (может содержать wildcards)
+        in_values: Исходная строка значений через запятую для оператора in
+
+    Returns:
+        Функция text -> bool или None для неподдерживаемого оператора
+    """
+    if operator_lower in ['=', 'is']:
+        return compile_wildcard_match(value_lower)
+    if operator_lower == 'contains':
+        return compile_wildcard_contains(value_lower)
+    if operator_lower == 'in':
+        values = {v.strip().strip('"').strip("'").lower() for v in in_values.split(',')}
+        return values.__contains__
+    return None
+
+
+def compile_condition(attribute: str, operator: str, value: str, contact_type: str = None, data_type: str = None):
+    """
+    Компилирует одно условие поиска в функцию-предикат user -> bool.
+    Все преобразования значения из запроса (удаление кавычек, приведение к нижнему регистру,
+    разбор дат и wildcards) выполняются один раз при компиляции, а не для каждого пользователя.
+
     Args:
-        user: Объект пользователя
         attribute: Атрибут для проверки
         operator: Оператор сравнения (=, is, contains, in, not, has_value, <, >, <=, >=, between)
         value: Значение для сравнения
         contact_type: Тип контакта для поиска в contacts ('phone', 'email') или 'group_aliases' для поиска в группах
         data_type: Тип данных атрибута ('date' для дат, 'array' для массивов)
-    
+
     Returns:
-        True если условие выполняется, иначе False
-    
+        Функция user -> bool
+
     Notes:
         - Для атрибутов full_groups.* (name, label, aliases) выполняется поиск по всем группам пользователя
         - Пользователь может быть в нескольких группах, условие считается выполненным, если хотя бы одна группа соответствует критерию
     """
+    never = lambda user: False
+
     # Специальная обработка для массивов (например, aliases, group.aliases)
     if data_type == 'array':
         # Специальная обработка для full_groups.aliases - также проверяем full_groups.label
         if contact_type == 'group_aliases':
-            full_groups = user.get('full_groups')
-            if not full_groups:
-                return False
-            
-            # Проверяем, что это список
-            if not isinstance(full_groups, list):
-                return False
-            
             # has_value для full_groups.aliases - проверяем наличие хотя бы одной группы
             if operator == 'has_value':
-                return len(full_groups) > 0
-            
+                def has_groups(user):
+                    full_groups = user.get('full_groups')
+                    return bool(full_groups) and isinstance(full_groups, list)
+                return has_groups
+
             # Очищаем значение от кавычек
-            search_value = value.strip('"').strip("'")
-            search_str = search_value.lower()
+            search_str = value.strip('"').strip("'").lower()
             operator_lower = operator.lower()
-            
-            # Перебираем все группы пользователя
-            for group in full_groups:
-                if not isinstance(group, dict):
-                    continue
-                
-                # Собираем все значения для поиска из текущей группы: aliases (массив) + label (строка)
-                search_values = []
-                
-                # Добавляем aliases из group['aliases'] (если это массив)
-                group_aliases = group.get('aliases', [])
-                if isinstance(group_aliases, list):
-                    search_values.extend([str(alias).lower() for alias in group_aliases])
-                elif group_aliases:
-                    search_values.append(str(group_aliases).lower())
-                
-                # Добавляем label из group['label']
-                group_label = group.get('label')
-                if group_label:
-                    search_values.append(str(group_label).lower())
-                
-                # Проверяем каждое значение в текущей группе
-                for search_val in search_values:
-                    if operator_lower in ['=', 'is']:
-                        if '*' in search_str:
-                            if wildcard_match(search_val, search_str):
-                                return True
-                        else:
-                            if search_val == search_str:
-                                return True
-                    elif operator_lower == 'contains':
-                        if '*' in search_str:
-                            if wildcard_contains(search_val, search_str):
-                                return True
-                        else:
-                            if search_str in search_val:
-                                return True
-                    elif operator_lower == 'in':
-                        values = [v.strip().strip('"').strip("'").lower() for v in value.split(',')]
-                        if search_val in values:
+
+            if operator_lower in ['=', 'is']:
+                matcher = compile_wildcard_match(search_str) if '*' in search_str else search_str.__eq__
+            elif operator_lower == 'contains':
+                matcher = compile_wildcard_contains(search_str) if '*' in search_str else (lambda text: search_str in text)
+            elif operator_lower == 'in':
+                matcher = {v.strip().strip('"').strip("'").lower() for v in value.split(',')}.__contains__
+            else:
+                return never
+
+            def match_group_aliases(user):
+                full_groups = user.get('full_groups')
+                if not full_groups or not isinstance(full_groups, list):
+                    return False
+
+                # Перебираем все группы пользователя: aliases (массив) + label (строка)
+                for group in full_groups:
+                    if not isinstance(group, dict):
+                        continue
+
+                    group_aliases = group.get('aliases', [])
+                    if isinstance(group_aliases, list):
+                        if any(matcher(str(alias).lower()) for alias in group_aliases):
                             return True
-            
-            return False
-        
+                    elif group_aliases and matcher(str(group_aliases).lower()):
+                        return True
+
+                    group_label = group.get('label')
+                    if group_label and matcher(str(group_label).lower()):
+                        return True
+
+                return False
+
+            return match_group_aliases
+
         # Обычная обработка массивов (aliases и т.д.)
-        attr_value = get_user_attribute(user, attribute)
-        
-        if attr_value is None:
-            return False
-        
-        # Если это не список, преобразуем в список
-        if not isinstance(attr_value, list):
-            return False
-        
+        getter = compile_attribute_getter(attribute)
+
         # has_value для массивов - проверяем, что массив не пустой
         if operator == 'has_value':
-            return len(attr_value) > 0
-        
+            def has_items(user):
+                attr_value = getter(user)
+                return isinstance(attr_value, list) and len(attr_value) > 0
+            return has_items
+
         # Операторы = и contains для массивов - ищут элемент в массиве
-        if operator in ['=', 'is', 'contains']:
-            # Очищаем значение от кавычек
-            search_value = value.strip('"').strip("'")
-            
-            # Проверяем каждый элемент массива
-            for item in attr_value:
-                item_str = str(item).lower()
-                search_str = search_value.lower()
-                
-                # Если есть wildcard, используем wildcard_match
-                if '*' in search_str:
-                    if wildcard_match(item_str, search_str):
-                        return True
-                else:
-                    # Точное совпадение
-                    if item_str == search_str:
-                        return True
-            
-            return False
-        
-        return False
-    
+        if operator not in ['=', 'is', 'contains']:
+            return never
+
+        # Очищаем значение от кавычек; если есть wildcard, используем wildcard_match, иначе точное совпадение
+        search_str = value.strip('"').strip("'").lower()
+        matcher = compile_wildcard_match(search_str) if '*' in search_str else search_str.__eq__
+
+        def match_array(user):
+            attr_value = getter(user)
+            if not isinstance(attr_value, list):
+                return False
+            return any(matcher(str(item).lower()) for item in attr_value)
+
+        return match_array
+
     # Специальная обработка для дат
     if data_type == 'date':
-        attr_value = get_user_attribute(user, attribute)
-        
-        logger.debug(f"Проверка даты: атрибут={attribute}, значение={attr_value}, оператор={operator}, сравнение_с={value}")
-        
-        if attr_value is None or not attr_value:
-            return False
-        
+        getter = compile_attribute_getter(attribute)
+        logger.debug(f"Проверка даты: атрибут={attribute}, оператор={operator}, сравнение_с={value}")
+
         # has_value для дат - проверяем, что дата существует
         if operator == 'has_value':
-            return True
-        
+            return lambda user: bool(getter(user))
+
         # Операторы сравнения дат
         if operator in ['<', '>', '<=', '>=', '=', 'is']:
-            result = compare_dates(str(attr_value), operator, value)
-            logger.debug(f"Результат сравнения дат: {result}")
-            return result
-        
+            compare = DATE_COMPARISON_OPERATORS[operator]
+            query_date = parse_date_value(value)
+            if not query_date:
+                return never
+            if query_date.tzinfo:
+                query_date = query_date.replace(tzinfo=None)
+
+            def match_date(user):
+                attr_value = getter(user)
+                if not attr_value:
+                    return False
+                attr_date = parse_attribute_date(str(attr_value))
+                return bool(attr_date) and compare(attr_date, query_date)
+
+            return match_date
+
         # Оператор between для дат
         if operator == 'between':
             # Ожидаем формат: "date1 date2" или "date1,date2"
             dates = value.replace(',', ' ').split()
-            if len(dates) >= 2:
-                date1 = parse_date_value(dates[0])
-                date2 = parse_date_value(dates[1])
-                
-                if date1 and date2:
-                    from datetime import datetime
-                    try:
-                        if 'T' in str(attr_value):
-                            attr_date = datetime.fromisoformat(str(attr_value).replace('Z', '+00:00'))
-                        else:
-                            attr_date = datetime.strptime(str(attr_value), '%Y-%m-%d')
-                        
-                        if attr_date.tzinfo:
-                            attr_date = attr_date.replace(tzinfo=None)
-                        if date1.tzinfo:
-                            date1 = date1.replace(tzinfo=None)
-                        if date2.tzinfo:
-                            date2 = date2.replace(tzinfo=None)
-                        
-                        return date1 <= attr_date <= date2
-                    except:
-                        pass
-            
-            return False
-        
-        return False
-    
+            if len(dates) < 2:
+                return never
+            date1 = parse_date_value(dates[0])
+            date2 = parse_date_value(dates[1])
+            if not date1 or not date2:
+                return never
+            if date1.tzinfo:
+                date1 = date1.replace(tzinfo=None)
+            if date2.tzinfo:
+                date2 = date2.replace(tzinfo=None)
+
+            def match_date_between(user):
+                attr_value = getter(user)
+                if not attr_value:
+                    return False
+                # Дата атрибута - ISO формат с временем или YYYY-MM-DD
+                attr_date = parse_attribute_date(str(attr_value), ('%Y-%m-%d',))
+                return bool(attr_date) and date1 <= attr_date <= date2
+
+            return match_date_between
+
+        return never
+
     # Специальная обработка для контактов
     if contact_type:
-        contacts = user.get('contacts', [])
-        if not contacts:
-            return False
-        
-        # Фильтруем контакты по типу
-        filtered_contacts = [c for c in contacts if c.get('type') == contact_type]
-        
-        if not filtered_contacts:
-            return False
-        
-        # Специальный оператор для проверки наличия контакта
-        if operator == 'has_value':
-            return len(filtered_contacts) > 0
-        
         # Убираем кавычки из значения
         value = value.strip().strip('"').strip("'")
-        value_lower = value.lower()
-        operator_lower = operator.lower()
-        
-        # Проверяем каждый контакт нужного типа
-        for contact in filtered_contacts:
-            contact_value = str(contact.get('value', '')).lower()
-            
-            if operator_lower in ['=', 'is']:
-                if wildcard_match(contact_value, value_lower):
-                    return True
-            elif operator_lower == 'contains':
-                if wildcard_contains(contact_value, value_lower):
-                    return True
-            elif operator_lower == 'in':
-                values = [v.strip().strip('"').strip("'").lower() for v in value.split(',')]
-                if contact_value in values:
+        if operator == 'has_value':
+            matcher = lambda contact_value: True
+        else:
+            matcher = _compile_text_matcher(operator.lower(), value.lower(), value)
+            if matcher is None:
+                return never
+
+        def match_contacts(user):
+            # Проверяем каждый контакт нужного типа
+            for contact in user.get('contacts', []) or []:
+                if contact.get('type') == contact_type and matcher(str(contact.get('value', '')).lower()):
                     return True
-        
-        return False
-    
+            return False
+
+        return match_contacts
+
     # Специальная обработка для full_groups.name и full_groups.label
     if attribute in ['full_groups.name', 'full_groups.label']:
-        full_groups = user.get('full_groups')
-        if not full_groups:
-            return False
-        
-        # Проверяем, что это список
-        if not isinstance(full_groups, list):
-            return False
-        
         # has_value - проверяем наличие хотя бы одной группы
         if operator == 'has_value':
-            return len(full_groups) > 0
-        
+            def has_groups(user):
+                full_groups = user.get('full_groups')
+                return bool(full_groups) and isinstance(full_groups, list)
+            return has_groups
+
         # Убираем кавычки из значения
         value = value.strip().strip('"').strip("'")
-        value_lower = value.lower()
-        operator_lower = operator.lower()
-        
+        matcher = _compile_text_matcher(operator.lower(), value.lower(), value)
+        if matcher is None:
+            return never
+
         # Определяем, какое поле проверяем
         field_name = attribute.split('.')[-1]  # 'name' или 'label'
-        
-        # Перебираем все группы пользователя
-        for group in full_groups:
-            if not isinstance(group, dict):
-                continue
-            
-            # Получаем значение поля из группы
-            field_value = group.get(field_name)
-            if not field_value:
-                continue
-            
-            attr_str = str(field_value).lower()
-            
-            # Операторы сравнения
-            if operator_lower in ['=', 'is']:
-                if wildcard_match(attr_str, value_lower):
-                    return True
-            elif operator_lower == 'contains':
-                if wildcard_contains(attr_str, value_lower):
-                    return True
-            elif operator_lower == 'in':
-                values = [v.strip().strip('"').strip("'").lower() for v in value.split(',')]
-                if attr_str in values:
+
+        def match_groups(user):
+            full_groups = user.get('full_groups')
+            if not full_groups or not isinstance(full_groups, list):
+                return False
+            # Перебираем все группы пользователя
+            for group in full_groups:
+                if not isinstance(group, dict):
+                    continue
+                field_value = group.get(field_name)
+                if field_value and matcher(str(field_value).lower()):
                     return True
-        
-        return False
-    
+            return False
+
+        return match_groups
+
     # Обычная обработка для не-контактов
-    attr_value = get_user_attribute(user, attribute)
-    
-    if attr_value is None:
-        return False
-    
+    getter = compile_attribute_getter(attribute)
+
     # Специальный оператор для проверки наличия значения
     if operator == 'has_value':
-        # Проверяем, что значение не пустое
-        if isinstance(attr_value, str):
-            return bool(attr_value.strip())
-        elif isinstance(attr_value, (list, dict)):
-            return len(attr_value) > 0
-        elif isinstance(attr_value, bool):
-            return True  # Boolean всегда имеет значение
-        elif isinstance(attr_value, (int, float)):
-            return True  # Числа всегда имеют значение
-        else:
-            return attr_value is not None
-    
+        def has_value(user):
+            attr_value = getter(user)
+            if attr_value is None:
+                return False
+            # Проверяем, что значение не пустое (boolean и числа всегда имеют значение)
+            if isinstance(attr_value, str):
+                return bool(attr_value.strip())
+            if isinstance(attr_value, (list, dict)):
+                return len(attr_value) > 0
+            return True
+        return has_value
+
     # Убираем кавычки из значения
     value = value.strip().strip('"').strip("'")
-    
+
     # Специальная обработка для атрибута department - удаляем все пробелы
-    if attribute.lower() == 'department':
-        if isinstance(attr_value, str):
-            attr_str = attr_value.replace(' ', '').lower()
-        else:
-            attr_str = str(attr_value).replace(' ', '').lower()
-        value_lower = value.replace(' ', '').lower()
-        operator_lower = operator.lower()
-    else:
+    is_department = attribute.lower() == 'department'
+    value_lower = value.replace(' ', '').lower() if is_department else value.lower()
+    matcher = _compile_text_matcher(operator.lower(), value_lower, value)
+    if matcher is None:
+        return never
+
+    def match_value(user):
+        attr_value = getter(user)
+        if attr_value is None:
+            return False
+
+        # Для списков проверяем каждый элемент
+        if isinstance(attr_value, list):
+            return any(matcher(str(item).lower()) for item in attr_value)
+
         # Преобразуем атрибут в строку для сравнения
-        if isinstance(attr_value, bool):
+        if is_department:
+            attr_str = str(attr_value).replace(' ', '').lower()
+        elif isinstance(attr_value, bool):
             attr_str = str(attr_value).lower()
         elif isinstance(attr_value, (int, float)):
             attr_str = str(attr_value)
-        elif isinstance(attr_value, list):
-            # Для списков проверяем каждый элемент
-            attr_str = None
-        else:
-            attr_str = str(attr_value).lower()
-        
-        value_lower = value.lower()
-        operator_lower = operator.lower()
-    
-    # Операторы сравнения
-    if operator_lower in ['=', 'is']:
-        if isinstance(attr_value, list):
-            # Для списков проверяем вхождение
-            return any(wildcard_match(str(item).lower(), value_lower) for item in attr_value)
         else:
-            return wildcard_match(attr_str, value_lower)
-    
-    elif operator_lower == 'contains':
-        if isinstance(attr_value, list):
-            # Для списков проверяем вхождение
-            return any(wildcard_contains(str(item).lower(), value_lower) for item in attr_value)
-        else:
-            return wildcard_contains(attr_str, value_lower)
-    
-    elif operator_lower == 'in':
-        # Проверка вхождения в список значений
-        values = [v.strip().strip('"').strip("'").lower() for v in value.split(',')]
-        if isinstance(attr_value, list):
-            return any(str(item).lower() in values for item in attr_value)
-        else:
-            return attr_str in values
-    
-    return False
+            attr_str = str(attr_value).lower()
+        return matcher(attr_str)
 
+    return match_value
 
-def execute_complex_query(users: list, query: str, settings: "SettingParams" = None) -> list:
+
+def evaluate_condition(user: dict, attribute: str, operator: str, value: str, contact_type: str = None, data_type: str = None) -> bool:
     """
-    Выполняет сложный запрос и возвращает список найденных пользователей.
+    Оценивает одно условие для пользователя.
+    Для проверки многих пользователей используйте compile_condition: условие компилируется один раз.
+
+    Args:
+        user: Объект пользователя
+        attribute: Атрибут для проверки
+        operator: Оператор сравнения (=, is, contains, in, not, has_value, <, >, <=, >=, between)
+        value: Значение для сравнения
+        contact_type: Тип контакта для поиска в contacts ('phone', 'email') или 'group_aliases' для поиска в группах
+        data_type: Тип данных атрибута ('date' для дат, 'array' для массивов)
+
+    Returns:
+        True если условие выполняется, иначе False
+    """
+    return compile_condition(attribute, operator, value, contact_type, data_type)(user)
+
+
+def parse_complex_query_conditions(query: str, settings: "SettingParams" = None):
+    """
+    Разбирает сложный запрос на список условий и логических операторов.
     
     Args:
-        users: Список всех пользователей
         query: Строка сложного запроса
         settings: Объект настроек приложения (опционально, для загрузки алиасов из файла)
     
     Returns:
-        Список пользователей, соответствующих запросу
+        Кортеж (условия, логические_операторы) или None, если в запросе неизвестный атрибут.
+        Условие - кортеж (атрибут, оператор, значение, инверсия, тип_контакта, тип_данных)
     """
     tokens = parse_complex_query(query)
     
@@ -5172,9 +6357,7 @@ def execute_complex_query(users: list, query: str, settings: "SettingParams" = N
     logger.debug(f"Токены: {tokens}")
     
     if not tokens:
-        return []
-    
-    result = []
+        return [], []
     
     # Список boolean атрибутов (в нормализованной форме)
     boolean_attrs = ['isAdmin', 'isEnabled']
@@ -5217,7 +6400,7 @@ def execute_complex_query(users: list, query: str, settings: "SettingParams" = N
             # Неизвестный атрибут
             logger.error(f"Ошибка в запросе: {str(e)}")
             print(f"\n❌ {str(e)}")
-            return []
+            return None
         
         # Проверяем, является ли это одиночным boolean атрибутом
         if current_attr in boolean_attrs:
@@ -5343,34 +6526,733 @@ def execute_complex_query(users: list, query: str, settings: "SettingParams" = N
     logger.debug(f"Созданные условия: {conditions}")
     logger.debug(f"Логические операторы: {logical_ops}")
     
-    # Оцениваем условия для каждого пользователя
-    for user in users:
-        if not conditions:
-            continue
-        
-        # Оцениваем первое условие
-        attr, op, val, negate, contact_type, data_type = conditions[0]
-        result_value = evaluate_condition(user, attr, op, val, contact_type, data_type)
-        if negate:
-            result_value = not result_value
-        
-        # Применяем остальные условия с логическими операторами
-        for idx, (attr, op, val, negate, contact_type, data_type) in enumerate(conditions[1:], start=0):
-            if idx < len(logical_ops):
-                logical_op = logical_ops[idx]
-                cond_result = evaluate_condition(user, attr, op, val, contact_type, data_type)
-                if negate:
-                    cond_result = not cond_result
-                
+    return conditions, logical_ops
+
+
+def _negate_predicate(predicate):
+    return lambda user: not predicate(user)
+
+
+def _and_predicates(left, right):
+    return lambda user: left(user) and right(user)
+
+
+def _or_predicates(left, right):
+    return lambda user: left(user) or right(user)
+
+
+def _member_predicate(user_ids: set):
+    return lambda user: id(user) in user_ids
+
+
+class CompiledQuery:
+    """
+    Скомпилированный сложный запрос (compile_complex_query).
+
+    Хранит условия запроса, логические операторы между ними и скомпилированные предикаты
+    условий (без учета инверсии). Вызов объекта с пользователем возвращает результат всего запроса.
+
+    Условия объединяются слева направо без приоритета: ((c1 op1 c2) op2 c3) ... Подряд идущие
+    условия с одним оператором образуют группу (tree): внутри группы порядок проверки не влияет
+    на результат, поэтому optimize() упорядочивает условия по стоимости и селективности так,
+    чтобы дешевые и отсекающие условия проверялись первыми, а проверка группы прекращалась
+    на первом решающем условии.
+
+    Args:
+        conditions: Условия - кортежи (атрибут, оператор, значение, инверсия, тип_контакта, тип_данных)
+        logical_ops: Логические операторы между условиями ('and', 'or')
+    """
+
+    # Селективность условия по умолчанию (доля подходящих пользователей), если нет индекса
+    DEFAULT_SELECTIVITY = {'=': 0.1, 'is': 0.1, 'in': 0.2, 'contains': 0.3, 'has_value': 0.9}
+
+    def __init__(self, conditions: list, logical_ops: list):
+        # Условия без логического оператора перед ними не учитываются
+        self.conditions = conditions[:len(logical_ops) + 1]
+        self.logical_ops = logical_ops[:len(self.conditions) - 1]
+        self.condition_predicates = [compile_condition(attr, op, val, contact_type, data_type)
+                                     for attr, op, val, negate, contact_type, data_type in self.conditions]
+
+        # Дерево запроса: индекс условия или (логический оператор, [дочерние узлы])
+        tree = 0
+        for idx in range(1, len(self.conditions)):
+            logical_op = self.logical_ops[idx - 1]
+            if logical_op not in ['and', 'or']:
+                continue
+            if isinstance(tree, tuple) and tree[0] == logical_op:
+                tree[1].append(idx)
+            else:
+                tree = (logical_op, [tree, idx])
+        self.tree = tree
+        # Результаты поиска условий по индексам (SearchIndex.find_candidates): (позиции, точно) или None
+        self.index_candidates = None
+        self.predicate = None
+        self.optimize()
+
+    def __call__(self, user: dict) -> bool:
+        return self.predicate(user)
+
+    @staticmethod
+    def estimate_condition_cost(condition: tuple) -> float:
+        """Относительная стоимость проверки условия для одного пользователя."""
+        attribute, operator, value, negate, contact_type, data_type = condition
+        if data_type == 'array' and contact_type == 'group_aliases':
+            cost = 8
+        elif data_type == 'array':
+            cost = 3
+        elif data_type == 'date':
+            cost = 2
+        elif contact_type:
+            cost = 3
+        elif attribute in ['full_groups.name', 'full_groups.label']:
+            cost = 4
+        elif attribute.lower() == 'department':
+            cost = 3
+        else:
+            cost = 1
+        if operator.lower() == 'contains' or '*' in value:
+            cost += 1
+        return cost
+
+    def estimate_condition_selectivity(self, condition: tuple) -> float:
+        """Ожидаемая доля пользователей, удовлетворяющих условию (без индексов)."""
+        attribute, operator, value, negate, contact_type, data_type = condition
+        if value.lower() in ['true', 'false']:
+            selectivity = 0.5
+        else:
+            selectivity = self.DEFAULT_SELECTIVITY.get(operator.lower(), 0.5)
+        return 1 - selectivity if negate else selectivity
+
+    def optimize(self, search_index: "SearchIndex" = None):
+        """
+        Перестраивает предикат запроса, упорядочивая условия внутри групп and/or.
+
+        Группа and проверяется до первого ложного условия, поэтому первыми идут условия
+        с наименьшим отношением стоимость / (1 - селективность); группа or - до первого
+        истинного, первыми идут условия с наименьшим отношением стоимость / селективность.
+
+        Args:
+            search_index: Индексы для поиска (SearchIndex), по которым уже выполнен find_candidates.
+                Селективность индексируемых условий берется из индексов, а условия, точно найденные
+                по индексам, проверяются по принадлежности пользователя найденному множеству
+        """
+        leaves = []
+        for idx, (condition, predicate) in enumerate(zip(self.conditions, self.condition_predicates)):
+            found = self.index_candidates[idx] if search_index is not None and self.index_candidates else None
+            if found is not None and found[1]:
+                # Инверсия уже учтена в найденном множестве
+                found_ids = {id(search_index.users[pos]) for pos in found[0]}
+                predicate = _member_predicate(found_ids)
+                cost = 0.5
+            else:
+                if condition[3]:
+                    predicate = _negate_predicate(predicate)
+                cost = self.estimate_condition_cost(condition)
+            if found is not None and search_index.users:
+                selectivity = len(found[0]) / len(search_index.users)
+            else:
+                selectivity = self.estimate_condition_selectivity(condition)
+            leaves.append((predicate, cost, selectivity))
+
+        def build(node):
+            # Возвращает (предикат, стоимость, селективность) узла дерева
+            if not isinstance(node, tuple):
+                return leaves[node]
+
+            logical_op, children = node
+            built = [build(child) for child in children]
+            if logical_op == 'and':
+                built.sort(key=lambda item: item[1] / max(1 - item[2], 1e-6))
+                combine = _and_predicates
+            else:
+                built.sort(key=lambda item: item[1] / max(item[2], 1e-6))
+                combine = _or_predicates
+
+            predicate, cost, selectivity = built[0]
+            # Вероятность того, что проверка группы дойдет до следующего условия
+            reach = selectivity if logical_op == 'and' else 1 - selectivity
+            for child_predicate, child_cost, child_selectivity in built[1:]:
+                predicate = combine(predicate, child_predicate)
+                cost += reach * child_cost
                 if logical_op == 'and':
-                    result_value = result_value and cond_result
-                elif logical_op == 'or':
-                    result_value = result_value or cond_result
-        
-        if result_value:
-            result.append(user)
-    
-    return result
+                    selectivity *= child_selectivity
+                    reach = selectivity
+                else:
+                    selectivity = 1 - (1 - selectivity) * (1 - child_selectivity)
+                    reach = 1 - selectivity
+            return predicate, cost, selectivity
+
+        self.predicate = build(self.tree)[0]
+
+
+def compile_complex_query(query: str, settings: "SettingParams" = None):
+    """
+    Компилирует сложный запрос: каждое условие компилируется один раз (см. compile_condition).
+
+    Args:
+        query: Строка сложного запроса
+        settings: Объект настроек приложения (опционально, для загрузки алиасов из файла)
+
+    Returns:
+        CompiledQuery или None, если запрос пустой или содержит ошибку
+    """
+    parsed = parse_complex_query_conditions(query, settings)
+    if not parsed or not parsed[0]:
+        return None
+    conditions, logical_ops = parsed
+    return CompiledQuery(conditions, logical_ops)
+
+
+class UserColumn:
+    """
+    Колонка атрибута в колоночном снимке пользователей (UserColumns).
+
+    Значения атрибута хранятся словарем: values - различные значения (списки - в виде кортежей),
+    codes - номер значения для каждой строки снимка. Одинаковые значения у тысяч пользователей
+    (подразделение, должность, признаки) хранятся один раз, а пользователи с одинаковым
+    значением находятся по номеру значения без обращения к словарям пользователей.
+    Строки с нехешируемым значением имеют номер -1 и перечислены в unhashable.
+    """
+
+    __slots__ = ('values', 'codes', 'unhashable')
+
+    def __init__(self, values: list, codes: array, unhashable: list):
+        self.values = values
+        self.codes = codes
+        self.unhashable = unhashable
+
+    def rows_by_value(self) -> list:
+        # Для каждого значения - номера строк с этим значением (в порядке строк)
+        rows_by_value = [[] for _ in self.values]
+        for row, code in enumerate(self.codes):
+            if code >= 0:
+                rows_by_value[code].append(row)
+        return rows_by_value
+
+
+class UserColumns:
+    """
+    Колоночный снимок списка пользователей для поиска и сортировки.
+
+    Строится при обновлении расширенного списка пользователей (get_extended_api360_users).
+    Строка снимка - позиция пользователя в списке users; колонки по атрибутам строятся
+    при первом обращении к атрибуту:
+    - column: значения атрибута словарем (UserColumn), атрибут ищется так же, как в условиях поиска;
+    - dates: даты атрибута в микросекундах от 1970-01-01 (array 'q'), DATE_MISSING - нет даты;
+    - sort_ranks: ранги значений для сортировки при выводе (display_users_list).
+
+    Args:
+        users: Список пользователей
+    """
+
+    DATE_MISSING = -2 ** 63
+    EPOCH = datetime(1970, 1, 1)
+    MICROSECOND = timedelta(microseconds=1)
+
+    def __init__(self, users: list):
+        self.users = users
+        self.rows = {id(user): row for row, user in enumerate(users)}
+        self.columns = {}
+        self.date_columns = {}
+        self.sort_rank_columns = {}
+
+    @classmethod
+    def to_epoch_us(cls, value: datetime) -> int:
+        return (value - cls.EPOCH) // cls.MICROSECOND
+
+    @staticmethod
+    def _encode(values) -> UserColumn:
+        table = []
+        codes_by_key = {}
+        codes = array('i')
+        unhashable = []
+        for row, value in enumerate(values):
+            if value.__class__ is list:
+                value = tuple(value)
+            key = (value.__class__, value)
+            try:
+                code = codes_by_key.get(key)
+                if code is None:
+                    code = codes_by_key[key] = len(table)
+                    table.append(value)
+            except TypeError:
+                code = -1
+                unhashable.append(row)
+            codes.append(code)
+        return UserColumn(table, codes, unhashable)
+
+    def column(self, field: str) -> UserColumn:
+        if field not in self.columns:
+            getter = compile_attribute_getter(field)
+            self.columns[field] = self._encode(getter(user) for user in self.users)
+        return self.columns[field]
+
+    def dates(self, field: str) -> array:
+        if field not in self.date_columns:
+            column = self.column(field)
+            value_dates = []
+            for value in column.values:
+                attr_date = parse_attribute_date(str(value)) if value else None
+                value_dates.append(self.to_epoch_us(attr_date) if attr_date else self.DATE_MISSING)
+            self.date_columns[field] = array('q', (value_dates[code] if code >= 0 else self.DATE_MISSING for code in column.codes))
+        return self.date_columns[field]
+
+    def sort_ranks(self, field: str):
+        """
+        Возвращает ранги значений атрибута для сортировки (по правилам display_users_list) для каждой строки
+        или None, если значения атрибута нельзя сравнить без обращения к пользователям.
+        """
+        if field not in self.sort_rank_columns:
+            keys = field.split('.')
+
+            def get_display_value(user):
+                value = user
+                for key in keys:
+                    if isinstance(value, USER_MAPPING_TYPES):
+                        value = value.get(key, '')
+                    else:
+                        return ''
+                return value if value is not None else ''
+
+            column = self._encode(get_display_value(user) for user in self.users)
+            ranks = None
+            if not column.unhashable:
+                sort_values = [int(value) if isinstance(value, bool) else value.lower() if isinstance(value, str) else value
+                               for value in column.values]
+                try:
+                    order = sorted(range(len(sort_values)), key=sort_values.__getitem__)
+                except TypeError:
+                    order = None
+                if order is not None:
+                    # Равные значения (например, 'Ivanov' и 'ivanov') получают одинаковый ранг
+                    rank_by_code = [0] * len(order)
+                    rank = 0
+                    for idx, code in enumerate(order):
+                        if idx and sort_values[code] != sort_values[order[idx - 1]]:
+                            rank += 1
+                        rank_by_code[code] = rank
+                    ranks = array('i', (rank_by_code[code] for code in column.codes))
+            self.sort_rank_columns[field] = ranks
+        return self.sort_rank_columns[field]
+
+
+def get_user_columns(settings: "SettingParams", users: list) -> UserColumns:
+    """
+    Возвращает колоночный снимок списка пользователей.
+    Снимок перестраивается, если список пользователей обновился.
+    """
+    if settings.user_columns is None or settings.user_columns.users is not users:
+        settings.user_columns = UserColumns(users)
+    return settings.user_columns
+
+
+class SearchIndex:
+    """
+    Вторичные индексы по списку пользователей для сложного поиска (execute_complex_query).
+
+    Хеш-индексы (HASH_FIELDS) группируют пользователей по значению атрибута. Условие, которое
+    зависит только от одного такого атрибута, проверяется один раз для одного пользователя
+    из каждой группы, а не для каждого пользователя. Так же обрабатываются подразделение
+    (department вычисляется по departmentId) и условия по группам (full_groups вычисляется по groups).
+
+    Строковые атрибуты (TEXT_FIELDS) группируются так же, а по их значениям дополнительно строится
+    триграммный индекс: для =, is и contains проверяются только значения, содержащие все триграммы
+    из частей паттерна без wildcards (например, для *петр* - значения с триграммами 'пет' и 'етр').
+
+    Сортированные индексы (SORTED_DATE_FIELDS) позволяют найти пользователей для операторов
+    сравнения дат (<, >, <=, >=, =, between) двоичным поиском.
+
+    Остальные атрибуты группируются так же, как HASH_FIELDS, если различных значений атрибута
+    не больше GENERIC_FIELD_MAX_DISTINCT_RATIO от числа пользователей (язык, часовой пояс и т.п.).
+    Значения атрибутов берутся из колоночного снимка пользователей (UserColumns).
+
+    Индексы возвращают множества позиций пользователей в списке users; условия без индекса
+    проверяются обычным перебором, но только для найденных по индексам кандидатов.
+    Индекс по атрибуту строится при первом запросе, в котором этот атрибут используется.
+
+    Args:
+        users: Список пользователей (get_extended_api360_users)
+        columns: Колоночный снимок того же списка пользователей (если не задан, строится заново)
+    """
+
+    HASH_FIELDS = ('isAdmin', 'isEnabled', 'departmentId', 'gender', 'groups')
+    TEXT_FIELDS = ('name.first', 'name.last', 'name.middle', 'nickname', 'position', 'aliases')
+    SORTED_DATE_FIELDS = ('createdAt', 'birthday', 'isEnabledUpdatedAt')
+    DATE_OPERATORS = ('<', '>', '<=', '>=', '=', 'is', 'between')
+    GENERIC_FIELD_MAX_DISTINCT_RATIO = 0.5
+
+    def __init__(self, users: list, columns: UserColumns = None):
+        self.users = users
+        self.columns = columns if columns is not None and columns.users is users else UserColumns(users)
+        self.all_positions = frozenset(range(len(users)))
+        self.fields_by_lower = {field.lower(): field for field in self.HASH_FIELDS + self.TEXT_FIELDS + self.SORTED_DATE_FIELDS}
+        # field -> ([позиции пользователей для каждого значения], [позиции пользователей с нехешируемым значением])
+        self.buckets = {}
+        # field -> ([позиции пользователей для каждого значения], {триграмма: множество номеров значений})
+        self.trigrams = {}
+        # field -> (отсортированные даты, позиции пользователей в том же порядке)
+        self.sorted_dates = {}
+
+    def _get_buckets(self, field: str) -> tuple:
+        if field not in self.buckets:
+            column = self.columns.column(field)
+            self.buckets[field] = (column.rows_by_value(), column.unhashable)
+        return self.buckets[field]
+
+    def _get_sorted_dates(self, field: str) -> tuple:
+        if field not in self.sorted_dates:
+            dates = self.columns.dates(field)
+            positions = sorted((pos for pos, attr_date in enumerate(dates) if attr_date != UserColumns.DATE_MISSING),
+                               key=dates.__getitem__)
+            self.sorted_dates[field] = (array('q', (dates[pos] for pos in positions)), positions)
+        return self.sorted_dates[field]
+
+    def _get_trigrams(self, field: str) -> tuple:
+        if field not in self.trigrams:
+            values_positions, unhashable = self._get_buckets(field)
+            trigrams = defaultdict(set)
+            for value_id, value in enumerate(self.columns.column(field).values):
+                texts = [str(item).lower() for item in value] if value.__class__ is tuple else [str(value).lower()]
+                for text in texts:
+                    for i in range(len(text) - 2):
+                        trigrams[text[i:i + 3]].add(value_id)
+            self.trigrams[field] = (values_positions, trigrams)
+        return self.trigrams[field]
+
+    def _is_low_cardinality(self, field: str) -> bool:
+        # Группировка по атрибуту с почти уникальными значениями не быстрее перебора
+        column = self.columns.column(field)
+        return len(column.values) + len(column.unhashable) <= len(self.users) * self.GENERIC_FIELD_MAX_DISTINCT_RATIO
+
+    def users_at(self, positions) -> list:
+        return [self.users[pos] for pos in sorted(positions)]
+
+    def _condition_field(self, attribute: str, contact_type: str, data_type: str):
+        # Атрибут пользователя, от которого зависит результат условия (в том же порядке, что и в compile_condition)
+        if data_type == 'array' and contact_type == 'group_aliases':
+            return 'groups'
+        if data_type not in ['array', 'date']:
+            if contact_type:
+                return None
+            if attribute in ['full_groups.name', 'full_groups.label']:
+                return 'groups'
+            if attribute.lower() == 'department':
+                return 'departmentId'
+        return self.fields_by_lower.get(attribute.lower(), attribute)
+
+    @staticmethod
+    def _pattern_trigrams(operator: str, value: str) -> set:
+        # Триграммы, которые обязательно содержит значение атрибута, подходящее под условие
+        if operator.lower() not in ['=', 'is', 'contains']:
+            return set()
+        pattern = value.strip().strip('"').strip("'").lower().strip()
+        return {part[i:i + 3] for part in pattern.split('*') for i in range(len(part) - 2)}
+
+    def _find_buckets(self, field: str, predicate, operator: str = '', value: str = '') -> list:
+        # Все пользователи с одинаковым значением атрибута дают одинаковый результат условия
+        values_positions, unhashable = self._get_buckets(field)
+        found = [[pos for pos in unhashable if predicate(self.users[pos])]]
+        pattern_trigrams = self._pattern_trigrams(operator, value) if field in self.TEXT_FIELDS else None
+        if not pattern_trigrams:
+            found.extend(bucket_positions for bucket_positions in values_positions if predicate(self.users[bucket_positions[0]]))
+            return found
+
+        # Проверяются только значения, содержащие все триграммы паттерна (начиная с самой редкой)
+        values_positions, trigrams = self._get_trigrams(field)
+        postings = sorted((trigrams.get(trigram, set()) for trigram in pattern_trigrams), key=len)
+        value_ids = set(postings[0]).intersection(*postings[1:])
+        found.extend(values_positions[value_id] for value_id in sorted(value_ids)
+                     if predicate(self.users[values_positions[value_id][0]]))
+        return found
+
+    def _find_date_range(self, field: str, operator: str, value: str) -> tuple:
+        # Возвращает (начало, конец, точно) - диапазон в отсортированном индексе дат
+        dates, positions = self._get_sorted_dates(field)
+        to_epoch_us = UserColumns.to_epoch_us
+        if operator == 'between':
+            bounds = value.replace(',', ' ').split()
+            if len(bounds) < 2:
+                return 0, 0, True
+            date1, date2 = parse_date_value(bounds[0]), parse_date_value(bounds[1])
+            if not date1 or not date2:
+                return 0, 0, True
+            date1, date2 = to_epoch_us(date1.replace(tzinfo=None)), to_epoch_us(date2.replace(tzinfo=None))
+            # between разбирает дату атрибута строже, поэтому результат требует проверки
+            return bisect.bisect_left(dates, date1), bisect.bisect_right(dates, date2), False
+
+        query_date = parse_date_value(value)
+        if not query_date:
+            return 0, 0, True
+        query_date = query_date.replace(tzinfo=None)
+        # Относительная дата вычисляется от текущего времени, поэтому результат требует проверки
+        exact = parse_relative_date(value) is None
+        query_us = to_epoch_us(query_date)
+        if operator == '<':
+            return 0, bisect.bisect_left(dates, query_us), exact
+        if operator == '<=':
+            return 0, bisect.bisect_right(dates, query_us), exact
+        if operator == '>':
+            return bisect.bisect_right(dates, query_us), len(dates), exact
+        if operator == '>=':
+            return bisect.bisect_left(dates, query_us), len(dates), exact
+        # Для равенства сравниваются только даты без времени
+        day_start = datetime.combine(query_date.date(), datetime.min.time())
+        start = bisect.bisect_left(dates, to_epoch_us(day_start))
+        end = bisect.bisect_left(dates, to_epoch_us(day_start + timedelta(days=1)))
+        return start, end, exact
+
+    def _is_date_condition(self, field: str, operator: str, data_type: str) -> bool:
+        return field in self.SORTED_DATE_FIELDS and data_type == 'date' and operator in self.DATE_OPERATORS
+
+    def find_condition_candidates(self, condition: tuple, predicate):
+        """
+        Находит по индексам позиции пользователей, удовлетворяющих условию.
+
+        Returns:
+            Кортеж (позиции, точно) или None, если для условия нет индекса.
+            Если точно == False, позиции - надмножество результата и требуют проверки предикатом
+        """
+        attribute, operator, value, negate, contact_type, data_type = condition
+        field = self._condition_field(attribute, contact_type, data_type)
+        if self._is_date_condition(field, operator, data_type):
+            start, end, exact = self._find_date_range(field, operator, value)
+            positions = set(self.sorted_dates[field][1][start:end])
+        elif field in self.HASH_FIELDS or field in self.TEXT_FIELDS or (field is not None and self._is_low_cardinality(field)):
+            positions, exact = set(), True
+            for bucket_positions in self._find_buckets(field, predicate, operator, value):
+                positions.update(bucket_positions)
+        else:
+            return None
+
+        if negate:
+            return (self.all_positions - positions, True) if exact else None
+        return positions, exact
+
+    def find_candidates(self, compiled_query: CompiledQuery):
+        """
+        Находит по индексам кандидатов для всего запроса, объединяя условия так же, как CompiledQuery.
+        Результаты по отдельным условиям сохраняются в compiled_query.index_candidates.
+
+        Returns:
+            Кортеж (позиции, точно) или None, если запрос нельзя сузить индексами (нужен полный перебор)
+        """
+        compiled_query.index_candidates = [self.find_condition_candidates(condition, predicate)
+                                           for condition, predicate in zip(compiled_query.conditions, compiled_query.condition_predicates)]
+        result = None
+        for idx, found in enumerate(compiled_query.index_candidates):
+            if idx == 0:
+                result = found
+            elif compiled_query.logical_ops[idx - 1] == 'and':
+                # Условие без индекса не сужает кандидатов, но результат требует проверки
+                if result is None:
+                    result = (found[0], False) if found else None
+                elif found is None:
+                    result = (result[0], False)
+                else:
+                    result = (result[0] & found[0], result[1] and found[1])
+            elif compiled_query.logical_ops[idx - 1] == 'or':
+                if result is None or found is None:
+                    result = None
+                else:
+                    result = (result[0] | found[0], result[1] and found[1])
+        return result
+
+
+def get_search_index(settings: "SettingParams", users: list) -> SearchIndex:
+    """
+    Возвращает индексы для поиска по списку пользователей.
+    Индексы перестраиваются, если список пользователей обновился.
+    """
+    if settings.search_index is None or settings.search_index.users is not users:
+        settings.search_index = SearchIndex(users, get_user_columns(settings, users))
+    return settings.search_index
+
+
+class QueryResultCache:
+    """
+    LRU-кэш результатов сложного поиска (execute_complex_query).
+
+    Ключ - нормализованный запрос (условия и логические операторы после разбора, т.е. без
+    учета пробелов, регистра операторов и синонимов атрибутов) и версия данных организации
+    (settings.snapshot_version). Значение - список id найденных пользователей.
+    Версия увеличивается при каждом обновлении кэша пользователей и изменении данных через API,
+    поэтому результаты, полученные по устаревшим данным, не возвращаются.
+
+    Запросы с относительными датами (-7d, 2w и т.п.) не кэшируются: их результат зависит от текущего времени.
+
+    Args:
+        max_size: Максимальное количество запросов в кэше
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Список пользователей, по которому построен словарь id -> пользователь
+        self.users = None
+        self.by_id = {}
+
+    @staticmethod
+    def make_key(compiled_query: CompiledQuery, snapshot_version: int):
+        """
+        Возвращает ключ кэша для запроса или None, если результат запроса кэшировать нельзя.
+        """
+        for attribute, operator, value, negate, contact_type, data_type in compiled_query.conditions:
+            if data_type == 'date' and any(parse_relative_date(part) for part in value.replace(',', ' ').split()):
+                return None
+        return (tuple(compiled_query.conditions), tuple(compiled_query.logical_ops), snapshot_version)
+
+    def _bind(self, users: list):
+        # Новый список пользователей - новые данные: прежние результаты не используются
+        if self.users is not users:
+            self.users = users
+            self.by_id = {user['id']: user for user in users}
+            self.entries.clear()
+
+    def get(self, key, users: list):
+        """
+        Возвращает найденных пользователей из кэша или None, если результата нет в кэше.
+        """
+        self._bind(users)
+        user_ids = self.entries.get(key)
+        if user_ids is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return [self.by_id[user_id] for user_id in user_ids]
+
+    def put(self, key, users: list, found: list):
+        self._bind(users)
+        self.entries[key] = [user['id'] for user in found]
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+def get_query_cache(settings: "SettingParams"):
+    """
+    Возвращает кэш результатов сложного поиска или None, если кэш отключен (QUERY_CACHE_SIZE = 0).
+    """
+    if settings.query_cache_size <= 0:
+        return None
+    if settings.query_cache is None:
+        settings.query_cache = QueryResultCache(settings.query_cache_size)
+    return settings.query_cache
+
+
+@dataclass
+class ComplexQueryResult:
+    """
+    Результат сложного поиска в find_users_prompt, который может быть уточнен следующим запросом.
+
+    Attributes:
+        query: Строка запроса
+        users: Список пользователей, по которому выполнен поиск
+        snapshot_version: Версия данных организации (settings.snapshot_version) на момент поиска
+        found: Найденные пользователи
+    """
+    query: str
+    users: list
+    snapshot_version: int
+    found: list
+
+
+def refine_complex_query(previous: ComplexQueryResult, users: list, query: str, settings: "SettingParams"):
+    """
+    Выполняет запрос, уточняющий предыдущий, только по результатам предыдущего запроса.
+
+    Запрос считается уточнением, если он начинается с условий предыдущего запроса, а все
+    добавленные условия присоединены через and: ((предыдущий) and c1) and c2 ...
+    Так как условия объединяются слева направо, результат такого запроса - подмножество
+    предыдущего результата, и новые условия достаточно проверить только для него.
+
+    Args:
+        previous: Результат предыдущего запроса (или None)
+        users: Список всех пользователей
+        query: Строка нового запроса
+        settings: Объект настроек приложения
+
+    Returns:
+        Список найденных пользователей или None, если запрос не уточняет предыдущий
+        или данные организации изменились после предыдущего запроса
+    """
+    if previous is None or previous.users is not users or previous.snapshot_version != settings.snapshot_version:
+        return None
+
+    compiled_query = compile_complex_query(query, settings)
+    previous_query = compile_complex_query(previous.query, settings)
+    if compiled_query is None or previous_query is None:
+        return None
+    prefix_len = len(previous_query.conditions)
+    if (len(compiled_query.conditions) <= prefix_len
+            or compiled_query.conditions[:prefix_len] != previous_query.conditions
+            or compiled_query.logical_ops[:prefix_len - 1] != previous_query.logical_ops
+            or any(op != 'and' for op in compiled_query.logical_ops[prefix_len - 1:])):
+        return None
+
+    refinement = CompiledQuery(compiled_query.conditions[prefix_len:], compiled_query.logical_ops[prefix_len:])
+    logger.info(f"Уточнение предыдущего запроса: проверено кандидатов {len(previous.found)} из {len(users)}")
+    query_predicate = refinement.predicate
+    found = [user for user in previous.found if query_predicate(user)]
+
+    query_cache = get_query_cache(settings)
+    cache_key = QueryResultCache.make_key(compiled_query, settings.snapshot_version) if query_cache else None
+    if cache_key is not None:
+        query_cache.put(cache_key, users, found)
+    return found
+
+
+def execute_complex_query(users: list, query: str, settings: "SettingParams" = None) -> list:
+    """
+    Выполняет сложный запрос и возвращает список найденных пользователей.
+    Запрос компилируется один раз и затем применяется ко всем пользователям.
+    Если включены индексы (SEARCH_USE_INDEXES), условия сначала сужают список кандидатов по индексам.
+    Условия проверяются в порядке, выбранном CompiledQuery.optimize (дешевые и отсекающие - первыми).
+    Результаты запросов сохраняются в кэше (QUERY_CACHE_SIZE) до обновления данных организации.
+
+    Args:
+        users: Список всех пользователей
+        query: Строка сложного запроса
+        settings: Объект настроек приложения (опционально, для загрузки алиасов из файла)
+
+    Returns:
+        Список пользователей, соответствующих запросу
+    """
+    compiled_query = compile_complex_query(query, settings)
+    if compiled_query is None:
+        return []
+
+    query_cache = get_query_cache(settings) if settings is not None else None
+    cache_key = QueryResultCache.make_key(compiled_query, settings.snapshot_version) if query_cache else None
+    if cache_key is not None:
+        found = query_cache.get(cache_key, users)
+        logger.debug(f"Кэш результатов поиска: попаданий {query_cache.hits}, промахов {query_cache.misses}")
+        if found is not None:
+            return found
+
+    found = _execute_compiled_query(users, compiled_query, settings)
+    if cache_key is not None:
+        query_cache.put(cache_key, users, found)
+    return found
+
+
+def _execute_compiled_query(users: list, compiled_query: CompiledQuery, settings: "SettingParams" = None) -> list:
+    if settings is not None and settings.search_use_indexes:
+        search_index = get_search_index(settings, users)
+        candidates = search_index.find_candidates(compiled_query)
+        if candidates is not None:
+            positions, exact = candidates
+            logger.debug(f"Кандидатов по индексам: {len(positions)} из {len(users)} (точно: {exact})")
+            if exact:
+                return search_index.users_at(positions)
+            users = search_index.users_at(positions)
+        # Оставшиеся проверки упорядочиваем по селективности, оцененной по индексам
+        compiled_query.optimize(search_index)
+
+    query_predicate = compiled_query.predicate
+    return [user for user in users if query_predicate(user)]
 
 
 def show_search_help():
@@ -5379,7 +7261,7 @@ def show_search_help():
     """
     print("\n=== Справка по поиску пользователей ===")
     print("Простой поиск: ID, часть логина, алиаса или фамилии (через пробел, запятую или точку с запятой)")
-    print("  Поддерживается wildcard (*). Примеры: iva*, *nov, *петр*")
+    print("  Поддерживается wildcard (*). Примеры: iva*, *nov, *петр*, iv*ov")
     print("\nСложный поиск: <атрибут> <оператор> <значение> [and|or <атрибут> <оператор> <значение>]")
     print("  Операторы: =, is, contains, not, in, <, >, <=, >=, between")
     print("\n  Допустимые атрибуты (и их алиасы):")
@@ -5442,7 +7324,123 @@ def show_search_help():
     print("Выход: пустая строка (Enter)")
 
 
-def display_users_list(users_list, rows_per_page=20, page_number=1, sort_field='nickname', sort_order='asc', fields_config=None):
+def _display_sort_key(users_list, sort_field, columns=None):
+    # Ключ сортировки по позиции пользователя в users_list (см. sort_users_for_display)
+    if columns is not None and (sort_field in columns.sort_rank_columns or len(users_list) * 4 >= len(columns.users)):
+        ranks = columns.sort_ranks(sort_field)
+        get_row = columns.rows.get
+        rows = [get_row(id(user)) for user in users_list]
+        if ranks is not None and None not in rows:
+            return [ranks[row] for row in rows].__getitem__
+
+    def get_nested_value(obj, field_path):
+        """Получает значение вложенного поля, например 'name.first'"""
+        keys = field_path.split('.')
+        value = obj
+        for key in keys:
+            if isinstance(value, USER_MAPPING_TYPES):
+                value = value.get(key, '')
+            else:
+                return ''
+        return value if value is not None else ''
+
+    def get_sort_value(idx):
+        value = get_nested_value(users_list[idx], sort_field)
+        # Преобразуем значение для корректной сортировки
+        if isinstance(value, bool):
+            return int(value)
+        if isinstance(value, str):
+            return value.lower()
+        return value if value is not None else ''
+
+    return get_sort_value
+
+
+def sort_users_for_display(users_list, sort_field, sort_order, columns=None, limit=None):
+    """
+    Сортирует список пользователей для вывода (display_users_list, interactive_display_users).
+
+    Строки сравниваются без учета регистра, булевы значения - как числа. Если передан колоночный
+    снимок (UserColumns), в котором есть все пользователи списка, сортировка выполняется по рангам
+    значений из снимка, без обращения к вложенным атрибутам каждого пользователя. Колонка снимка
+    строится по всем пользователям, поэтому для небольшой выборки она используется, только если уже построена.
+
+    Если задан limit, возвращаются только первые limit пользователей (heapq.nsmallest/nlargest):
+    результат совпадает с началом полностью отсортированного списка.
+
+    Args:
+        users_list: Список пользователей
+        sort_field: Поле для сортировки (поддерживаются вложенные поля через точку)
+        sort_order: Порядок сортировки - 'asc' или 'desc'
+        columns: Колоночный снимок пользователей (опционально)
+        limit: Количество первых пользователей в порядке сортировки (опционально)
+
+    Returns:
+        Отсортированный список пользователей (исходный список, если значения поля нельзя сравнить)
+    """
+    reverse = sort_order.lower() == 'desc'
+    sort_key = _display_sort_key(users_list, sort_field, columns)
+    positions = range(len(users_list))
+    try:
+        if limit is not None and limit < len(users_list):
+            select = heapq.nlargest if reverse else heapq.nsmallest
+            order = select(limit, positions, key=sort_key)
+        else:
+            order = sorted(positions, key=sort_key, reverse=reverse)
+    except Exception as e:
+        logger.error(f"Ошибка при сортировке по полю '{sort_field}': {e}")
+        return users_list if limit is None else users_list[:limit]
+    return [users_list[idx] for idx in order]
+
+
+class SortedUsersView:
+    """
+    Отсортированные представления списка пользователей для постраничного вывода
+    (display_users_list, interactive_display_users).
+
+    Порядок пользователей сохраняется для каждой пары (поле, порядок сортировки), поэтому переход
+    между страницами и возврат к прежней сортировке не сортируют список заново. Представление
+    относится к одному списку users_list: для другого списка создается новое представление.
+
+    Для первых страниц большого списка выбираются только первые пользователи в порядке сортировки
+    (sort_users_for_display с limit); полная сортировка выполняется, когда запрошенная страница
+    дальше TOP_K_MAX_RATIO от начала списка.
+
+    Args:
+        users_list: Список пользователей
+        columns: Колоночный снимок пользователей (UserColumns) для сортировки (опционально)
+    """
+
+    TOP_K_MAX_RATIO = 0.1
+
+    def __init__(self, users_list: list, columns=None):
+        self.users = users_list
+        self.columns = columns
+        # (поле, порядок) -> первые пользователи в порядке сортировки (все, если список отсортирован полностью)
+        self.orders = {}
+
+    def sorted_users(self, sort_field: str, sort_order: str) -> list:
+        key = (sort_field, sort_order.lower())
+        ordered = self.orders.get(key)
+        if ordered is None or len(ordered) < len(self.users):
+            ordered = self.orders[key] = sort_users_for_display(self.users, sort_field, sort_order, self.columns)
+        return ordered
+
+    def page(self, sort_field: str, sort_order: str, start: int, end: int) -> list:
+        key = (sort_field, sort_order.lower())
+        ordered = self.orders.get(key)
+        if ordered is not None and (len(ordered) >= end or len(ordered) == len(self.users)):
+            return ordered[start:end]
+        # Выбираем с запасом (и с ростом при каждом следующем выборе), чтобы следующие страницы
+        # брались из уже выбранных пользователей
+        limit = max(2 * end, 4 * len(ordered or ()))
+        if limit > len(self.users) * self.TOP_K_MAX_RATIO:
+            return self.sorted_users(sort_field, sort_order)[start:end]
+        ordered = self.orders[key] = sort_users_for_display(self.users, sort_field, sort_order, self.columns, limit)
+        return ordered[start:end]
+
+
+def display_users_list(users_list, rows_per_page=20, page_number=1, sort_field='nickname', sort_order='asc', fields_config=None, columns=None, sorted_view=None):
     """
     Отображает список пользователей в консоли с поддержкой пагинации, сортировки и настройки колонок.
     
@@ -5462,6 +7460,9 @@ def display_users_list(users_list, rows_per_page=20, page_number=1, sort_field='
                       - Порядок определяет позицию колонки (можно опустить)
                       - Если значение не помещается в колонку, оно обрезается, последний символ заменяется на '…'
                       - Нулевая колонка "№" добавляется автоматически с порядковым номером
+        columns: Колоночный снимок пользователей (UserColumns) для сортировки (опционально)
+        sorted_view: Отсортированные представления того же списка (SortedUsersView), сохраняемые между
+                     вызовами (опционально); выбираются и форматируются только пользователи текущей страницы
     
     Returns:
         None
@@ -5553,31 +7554,18 @@ def display_users_list(users_list, rows_per_page=20, page_number=1, sort_field='
         keys = field_path.split('.')
         value = obj
         for key in keys:
-            if isinstance(value, dict):
+            if isinstance(value, USER_MAPPING_TYPES):
                 value = value.get(key, '')
             else:
                 return ''
         return value if value is not None else ''
     
-    # Функция для получения значения для сортировки
-    def get_sort_value(user):
-        value = get_nested_value(user, sort_field)
-        # Преобразуем значение для корректной сортировки
-        if isinstance(value, bool):
-            return int(value)
-        if isinstance(value, str):
-            return value.lower()
-        return value if value is not None else ''
-    
-    # Сортировка списка пользователей
-    try:
-        sorted_users = sorted(users_list, key=get_sort_value, reverse=(sort_order.lower() == 'desc'))
-    except Exception as e:
-        logger.error(f"Ошибка при сортировке по полю '{sort_field}': {e}")
-        sorted_users = users_list
+    # Отсортированные представления списка (сохраняются между вызовами, если переданы)
+    if sorted_view is None or sorted_view.users is not users_list:
+        sorted_view = SortedUsersView(users_list, columns)
     
     # Расчет пагинации
-    total_users = len(sorted_users)
+    total_users = len(users_list)
     total_pages = (total_users + rows_per_page - 1) // rows_per_page  # Округление вверх
     
     # Проверка корректности номера страницы
@@ -5589,7 +7577,7 @@ def display_users_list(users_list, rows_per_page=20, page_number=1, sort_field='
     # Определение диапазона пользователей для текущей страницы
     start_idx = (page_number - 1) * rows_per_page
     end_idx = min(start_idx + rows_per_page, total_users)
-    page_users = sorted_users[start_idx:end_idx]
+    page_users = sorted_view.page(sort_field, sort_order, start_idx, end_idx)
     
     # Функция для обрезки текста с добавлением многоточия
     def truncate_text(text, width):
@@ -5859,6 +7847,10 @@ def interactive_display_users(users_list, settings=None, rows_per_page=20, sort_
     # Получаем имя файла из settings или используем значение по умолчанию
     fields_file = settings.display_users_fields_file if settings else "fields_spec.txt"
     loaded_fields_config = load_fields_config_from_file(fields_file)
+    # Колоночный снимок списка, из которого выбраны пользователи (для сортировки без обхода вложенных атрибутов)
+    columns = settings.user_columns if settings else None
+    # Порядок пользователей для каждой сортировки вычисляется один раз за сеанс просмотра
+    sorted_view = SortedUsersView(users_list, columns)
     
     # Инициализация параметров
     current_page = 1
@@ -5982,7 +7974,7 @@ def interactive_display_users(users_list, settings=None, rows_per_page=20, sort_
             actual_keys = []
             
             for key in keys:
-                if isinstance(value, dict):
+                if isinstance(value, USER_MAPPING_TYPES):
                     # Ищем ключ без учета регистра
                     found_key = None
                     key_lower = key.lower()
@@ -6018,31 +8010,7 @@ def interactive_display_users(users_list, settings=None, rows_per_page=20, sort_
     # Функция для получения отсортированного списка пользователей
     def get_sorted_users():
         """Получает отсортированный список пользователей согласно текущим настройкам"""
-        def get_nested_value(obj, field_path):
-            """Получает значение вложенного поля, например 'name.first'"""
-            keys = field_path.split('.')
-            value = obj
-            for key in keys:
-                if isinstance(value, dict):
-                    value = value.get(key, '')
-                else:
-                    return ''
-            return value if value is not None else ''
-        
-        def get_sort_value(user):
-            value = get_nested_value(user, current_sort_field)
-            # Преобразуем значение для корректной сортировки
-            if isinstance(value, bool):
-                return int(value)
-            if isinstance(value, str):
-                return value.lower()
-            return value if value is not None else ''
-        
-        try:
-            return sorted(users_list, key=get_sort_value, reverse=(current_sort_order.lower() == 'desc'))
-        except Exception as e:
-            logger.error(f"Ошибка при сортировке по полю '{current_sort_field}': {e}")
-            return users_list
+        return sorted_view.sorted_users(current_sort_field, current_sort_order)
     
     # Основной цикл
     while True:
@@ -6053,7 +8021,9 @@ def interactive_display_users(users_list, settings=None, rows_per_page=20, sort_
             page_number=current_page,
             sort_field=current_sort_field,
             sort_order=current_sort_order,
-            fields_config=current_fields_config
+            fields_config=current_fields_config,
+            columns=columns,
+            sorted_view=sorted_view
         )
         
         # Запрос команды от пользователя
@@ -6114,7 +8084,7 @@ def interactive_display_users(users_list, settings=None, rows_per_page=20, sort_
                 
                 def collect_fields_recursive(obj, prefix=''):
                     """Рекурсивно собирает поля из объекта"""
-                    if isinstance(obj, dict):
+                    if isinstance(obj, USER_MAPPING_TYPES):
                         for key, value in obj.items():
                             field_path = f"{prefix}.{key}" if prefix else key
                             all_fields.add(field_path)
@@ -6409,6 +8379,9 @@ def find_users_prompt(settings: "SettingParams"):
     print("Справка: ? (вопросительный знак)")
     print("Выход: пустая строка (Enter)")
     
+    # Результат последнего сложного запроса: следующий запрос с дополнительными условиями "and ..." проверяется только по нему
+    previous_result = None
+
     while True:
         double_users_flag = False
         
@@ -6440,7 +8413,10 @@ def find_users_prompt(settings: "SettingParams"):
             # Сложный поиск
             logger.info("Обнаружен сложный запрос поиска")
             try:
-                users_to_add = execute_complex_query(users, answer, settings)
+                users_to_add = refine_complex_query(previous_result, users, answer, settings)
+                if users_to_add is None:
+                    users_to_add = execute_complex_query(users, answer, settings)
+                previous_result = ComplexQueryResult(answer, users, settings.snapshot_version, users_to_add)
                 if users_to_add:
                     logger.info(f"Найдено пользователей: {len(users_to_add)}")
                     for user in users_to_add:
@@ -6454,6 +8430,7 @@ def find_users_prompt(settings: "SettingParams"):
         else:
             # Простой поиск (существующая логика)
             logger.info("Выполняется простой запрос поиска")
+            previous_result = None
             
             # Если пустая строка после обработки "*", получить всех пользователей
             if not answer.strip():
@@ -6487,11 +8464,14 @@ def find_users_prompt(settings: "SettingParams"):
 
                     else:
                         found_last_name_user = []
+                        # Паттерн компилируется один раз для всех пользователей
+                        match_searched = compile_wildcard_match(searched.strip())
+                        contains_searched = compile_wildcard_contains(searched.strip())
                         for user in users:
                             aliases_lower_case = [r.lower() for r in user['aliases']]
                             
                             # Проверка nickname с поддержкой wildcard
-                            if wildcard_match(user['nickname'], searched.strip()):
+                            if match_searched(user['nickname'].lower()):
                                 logger.debug(f"User found: {user['nickname']} ({user['id']})")
                                 users_to_add.append(user)
                                 found_flag = True
@@ -6499,7 +8479,7 @@ def find_users_prompt(settings: "SettingParams"):
                             
                             # Проверка алиасов с поддержкой wildcard
                             for alias in aliases_lower_case:
-                                if wildcard_match(alias, searched.strip()):
+                                if match_searched(alias):
                                     logger.debug(f"User found: {user['nickname']} ({user['id']})")
                                     users_to_add.append(user)
                                     found_flag = True
@@ -6509,7 +8489,7 @@ def find_users_prompt(settings: "SettingParams"):
                                 break
                             
                             # Проверка фамилии с поддержкой wildcard
-                            if wildcard_contains(user['name']['last'], searched.strip()):
+                            if contains_searched(user['name']['last'].lower()):
                                 found_last_name_user.append(user)
                                 
                         if not found_flag and found_last_name_user:
@@ -6634,9 +8614,6 @@ def delete_users_from_list(settings: "SettingParams", users_to_delete: list):
         else:
             failed_count += 1
             logger.error(f"✗ Не удалось удалить пользователя {nickname}.")
-        
-        # Небольшая пауза между запросами
-        time.sleep(SLEEP_TIME_BETWEEN_API_CALLS)
     
     logger.info("-" * 100)
     logger.info(f"Удаление завершено. Успешно: {success_count}, Ошибок: {failed_count}")
@@ -6673,6 +8650,7 @@ def delete_users_from_file(settings: "SettingParams", file_name: str):
     if not all_api_users:
         logger.error("Не удалось получить список пользователей из API 360.")
         return False
+    index = get_directory_index(settings)
     
     try:
         with open(file_name, 'r', encoding='utf-8') as csvfile:
@@ -6700,12 +8678,12 @@ def delete_users_from_file(settings: "SettingParams", file_name: str):
                 
                 if user_id:
                     # Поиск по ID
-                    found_user = next((u for u in all_api_users if u['id'] == user_id), None)
+                    found_user = index.find_by_id(user_id)
                 
                 if not found_user and login:
                     # Поиск по логину
                     login_clean = login.split('@')[0] if '@' in login else login
-                    found_user = next((u for u in all_api_users if u['nickname'].lower() == login_clean.lower()), None)
+                    found_user = index.find_by_nickname(login_clean)
                 
                 if found_user:
                     users_to_delete.append(found_user)